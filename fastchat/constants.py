@@ -39,6 +39,13 @@ BLIND_MODE_INPUT_CHAR_LEN_LIMIT = int(
 )
 # Maximum conversation turns
 CONVERSATION_TURN_LIMIT = 50
+# Seconds between the UI frames of a streamed answer
+STREAM_FRAME_INTERVAL = float(os.getenv("FASTCHAT_STREAM_FRAME_INTERVAL", 0.03))
+# Replay speed of answers that arrive in one piece, and the longest replay
+REPLAY_CHARS_PER_SEC = int(os.getenv("FASTCHAT_REPLAY_CHARS_PER_SEC", 2000))
+REPLAY_MAX_DURATION = float(os.getenv("FASTCHAT_REPLAY_MAX_DURATION", 1.0))
+# Seconds a side of a battle may go without output before it is stopped
+BATTLE_SIDE_TIMEOUT = int(os.getenv("FASTCHAT_BATTLE_SIDE_TIMEOUT", 300))
 # Session expiration time
 SESSION_EXPIRATION_TIME = 3600
 # The output dir of log files
@@ -53,6 +60,16 @@ CONTROLLER_HEART_BEAT_EXPIRATION = int(
 )
 WORKER_HEART_BEAT_INTERVAL = int(os.getenv("FASTCHAT_WORKER_HEART_BEAT_INTERVAL", 45))
 WORKER_API_TIMEOUT = int(os.getenv("FASTCHAT_WORKER_API_TIMEOUT", 100))
+# The maximum number of concurrent requests a controller sends when it polls workers
+CONTROLLER_FANOUT_CONCURRENCY = int(
+    os.getenv("FASTCHAT_CONTROLLER_FANOUT_CONCURRENCY", 64)
+)
+# Smoothing factor of the TTFT and tokens/sec averages used by latency_ewma dispatch
+LATENCY_EWMA_ALPHA = float(os.getenv("FASTCHAT_LATENCY_EWMA_ALPHA", 0.3))
+# The completion length latency_ewma dispatch assumes when it estimates latency
+LATENCY_EWMA_EXPECTED_TOKENS = int(
+    os.getenv("FASTCHAT_LATENCY_EWMA_EXPECTED_TOKENS", 256)
+)
 WORKER_API_EMBEDDING_BATCH_SIZE = int(
     os.getenv("FASTCHAT_WORKER_API_EMBEDDING_BATCH_SIZE", 4)
 )
@@ -360,11 +360,30 @@ class Conversation:
         self.messages[-1][1] = message
 
     def to_gradio_chatbot(self):
-        """Convert the conversation to gradio chatbot format."""
+        """Convert the conversation to gradio chatbot format.
+
+        The rows of the turns before the last one are cached, so streaming an
+        answer only rebuilds the last row.
+        """
+        messages = self.messages[self.offset :]
+        num_cached = (len(messages) - 1) // 2 * 2
+        cache = getattr(self, "_gradio_chatbot_cache", None)
+        if (
+            cache is None
+            or cache[0] != self.offset
+            or len(cache[1]) != num_cached
+            or any(msg is not x for (_, msg), x in zip(messages, cache[1]))
+        ):
+            rows = self._to_gradio_chatbot_rows(messages[:num_cached])
+            cache = (self.offset, [msg for _, msg in messages[:num_cached]], rows)
+            self._gradio_chatbot_cache = cache
+        return cache[2] + self._to_gradio_chatbot_rows(messages[num_cached:])
+
+    def _to_gradio_chatbot_rows(self, messages):
         from fastchat.serve.vision.image import ImageFormat
 
         ret = []
-        for i, (role, msg) in enumerate(self.messages[self.offset :]):
+        for i, (role, msg) in enumerate(messages):
             if i % 2 == 0:
                 if type(msg) is tuple:
                     msg, images = msg
@@ -16,6 +16,8 @@ import bs4
 import markdownify  # == 0.11.6
 from tqdm import tqdm
 
+from fastchat.data.keyword_matcher import KeywordMatcher
+
 
 div_pattern = re.compile("<div.*?>")
 span_pattern = re.compile("<span.*?>")
@@ -26,6 +28,7 @@ code_lang_format = "```\g<1>\n\g<2>\n```"
 regenerate_pattern = re.compile("\d+ / \d+")
 copy_chars_pattern = re.compile("Copy\d+ chars / \d+ words")
 copy_code_pattern = re.compile("```(.*?)Copy code\s*```")
+blocked_words_matcher = KeywordMatcher({"blocked": ["openai", "chatgpt"]})
 
 
 def reformat_code(val: str) -> str:
@@ -64,11 +67,7 @@ def html_to_markdown(val: str) -> str:
 
 
 def contain_blocked_words(val: str) -> bool:
-    blocked_words = ["openai", "chatgpt"]
-    for w in blocked_words:
-        if w in val.lower():
-            return True
-    return False
+    return blocked_words_matcher.contains(val, "blocked")
 
 
 def contain_blocked_responses(role: str, val: str) -> bool:
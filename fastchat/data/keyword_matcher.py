@@ -0,0 +1,78 @@
+"""
+Find the keywords of several categories in a text with one scan.
+
+The data cleaning scripts check conversations against lists of keywords
+(identity words, error messages, blocked words). KeywordMatcher compiles all
+lists into one Aho-Corasick automaton, so a text is scanned once regardless of
+the number of keywords. Without pyahocorasick it falls back to one substring
+search per keyword. Both count overlapping occurrences.
+
+Requirement:
+pip install "fschat[data]"
+"""
+from typing import Dict, List
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+
+def _count_overlapping(text: str, word: str) -> int:
+    """Count the occurrences of word in text like the automaton, overlaps included."""
+    num, pos = 0, text.find(word)
+    while pos != -1:
+        num += 1
+        pos = text.find(word, pos + 1)
+    return num
+
+
+class KeywordMatcher:
+    def __init__(self, categories: Dict[str, List[str]], ignore_case: bool = True):
+        """categories maps a category name to its keywords."""
+        self.ignore_case = ignore_case
+        self.categories = {
+            name: [w.lower() for w in words] if ignore_case else list(words)
+            for name, words in categories.items()
+        }
+
+        self.automaton = None
+        if ahocorasick is not None:
+            # A keyword may belong to several categories
+            matches = {}
+            for name, words in self.categories.items():
+                for i, w in enumerate(words):
+                    matches.setdefault(w, []).append((name, i))
+            self.automaton = ahocorasick.Automaton()
+            for w, value in matches.items():
+                self.automaton.add_word(w, value)
+            self.automaton.make_automaton()
+
+    def count(self, text: str) -> Dict[str, Dict[str, int]]:
+        """
+        Return {category: {keyword: number of occurrences}} for the keywords in text.
+
+        Every category is in the result. The keywords of a category are in the
+        order of its list, so the first one is the first listed keyword found.
+        """
+        if self.ignore_case:
+            text = text.lower()
+
+        if self.automaton is None or len(self.automaton) == 0:
+            return {
+                name: {w: _count_overlapping(text, w) for w in words if w and w in text}
+                for name, words in self.categories.items()
+            }
+
+        counts = {name: {} for name in self.categories}
+        for _, value in self.automaton.iter(text):
+            for name, i in value:
+                counts[name][i] = counts[name].get(i, 0) + 1
+        words = self.categories
+        return {
+            name: {words[name][i]: found[i] for i in sorted(found)}
+            for name, found in counts.items()
+        }
+
+    def contains(self, text: str, category: str) -> bool:
+        return len(self.count(text)[category]) > 0
@@ -0,0 +1,145 @@
+"""
+Shared clients for the API providers.
+
+Creating an SDK client sets up a new HTTP connection pool, so building one per
+message pays the TCP and TLS handshakes on every call. get_api_client keeps one
+client per (provider, api_base, api_key, options) and get_http_session one
+requests session for the providers called over plain HTTP, so calls reuse
+kept-alive connections. Async clients are kept per event loop because their
+connections belong to the loop that opened them.
+"""
+import asyncio
+import threading
+import weakref
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Connections kept alive per host
+POOL_MAXSIZE = 100
+
+
+def _openai(api_base, api_key, **kwargs):
+    import openai
+
+    return openai.OpenAI(base_url=api_base, api_key=api_key, **kwargs)
+
+
+def _openai_async(api_base, api_key, **kwargs):
+    import openai
+
+    return openai.AsyncOpenAI(base_url=api_base, api_key=api_key, **kwargs)
+
+
+def _azure_openai(api_base, api_key, **kwargs):
+    import openai
+
+    return openai.AzureOpenAI(azure_endpoint=api_base, api_key=api_key, **kwargs)
+
+
+def _azure_openai_async(api_base, api_key, **kwargs):
+    import openai
+
+    return openai.AsyncAzureOpenAI(azure_endpoint=api_base, api_key=api_key, **kwargs)
+
+
+def _anthropic(api_base, api_key, **kwargs):
+    import anthropic
+
+    return anthropic.Anthropic(base_url=api_base, api_key=api_key, **kwargs)
+
+
+def _anthropic_async(api_base, api_key, **kwargs):
+    import anthropic
+
+    return anthropic.AsyncAnthropic(base_url=api_base, api_key=api_key, **kwargs)
+
+
+def _anthropic_vertex(api_base, api_key, **kwargs):
+    import anthropic
+
+    return anthropic.AnthropicVertex(base_url=api_base, **kwargs)
+
+
+def _anthropic_vertex_async(api_base, api_key, **kwargs):
+    import anthropic
+
+    return anthropic.AsyncAnthropicVertex(base_url=api_base, **kwargs)
+
+
+def _mistral(api_base, api_key, **kwargs):
+    from mistralai import Mistral
+
+    return Mistral(server_url=api_base, api_key=api_key, **kwargs)
+
+
+def _cohere(api_base, api_key, **kwargs):
+    import cohere
+
+    return cohere.Client(base_url=api_base, api_key=api_key, **kwargs)
+
+
+def _reka(api_base, api_key, **kwargs):
+    from reka.client import Reka
+
+    return Reka(base_url=api_base, api_key=api_key, **kwargs)
+
+
+API_CLIENT_FACTORIES = {
+    "openai": _openai,
+    "openai_async": _openai_async,
+    "azure_openai": _azure_openai,
+    "azure_openai_async": _azure_openai_async,
+    "anthropic": _anthropic,
+    "anthropic_async": _anthropic_async,
+    "anthropic_vertex": _anthropic_vertex,
+    "anthropic_vertex_async": _anthropic_vertex_async,
+    "mistral": _mistral,
+    "cohere": _cohere,
+    "reka": _reka,
+}
+
+_clients = {}
+# event loop -> {key: client}
+_async_clients = weakref.WeakKeyDictionary()
+_http_session = None
+_lock = threading.Lock()
+
+
+def create_api_client(provider, api_base=None, api_key=None, **kwargs):
+    """Create a new client. api_base=None uses the SDK's default endpoint."""
+    return API_CLIENT_FACTORIES[provider](api_base, api_key, **kwargs)
+
+
+def get_api_client(provider, api_base=None, api_key=None, **kwargs):
+    """Return the shared client of the provider with these settings.
+
+    The keyword arguments are passed to the SDK client and must be hashable.
+    Async providers ("*_async") must be called from a running event loop.
+    """
+    if provider.endswith("_async"):
+        loop = asyncio.get_running_loop()
+    key = (provider, api_base, api_key, tuple(sorted(kwargs.items())))
+    with _lock:
+        if provider.endswith("_async"):
+            clients = _async_clients.setdefault(loop, {})
+        else:
+            clients = _clients
+        if key not in clients:
+            clients[key] = create_api_client(provider, api_base, api_key, **kwargs)
+        return clients[key]
+
+
+def get_http_session():
+    """Return the requests session shared by the HTTP providers."""
+    global _http_session
+
+    with _lock:
+        if _http_session is None:
+            _http_session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=POOL_MAXSIZE, pool_maxsize=POOL_MAXSIZE
+            )
+            _http_session.mount("http://", adapter)
+            _http_session.mount("https://", adapter)
+        return _http_session
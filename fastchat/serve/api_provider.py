@@ -1,14 +1,15 @@
 """Call API providers."""
 
+import asyncio
+import inspect
 import json
 import os
 import random
 import re
 from typing import Optional
-import time
-
-import requests
 
+from fastchat.serve.api_clients import get_api_client, get_http_session
+from fastchat.serve.replay_streamer import replay_text, replay_text_async
 from fastchat.utils import build_logger
 
 
@@ -23,13 +24,27 @@ def get_api_provider_stream_iter(
     top_p,
     max_new_tokens,
     state,
+    use_async=False,
 ):
+    """Return the stream iterator of an API model.
+
+    With use_async=True the iterator is an async generator. Providers without
+    an async client are advanced in the default executor of the running loop.
+    """
+    openai_stream_iter = (
+        openai_api_stream_iter_async if use_async else openai_api_stream_iter
+    )
+    anthropic_message_stream_iter = (
+        anthropic_message_api_stream_iter_async
+        if use_async
+        else anthropic_message_api_stream_iter
+    )
     if model_api_dict["api_type"] == "openai":
         if model_api_dict.get("vision-arena", False):
             prompt = conv.to_openai_vision_api_messages()
         else:
             prompt = conv.to_openai_api_messages()
-        stream_iter = openai_api_stream_iter(
+        stream_iter = openai_stream_iter(
             model_api_dict["model_name"],
             prompt,
             temperature,
@@ -40,7 +55,7 @@ def get_api_provider_stream_iter(
         )
     elif model_api_dict["api_type"] == "openai_no_stream":
         prompt = conv.to_openai_api_messages()
-        stream_iter = openai_api_stream_iter(
+        stream_iter = openai_stream_iter(
             model_api_dict["model_name"],
             prompt,
             temperature,
@@ -52,7 +67,7 @@ def get_api_provider_stream_iter(
         )
     elif model_api_dict["api_type"] == "openai_o1":
         prompt = conv.to_openai_api_messages()
-        stream_iter = openai_api_stream_iter(
+        stream_iter = openai_stream_iter(
             model_api_dict["model_name"],
             prompt,
             temperature,
@@ -83,7 +98,7 @@ def get_api_provider_stream_iter(
             prompt = conv.to_anthropic_vision_api_messages()
         else:
             prompt = conv.to_openai_api_messages()
-        stream_iter = anthropic_message_api_stream_iter(
+        stream_iter = anthropic_message_stream_iter(
             model_api_dict["model_name"], prompt, temperature, top_p, max_new_tokens
         )
     elif model_api_dict["api_type"] == "anthropic_message_vertex":
@@ -91,7 +106,7 @@ def get_api_provider_stream_iter(
             prompt = conv.to_anthropic_vision_api_messages()
         else:
             prompt = conv.to_openai_api_messages()
-        stream_iter = anthropic_message_api_stream_iter(
+        stream_iter = anthropic_message_stream_iter(
             model_api_dict["model_name"],
             prompt,
             temperature,
@@ -249,37 +264,12 @@ def get_api_provider_stream_iter(
     else:
         raise NotImplementedError()
 
+    if use_async and not inspect.isasyncgen(stream_iter):
+        stream_iter = iterate_in_executor(stream_iter)
     return stream_iter
 
 
-def openai_api_stream_iter(
-    model_name,
-    messages,
-    temperature,
-    top_p,
-    max_new_tokens,
-    api_base=None,
-    api_key=None,
-    stream=True,
-    is_o1=False,
-):
-    import openai
-
-    api_key = api_key or os.environ["OPENAI_API_KEY"]
-
-    if "azure" in model_name:
-        client = openai.AzureOpenAI(
-            api_version="2023-07-01-preview",
-            azure_endpoint=api_base or "https://api.openai.com/v1",
-            api_key=api_key,
-        )
-    else:
-        client = openai.OpenAI(
-            base_url=api_base or "https://api.openai.com/v1",
-            api_key=api_key,
-            timeout=180,
-        )
-
+def log_api_request(model_name, messages, temperature, top_p, max_new_tokens):
     # Make requests for logging
     text_messages = []
     for message in messages:
@@ -302,14 +292,56 @@ def openai_api_stream_iter(
     }
     logger.info(f"==== request ====\n{gen_params}")
 
-    if stream and not is_o1:
-        res = client.chat.completions.create(
-            model=model_name,
-            messages=messages,
-            temperature=temperature,
-            max_tokens=max_new_tokens,
-            stream=True,
+
+def get_openai_client(model_name, api_base, api_key, use_async=False):
+    suffix = "_async" if use_async else ""
+    if "azure" in model_name:
+        return get_api_client(
+            "azure_openai" + suffix,
+            api_base or "https://api.openai.com/v1",
+            api_key,
+            api_version="2023-07-01-preview",
+        )
+    return get_api_client(
+        "openai" + suffix, api_base or "https://api.openai.com/v1", api_key, timeout=180
+    )
+
+
+def get_openai_create_params(
+    model_name, messages, temperature, max_new_tokens, stream, is_o1
+):
+    if is_o1:
+        return dict(model=model_name, messages=messages, temperature=1.0, stream=False)
+    return dict(
+        model=model_name,
+        messages=messages,
+        temperature=temperature,
+        max_tokens=max_new_tokens,
+        stream=stream,
+    )
+
+
+def openai_api_stream_iter(
+    model_name,
+    messages,
+    temperature,
+    top_p,
+    max_new_tokens,
+    api_base=None,
+    api_key=None,
+    stream=True,
+    is_o1=False,
+):
+    api_key = api_key or os.environ["OPENAI_API_KEY"]
+    client = get_openai_client(model_name, api_base, api_key)
+    log_api_request(model_name, messages, temperature, top_p, max_new_tokens)
+
+    res = client.chat.completions.create(
+        **get_openai_create_params(
+            model_name, messages, temperature, max_new_tokens, stream, is_o1
         )
+    )
+    if stream and not is_o1:
         text = ""
         for chunk in res:
             if len(chunk.choices) > 0:
@@ -320,31 +352,38 @@ def openai_api_stream_iter(
                 }
                 yield data
     else:
-        if is_o1:
-            res = client.chat.completions.create(
-                model=model_name,
-                messages=messages,
-                temperature=1.0,
-                stream=False,
-            )
-        else:
-            res = client.chat.completions.create(
-                model=model_name,
-                messages=messages,
-                temperature=temperature,
-                max_tokens=max_new_tokens,
-                stream=False,
-            )
-        text = res.choices[0].message.content
-        pos = 0
-        while pos < len(text):
-            # simulate token streaming
-            pos += 2
-            time.sleep(0.001)
-            data = {
-                "text": text[:pos],
-                "error_code": 0,
-            }
+        yield from replay_text(res.choices[0].message.content)
+
+
+async def openai_api_stream_iter_async(
+    model_name,
+    messages,
+    temperature,
+    top_p,
+    max_new_tokens,
+    api_base=None,
+    api_key=None,
+    stream=True,
+    is_o1=False,
+):
+    """The async version of openai_api_stream_iter."""
+    api_key = api_key or os.environ["OPENAI_API_KEY"]
+    client = get_openai_client(model_name, api_base, api_key, use_async=True)
+    log_api_request(model_name, messages, temperature, top_p, max_new_tokens)
+
+    res = await client.chat.completions.create(
+        **get_openai_create_params(
+            model_name, messages, temperature, max_new_tokens, stream, is_o1
+        )
+    )
+    if stream and not is_o1:
+        text = ""
+        async for chunk in res:
+            if len(chunk.choices) > 0:
+                text += chunk.choices[0].delta.content or ""
+                yield {"text": text, "error_code": 0}
+    else:
+        async for data in replay_text_async(res.choices[0].message.content):
             yield data
 
 
@@ -382,7 +421,7 @@ def column_api_stream_iter(
         # try 3 times
         for i in range(3):
             try:
-                response = requests.post(
+                response = get_http_session().post(
                     api_base, json=gen_params, stream=True, timeout=30
                 )
                 break
@@ -433,11 +472,10 @@ def openai_assistant_api_stream_iter(
     assistant_id,
     api_key=None,
 ):
-    import openai
     import base64
 
     api_key = api_key or os.environ["OPENAI_API_KEY"]
-    client = openai.OpenAI(base_url="https://api.openai.com/v1", api_key=api_key)
+    client = get_api_client("openai", "https://api.openai.com/v1", api_key)
 
     if state.oai_thread_id is None:
         logger.info("==== create thread ====")
@@ -460,7 +498,7 @@ def openai_assistant_api_stream_iter(
     }
     logger.info(f"==== request ====\n{gen_params}")
 
-    res = requests.post(
+    res = get_http_session().post(
         f"https://api.openai.com/v1/threads/{state.oai_thread_id}/runs",
         headers={
             "Authorization": f"Bearer {api_key}",
@@ -570,7 +608,7 @@ def openai_assistant_api_stream_iter(
 def anthropic_api_stream_iter(model_name, prompt, temperature, top_p, max_new_tokens):
     import anthropic
 
-    c = anthropic.Anthropic(api_key=os.environ["ANTHROPIC_API_KEY"])
+    c = get_api_client("anthropic", api_key=os.environ["ANTHROPIC_API_KEY"])
 
     # Make requests
     gen_params = {
@@ -601,50 +639,22 @@ def anthropic_api_stream_iter(model_name, prompt, temperature, top_p, max_new_to
         yield data
 
 
-def anthropic_message_api_stream_iter(
-    model_name,
-    messages,
-    temperature,
-    top_p,
-    max_new_tokens,
-    vertex_ai=False,
-):
-    import anthropic
-
+def get_anthropic_message_client(vertex_ai=False, use_async=False):
+    suffix = "_async" if use_async else ""
     if vertex_ai:
-        client = anthropic.AnthropicVertex(
+        return get_api_client(
+            "anthropic_vertex" + suffix,
             region=os.environ["GCP_LOCATION"],
             project_id=os.environ["GCP_PROJECT_ID"],
             max_retries=5,
         )
-    else:
-        client = anthropic.Anthropic(
-            api_key=os.environ["ANTHROPIC_API_KEY"],
-            max_retries=5,
-        )
+    return get_api_client(
+        "anthropic" + suffix, api_key=os.environ["ANTHROPIC_API_KEY"], max_retries=5
+    )
 
-    text_messages = []
-    for message in messages:
-        if type(message["content"]) == str:  # text-only model
-            text_messages.append(message)
-        else:  # vision model
-            filtered_content_list = [
-                content for content in message["content"] if content["type"] == "text"
-            ]
-            text_messages.append(
-                {"role": message["role"], "content": filtered_content_list}
-            )
-
-    # Make requests for logging
-    gen_params = {
-        "model": model_name,
-        "prompt": text_messages,
-        "temperature": temperature,
-        "top_p": top_p,
-        "max_new_tokens": max_new_tokens,
-    }
-    logger.info(f"==== request ====\n{gen_params}")
 
+def get_anthropic_system_prompt(messages):
+    """Split the system prompt from the messages."""
     system_prompt = ""
     if messages[0]["role"] == "system":
         if type(messages[0]["content"]) == dict:
@@ -653,6 +663,20 @@ def anthropic_message_api_stream_iter(
             system_prompt = messages[0]["content"]
         # remove system prompt
         messages = messages[1:]
+    return system_prompt, messages
+
+
+def anthropic_message_api_stream_iter(
+    model_name,
+    messages,
+    temperature,
+    top_p,
+    max_new_tokens,
+    vertex_ai=False,
+):
+    client = get_anthropic_message_client(vertex_ai)
+    log_api_request(model_name, messages, temperature, top_p, max_new_tokens)
+    system_prompt, messages = get_anthropic_system_prompt(messages)
 
     text = ""
     with client.messages.stream(
@@ -672,6 +696,44 @@ def anthropic_message_api_stream_iter(
             yield data
 
 
+async def anthropic_message_api_stream_iter_async(
+    model_name,
+    messages,
+    temperature,
+    top_p,
+    max_new_tokens,
+    vertex_ai=False,
+):
+    """The async version of anthropic_message_api_stream_iter."""
+    client = get_anthropic_message_client(vertex_ai, use_async=True)
+    log_api_request(model_name, messages, temperature, top_p, max_new_tokens)
+    system_prompt, messages = get_anthropic_system_prompt(messages)
+
+    text = ""
+    async with client.messages.stream(
+        temperature=temperature,
+        top_p=top_p,
+        max_tokens=max_new_tokens,
+        messages=messages,
+        model=model_name,
+        system=system_prompt,
+    ) as stream:
+        async for chunk in stream.text_stream:
+            text += chunk
+            yield {"text": text, "error_code": 0}
+
+
+async def iterate_in_executor(stream_iter):
+    """Advance a stream iterator in the default executor of the running loop."""
+    loop = asyncio.get_running_loop()
+    done = object()
+    while True:
+        data = await loop.run_in_executor(None, next, stream_iter, done)
+        if data is done:
+            return
+        yield data
+
+
 def gemini_api_stream_iter(
     model_name,
     messages,
@@ -743,17 +805,7 @@ def gemini_api_stream_iter(
     else:
         try:
             response = convo.send_message(messages[-1]["content"], stream=False)
-            text = response.candidates[0].content.parts[0].text
-            pos = 0
-            while pos < len(text):
-                # simulate token streaming
-                pos += 5
-                time.sleep(0.001)
-                data = {
-                    "text": text[:pos],
-                    "error_code": 0,
-                }
-                yield data
+            yield from replay_text(response.candidates[0].content.parts[0].text)
         except Exception as e:
             logger.error(f"==== error ====\n{e}")
             yield {
@@ -791,7 +843,7 @@ def ai2_api_stream_iter(
     if temperature == 0.0 and top_p < 1.0:
         raise ValueError("top_p must be 1 when temperature is 0.0")
 
-    res = requests.post(
+    res = get_http_session().post(
         api_base,
         stream=True,
         headers={"Authorization": f"Bearer {ai2_key}"},
@@ -840,12 +892,11 @@ def mistral_api_stream_iter(
 ):
     # from mistralai.client import MistralClient
     # from mistralai.models.chat_completion import ChatMessage
-    from mistralai import Mistral
 
     if api_key is None:
         api_key = os.environ["MISTRAL_API_KEY"]
 
-    client = Mistral(api_key=api_key)
+    client = get_api_client("mistral", api_key=api_key)
 
     # Make requests for logging
     text_messages = []
@@ -928,7 +979,7 @@ def nvidia_api_stream_iter(
     # try 3 times
     for i in range(3):
         try:
-            response = requests.post(
+            response = get_http_session().post(
                 api_base, headers=headers, json=payload, stream=True, timeout=3
             )
             break
@@ -973,7 +1024,7 @@ def yandexgpt_api_stream_iter(
     logger.info(f"==== request ====\n{payload}")
 
     # https://llm.api.cloud.yandex.net/foundationModels/v1/completion
-    response = requests.post(
+    response = get_http_session().post(
         api_base, headers=headers, json=payload, stream=True, timeout=60
     )
     text = ""
@@ -1013,11 +1064,7 @@ def cohere_api_stream_iter(
         "system": "System",
     }
 
-    client = cohere.Client(
-        api_key=api_key,
-        base_url=api_base,
-        client_name=client_name,
-    )
+    client = get_api_client("cohere", api_base, api_key, client_name=client_name)
 
     # prepare and log requests
     chat_history = [
@@ -1139,12 +1186,11 @@ def reka_api_stream_iter(
     api_key: Optional[str] = None,  # default is env var CO_API_KEY
     api_base: Optional[str] = None,
 ):
-    from reka.client import Reka
     from reka import TypedText
 
     api_key = api_key or os.environ["REKA_API_KEY"]
 
-    client = Reka(api_key=api_key)
+    client = get_api_client("reka", api_key=api_key)
 
     use_search_engine = False
     if "-online" in model_name:
@@ -1221,7 +1267,7 @@ def metagen_api_stream_iter(
         }
         logger.info(f"==== request ====\n{gen_params}")
 
-        res = requests.post(
+        res = get_http_session().post(
             f"{api_base}/chat_stream_completions?access_token={api_key}",
             stream=True,
             headers={"Content-Type": "application/json"},
@@ -1,4 +1,5 @@
 import asyncio
+import json
 import threading
 import time
 from typing import List
@@ -6,8 +7,9 @@ from typing import List
 from fastapi import FastAPI, Request, BackgroundTasks
 from fastapi.responses import StreamingResponse, JSONResponse
 import requests
+from starlette.concurrency import iterate_in_threadpool
 
-from fastchat.constants import WORKER_HEART_BEAT_INTERVAL
+from fastchat.constants import LATENCY_EWMA_ALPHA, WORKER_HEART_BEAT_INTERVAL
 from fastchat.conversation import Conversation
 from fastchat.utils import pretty_print_semaphore, build_logger
 
@@ -52,6 +54,12 @@ class BaseModelWorker:
         self.context_len = None
         self.call_ct = 0
         self.semaphore = None
+        # Moving averages of streaming latency, reported for latency_ewma dispatch
+        self.ttft = None
+        self.tokens_per_second = None
+        # Requests stopped early because their client disconnected
+        self.num_cancelled = 0
+        self.num_cancelled_tokens = 0
 
         self.heart_beat_thread = None
 
@@ -116,6 +124,8 @@ class BaseModelWorker:
                     json={
                         "worker_name": self.worker_addr,
                         "queue_length": self.get_queue_length(),
+                        "ttft": self.ttft,
+                        "tokens_per_second": self.tokens_per_second,
                     },
                     timeout=5,
                 )
@@ -147,8 +157,64 @@ class BaseModelWorker:
             "model_names": self.model_names,
             "speed": 1,
             "queue_length": self.get_queue_length(),
+            "ttft": self.ttft,
+            "tokens_per_second": self.tokens_per_second,
+            "num_cancelled": self.num_cancelled,
+            "num_cancelled_tokens": self.num_cancelled_tokens,
         }
 
+    def record_cancellation(self, generated_tokens: int):
+        """Count a request whose client disconnected before it finished.
+
+        generated_tokens is the number of tokens the request had generated when
+        it was stopped.
+        """
+        self.num_cancelled += 1
+        self.num_cancelled_tokens += generated_tokens
+
+    def record_latency(self, ttft: float, tokens_per_second: float = None):
+        if self.ttft is None:
+            self.ttft = ttft
+        else:
+            self.ttft += LATENCY_EWMA_ALPHA * (ttft - self.ttft)
+        if tokens_per_second is None:
+            return
+        if self.tokens_per_second is None:
+            self.tokens_per_second = tokens_per_second
+        else:
+            self.tokens_per_second += LATENCY_EWMA_ALPHA * (
+                tokens_per_second - self.tokens_per_second
+            )
+
+    def track_latency(self, generator):
+        """Wrap a stream of generate_stream_gate chunks to record its latency."""
+        start = time.time()
+        first_token_time = None
+        chunk = None
+        try:
+            for chunk in generator:
+                if first_token_time is None:
+                    first_token_time = time.time()
+                yield chunk
+        finally:
+            # Stop decoding now when the stream is closed early
+            generator.close()
+        if first_token_time is None:
+            return
+
+        try:
+            ret = json.loads(chunk.rstrip(b"\0"))
+        except ValueError:
+            return
+        if ret.get("error_code", 0) != 0:
+            return
+        tokens_per_second = None
+        completion_tokens = ret.get("usage", {}).get("completion_tokens", 0)
+        decode_time = time.time() - first_token_time
+        if completion_tokens > 1 and decode_time > 0:
+            tokens_per_second = (completion_tokens - 1) / decode_time
+        self.record_latency(first_token_time - start, tokens_per_second)
+
     def count_token(self, params):
         prompt = params["prompt"]
 
@@ -164,9 +230,27 @@ class BaseModelWorker:
         }
         return ret
 
+    def count_token_batch(self, params):
+        prompts = params["prompts"]
+
+        try:
+            # Fast tokenizers encode a list of texts in one parallel call.
+            counts = [len(input_ids) for input_ids in self.tokenizer(prompts).input_ids]
+        except TypeError:
+            counts = [self.tokenizer.num_tokens(prompt) for prompt in prompts]
+
+        ret = {
+            "counts": counts,
+            "error_code": 0,
+        }
+        return ret
+
     def get_conv_template(self):
         return {"conv": self.conv}
 
+    def get_model_details(self):
+        return {"context_length": self.context_len}
+
     def generate_stream_gate(self, params):
         raise NotImplementedError
 
@@ -193,13 +277,31 @@ def create_background_tasks():
     return background_tasks
 
 
+async def stream_until_disconnect(generator, release):
+    """Stream a generator of chunks and stop it when the client disconnects.
+
+    Starlette cancels the response stream when the client goes away. The
+    generator is then closed right away, which stops its decode loop, and
+    `release` is called however the stream ends.
+    """
+    try:
+        # A cancelled step still runs to completion in its thread, so the
+        # generator is never closed while it is executing.
+        async for chunk in iterate_in_threadpool(generator):
+            yield chunk
+    finally:
+        generator.close()
+        release()
+
+
 @app.post("/worker_generate_stream")
 async def api_generate_stream(request: Request):
     params = await request.json()
     await acquire_worker_semaphore()
-    generator = worker.generate_stream_gate(params)
-    background_tasks = create_background_tasks()
-    return StreamingResponse(generator, background=background_tasks)
+    generator = worker.track_latency(worker.generate_stream_gate(params))
+    return StreamingResponse(
+        stream_until_disconnect(generator, release_worker_semaphore)
+    )
 
 
 @app.post("/worker_generate")
@@ -231,6 +333,12 @@ async def api_count_token(request: Request):
     return worker.count_token(params)
 
 
+@app.post("/count_token_batch")
+async def api_count_token_batch(request: Request):
+    params = await request.json()
+    return worker.count_token_batch(params)
+
+
 @app.post("/worker_get_conv_template")
 async def api_get_conv(request: Request):
     return worker.get_conv_template()
@@ -238,4 +346,4 @@ async def api_get_conv(request: Request):
 
 @app.post("/model_details")
 async def api_model_details(request: Request):
-    return {"context_length": worker.context_len}
+    return worker.get_model_details()
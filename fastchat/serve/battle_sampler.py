@@ -0,0 +1,196 @@
+"""
+Sample the model pairs of anonymous battles.
+
+The first model is drawn in proportion to its sampling weight (boosted for
+the boost models) and its rival in proportion to the rival weights, which
+skip the model itself, pairs of two anonymous models and pairs that violate
+the strict targets, and give the battle targets of the first model half of
+the total weight. These distributions only depend on the sampling config, so
+BattlePairSampler precomputes them once as alias tables (Vose's method) and
+draws each pair in constant time. get_battle_pair_sampler keeps the samplers
+by the content of their config and builds a new one only when it changes.
+"""
+import re
+
+import numpy as np
+
+
+def get_sample_weight(model, outage_models, sampling_weights, sampling_boost_models=[]):
+    if model in outage_models:
+        return 0
+    weight = sampling_weights.get(model, 0)
+    if model in sampling_boost_models:
+        weight *= 5
+    return weight
+
+
+def compile_model_patterns(patterns):
+    """Compile the patterns of is_model_match_pattern, where * matches anything."""
+    return [re.compile(pattern.replace("*", ".*")) for pattern in patterns]
+
+
+def is_model_match_pattern(model, compiled_patterns):
+    return any(pattern.match(model) is not None for pattern in compiled_patterns)
+
+
+def build_alias_table(weights):
+    """Build the (prob, alias) table of Vose's alias method.
+
+    Index i is drawn with probability weights[i] / sum(weights). Returns None
+    if the weights do not sum to a positive number.
+    """
+    n = len(weights)
+    total = float(np.sum(weights))
+    if n == 0 or not total > 0:
+        return None
+    scaled = [w * n / total for w in weights]
+    prob = [1.0] * n
+    alias = list(range(n))
+    small = [i for i, p in enumerate(scaled) if p < 1]
+    large = [i for i, p in enumerate(scaled) if p >= 1]
+    while small and large:
+        i, j = small.pop(), large.pop()
+        prob[i] = scaled[i]
+        alias[i] = j
+        scaled[j] -= 1 - scaled[i]
+        if scaled[j] < 1:
+            small.append(j)
+        else:
+            large.append(j)
+    # The rest are 1 up to rounding errors
+    return prob, alias
+
+
+def sample_alias_table(table):
+    """Draw an index from a table of build_alias_table."""
+    prob, alias = table
+    x = np.random.random() * len(prob)
+    i = int(x)
+    return i if x - i < prob[i] else alias[i]
+
+
+class BattlePairSampler:
+    """Draw battle pairs in constant time from precomputed alias tables."""
+
+    def __init__(
+        self,
+        models,
+        battle_targets,
+        outage_models,
+        sampling_weights,
+        sampling_boost_models,
+        strict_targets={},
+        anon_models=[],
+    ):
+        self.models = list(models)
+        model_weights = [
+            get_sample_weight(
+                model, outage_models, sampling_weights, sampling_boost_models
+            )
+            for model in self.models
+        ]
+        total_weight = np.sum(model_weights)
+        self.model_table = build_alias_table(model_weights)
+
+        strict_patterns = {
+            model: compile_model_patterns(patterns)
+            for model, patterns in strict_targets.items()
+        }
+
+        # The rival table of each model that can be chosen
+        self.rival_tables = {}
+        for chosen_model, chosen_weight in zip(self.models, model_weights):
+            if chosen_weight == 0 or chosen_model in self.rival_tables:
+                continue
+            rival_models = []
+            rival_weights = []
+            for model in self.models:
+                if model == chosen_model:
+                    continue
+                if model in anon_models and chosen_model in anon_models:
+                    continue
+                if chosen_model in strict_patterns:
+                    if not is_model_match_pattern(model, strict_patterns[chosen_model]):
+                        continue
+                if model in strict_patterns:
+                    if not is_model_match_pattern(chosen_model, strict_patterns[model]):
+                        continue
+                weight = get_sample_weight(model, outage_models, sampling_weights)
+                if (
+                    weight != 0
+                    and chosen_model in battle_targets
+                    and model in battle_targets[chosen_model]
+                ):
+                    # boost to 20% chance
+                    weight = 0.5 * total_weight / len(battle_targets[chosen_model])
+                rival_models.append(model)
+                rival_weights.append(weight)
+            self.rival_tables[chosen_model] = (
+                rival_models,
+                build_alias_table(rival_weights),
+            )
+
+    def sample(self):
+        """Return a (left, right) pair of model names."""
+        if len(self.models) == 1:
+            return self.models[0], self.models[0]
+        if self.model_table is None:
+            raise ValueError("No model has a positive sampling weight")
+        chosen_model = self.models[sample_alias_table(self.model_table)]
+
+        rival_models, rival_table = self.rival_tables[chosen_model]
+        if rival_table is None:
+            raise ValueError(f"No rival has a positive sampling weight: {chosen_model}")
+        rival_model = rival_models[sample_alias_table(rival_table)]
+
+        swap = np.random.randint(2)
+        if swap == 0:
+            return chosen_model, rival_model
+        else:
+            return rival_model, chosen_model
+
+
+MAX_CACHED_SAMPLERS = 8
+MAX_CACHED_CONFIGS = 64
+# The samplers by the content of their config
+_samplers = {}
+# (config, sampler) by the identity of the config objects
+_samplers_by_id = {}
+
+
+def freeze_config(value):
+    """Return a hashable copy of a config object made of lists, sets and dicts."""
+    if isinstance(value, dict):
+        return frozenset((k, freeze_config(v)) for k, v in value.items())
+    if isinstance(value, (set, frozenset)):
+        return frozenset(value)
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze_config(v) for v in value)
+    return value
+
+
+def get_battle_pair_sampler(*config):
+    """Return the BattlePairSampler of config, building it if the config changed.
+
+    The config is the arguments of BattlePairSampler. A lookup with the same
+    config objects as before costs the same for any number of models. New
+    objects, e.g. the model list that is reloaded on every page load, are
+    compared by content, so the sampler is only rebuilt when the content
+    changes. Updates in place of an object seen before are not noticed.
+    """
+    id_key = tuple(map(id, config))
+    entry = _samplers_by_id.get(id_key)
+    if entry is not None:
+        return entry[1]
+
+    key = freeze_config(config)
+    sampler = _samplers.get(key)
+    if sampler is None:
+        if len(_samplers) >= MAX_CACHED_SAMPLERS:
+            _samplers.clear()
+        sampler = _samplers[key] = BattlePairSampler(*config)
+    if len(_samplers_by_id) >= MAX_CACHED_CONFIGS:
+        _samplers_by_id.clear()
+    # Keep the config alive so that its ids are not reused by other objects
+    _samplers_by_id[id_key] = (config, sampler)
+    return sampler
@@ -7,62 +7,147 @@ from fastapi import FastAPI
 import hashlib
 import asyncio
 
-REFRESH_INTERVAL_SEC = 300
+REFRESH_INTERVAL_SEC = 10
+PRUNE_INTERVAL_SEC = 3600
 LOG_DIR_LIST = []
 # LOG_DIR = "/home/vicuna/tmp/test_env"
 
 
+class SlidingWindowCounter:
+    """Count events per key over a sliding window of fixed-size time buckets.
+
+    Each key keeps a ring of bucket counts and their running total, so adding
+    an event and reading the count of the whole window take amortized O(1)
+    time, and memory is bounded by the number of keys active in the window.
+    """
+
+    def __init__(self, window_sec: int, num_buckets: int):
+        self.bucket_sec = window_sec / num_buckets
+        self.num_buckets = num_buckets
+        # key -> [bucket counts, total, last bucket]
+        self.rings = {}
+
+    def _advance(self, ring, bucket):
+        counts, total, last_bucket = ring
+        if bucket - last_bucket >= self.num_buckets:
+            counts[:] = [0] * self.num_buckets
+            total = 0
+        else:
+            # Expire the buckets that left the window since the last update
+            for b in range(last_bucket + 1, bucket + 1):
+                total -= counts[b % self.num_buckets]
+                counts[b % self.num_buckets] = 0
+        if bucket > last_bucket:
+            ring[1], ring[2] = total, bucket
+
+    def add(self, key, tstamp: float, now: float = None) -> None:
+        now = time.time() if now is None else now
+        bucket = int(tstamp // self.bucket_sec)
+        cur_bucket = int(now // self.bucket_sec)
+        if not cur_bucket - self.num_buckets < bucket <= cur_bucket:
+            return
+        if key not in self.rings:
+            self.rings[key] = [[0] * self.num_buckets, 0, cur_bucket]
+        ring = self.rings[key]
+        self._advance(ring, cur_bucket)
+        ring[0][bucket % self.num_buckets] += 1
+        ring[1] += 1
+
+    def count(self, key, window_sec: float = None, now: float = None) -> int:
+        if key not in self.rings:
+            return 0
+        now = time.time() if now is None else now
+        cur_bucket = int(now // self.bucket_sec)
+        ring = self.rings[key]
+        self._advance(ring, cur_bucket)
+        num_buckets = self.num_buckets
+        if window_sec is not None:
+            num_buckets = max(1, -int(-window_sec // self.bucket_sec))
+        if num_buckets >= self.num_buckets:
+            return ring[1]
+        return sum(
+            ring[0][b % self.num_buckets]
+            for b in range(cur_bucket - num_buckets + 1, cur_bucket + 1)
+        )
+
+    def counts(self, window_sec: float = None, now: float = None) -> dict:
+        """Return the nonzero counts of all keys."""
+        now = time.time() if now is None else now
+        counts = {}
+        for key in list(self.rings):
+            n = self.count(key, window_sec, now)
+            if n > 0:
+                counts[key] = n
+        return counts
+
+    def prune(self, now: float = None) -> None:
+        """Drop the keys without events in the window."""
+        now = time.time() if now is None else now
+        for key in list(self.rings):
+            if self.count(key, now=now) == 0:
+                del self.rings[key]
+
+
 class Monitor:
     """Monitor the number of calls to each model."""
 
     def __init__(self, log_dir_list: list):
         self.log_dir_list = log_dir_list
-        self.model_call = {}
-        self.user_call = {}
+        # model -> calls in the last hour
+        self.model_call = SlidingWindowCounter(3600, 60)
+        # (user_id, model) -> calls in the last hour and in the last day
+        self.user_call_hour = SlidingWindowCounter(3600, 60)
+        self.user_call_day = SlidingWindowCounter(24 * 3600, 96)
+        # log file -> offset of the first unread line
+        self.log_offsets = {}
         self.model_call_limit_global = {}
         self.model_call_day_limit_per_user = {}
 
+    def record_call(self, model: str, user_id: str, tstamp: float) -> None:
+        self.model_call.add(model, tstamp)
+        self.user_call_hour.add((user_id, model), tstamp)
+        self.user_call_day.add((user_id, model), tstamp)
+
+    def read_new_calls(self, json_file: str) -> None:
+        offset = self.log_offsets.get(json_file, 0)
+        if os.path.getsize(json_file) < offset:  # The file was truncated
+            offset = 0
+        with open(json_file, "rb") as fin:
+            fin.seek(offset)
+            data = fin.read()
+        # Leave a partially written last line for the next update
+        end = data.rfind(b"\n") + 1
+        self.log_offsets[json_file] = offset + end
+        for line in data[:end].splitlines():
+            try:
+                obj = json.loads(line)
+            except json.JSONDecodeError:
+                print(f"Error decoding json: {json_file} {line}")
+                continue
+            if obj["type"] != "chat":
+                continue
+            self.record_call(obj["model"], obj["ip"], obj["tstamp"])
+
     async def update_stats(self, num_file=1) -> None:
+        last_prune = time.time()
         while True:
-            # find the latest num_file log under log_dir
+            # tail the latest num_file logs under log_dir
             json_files = []
             for log_dir in self.log_dir_list:
                 json_files_per_server = glob.glob(os.path.join(log_dir, "*.json"))
                 json_files_per_server.sort(key=os.path.getctime, reverse=True)
                 json_files += json_files_per_server[:num_file]
-            model_call = {}
-            user_call = {}
             for json_file in json_files:
-                for line in open(json_file, "r", encoding="utf-8"):
-                    try:
-                        obj = json.loads(line)
-                    except json.JSONDecodeError:
-                        print(f"Error decoding json: {json_file} {line}")
-                        continue
-                    if obj["type"] != "chat":
-                        continue
-                    if obj["model"] not in model_call:
-                        model_call[obj["model"]] = []
-                    model_call[obj["model"]].append(
-                        {"tstamp": obj["tstamp"], "user_id": obj["ip"]}
-                    )
-                    if obj["ip"] not in user_call:
-                        user_call[obj["ip"]] = []
-                    user_call[obj["ip"]].append(
-                        {"tstamp": obj["tstamp"], "model": obj["model"]}
-                    )
-
-            self.model_call = model_call
-            self.model_call_stats_hour = self.get_model_call_stats(top_k=None)
-            self.model_call_stats_day = self.get_model_call_stats(
-                top_k=None, most_recent_min=24 * 60
-            )
-
-            self.user_call = user_call
-            self.user_call_stats_hour = self.get_user_call_stats(top_k=None)
-            self.user_call_stats_day = self.get_user_call_stats(
-                top_k=None, most_recent_min=24 * 60
-            )
+                self.read_new_calls(json_file)
+            self.log_offsets = {
+                json_file: self.log_offsets[json_file] for json_file in json_files
+            }
+
+            if time.time() - last_prune > PRUNE_INTERVAL_SEC:
+                self.model_call.prune()
+                self.user_call_hour.prune()
+                self.user_call_day.prune()
+                last_prune = time.time()
             await asyncio.sleep(REFRESH_INTERVAL_SEC)
 
     def get_model_call_limit(self, model: str) -> int:
@@ -79,41 +164,35 @@ class Monitor:
     def is_model_limit_reached(self, model: str) -> bool:
         if model not in self.model_call_limit_global:
             return False
-        if model not in self.model_call_stats_hour:
-            return False
         # check if the model call limit is reached
-        if self.model_call_stats_hour[model] >= self.model_call_limit_global[model]:
-            return True
-        return False
+        return self.model_call.count(model) >= self.model_call_limit_global[model]
 
     def is_user_limit_reached(self, model: str, user_id: str) -> bool:
         if model not in self.model_call_day_limit_per_user:
             return False
-        if user_id not in self.user_call_stats_day:
-            return False
-        if model not in self.user_call_stats_day[user_id]["call_dict"]:
-            return False
         # check if the user call limit is reached
-        if (
-            self.user_call_stats_day[user_id]["call_dict"][model]
+        return (
+            self.user_call_day.count((user_id, model))
             >= self.model_call_day_limit_per_user[model]
-        ):
-            return True
-        return False
+        )
 
     def get_model_call_stats(
         self, target_model=None, most_recent_min: int = 60, top_k: int = 20
     ) -> dict:
-        model_call_stats = {}
-        for model, reqs in self.model_call.items():
-            if target_model is not None and model != target_model:
-                continue
-            model_call = []
-            for req in reqs:
-                if req["tstamp"] < time.time() - most_recent_min * 60:
-                    continue
-                model_call.append(req["tstamp"])
-            model_call_stats[model] = len(model_call)
+        if most_recent_min <= 60:
+            model_call_stats = self.model_call.counts(most_recent_min * 60)
+        else:
+            model_call_stats = {}
+            for (_, model), n in self.user_call_day.counts(
+                most_recent_min * 60
+            ).items():
+                model_call_stats[model] = model_call_stats.get(model, 0) + n
+        if target_model is not None:
+            model_call_stats = {
+                model: n
+                for model, n in model_call_stats.items()
+                if model == target_model
+            }
         if top_k is not None:
             top_k_model = sorted(
                 model_call_stats, key=lambda x: model_call_stats[x], reverse=True
@@ -124,21 +203,15 @@ class Monitor:
     def get_user_call_stats(
         self, target_model=None, most_recent_min: int = 60, top_k: int = 20
     ) -> dict:
+        user_call = self.user_call_hour if most_recent_min <= 60 else self.user_call_day
         user_call_stats = {}
-        for user_id, reqs in self.user_call.items():
-            user_model_call = {"call_dict": {}}
-            for req in reqs:
-                if req["tstamp"] < time.time() - most_recent_min * 60:
-                    continue
-                if target_model is not None and req["model"] != target_model:
-                    continue
-                if req["model"] not in user_model_call["call_dict"]:
-                    user_model_call["call_dict"][req["model"]] = 0
-                user_model_call["call_dict"][req["model"]] += 1
-
-            user_model_call["total_calls"] = sum(user_model_call["call_dict"].values())
-            if user_model_call["total_calls"] > 0:
-                user_call_stats[user_id] = user_model_call
+        for (user_id, model), n in user_call.counts(most_recent_min * 60).items():
+            if target_model is not None and model != target_model:
+                continue
+            if user_id not in user_call_stats:
+                user_call_stats[user_id] = {"call_dict": {}, "total_calls": 0}
+            user_call_stats[user_id]["call_dict"][model] = n
+            user_call_stats[user_id]["total_calls"] += n
         if top_k is not None:
             top_k_user = sorted(
                 user_call_stats,
@@ -151,10 +224,8 @@ class Monitor:
         return user_call_stats
 
     def get_num_users(self, most_recent_min: int = 60) -> int:
-        user_call_stats = self.get_user_call_stats(
-            most_recent_min=most_recent_min, top_k=None
-        )
-        return len(user_call_stats)
+        user_call = self.user_call_hour if most_recent_min <= 60 else self.user_call_day
+        return len({user_id for user_id, _ in user_call.counts(most_recent_min * 60)})
 
 
 monitor = Monitor(log_dir_list=LOG_DIR_LIST)
@@ -195,12 +266,12 @@ async def is_limit_reached(model: str, user_id: str):
 
 @app.get("/get_num_users_hr")
 async def get_num_users():
-    return {"num_users": len(monitor.user_call_stats_hour)}
+    return {"num_users": monitor.get_num_users()}
 
 
 @app.get("/get_num_users_day")
 async def get_num_users_day():
-    return {"num_users": len(monitor.user_call_stats_day)}
+    return {"num_users": monitor.get_num_users(most_recent_min=24 * 60)}
 
 
 @app.get("/get_user_call_stats")
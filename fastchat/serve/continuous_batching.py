@@ -0,0 +1,417 @@
+"""
+Iteration-level (continuous) batching for the native HF model worker.
+
+New requests are prefilled one by one and merged into the running decode
+batch. Every decode step runs a single forward pass over all running sequences
+and finished sequences are retired right away, so a slot can be refilled on the
+next step instead of waiting for the whole batch to finish.
+
+Requests with n > 1 prefill their prompt once and decode the n samples as
+separate rows of the batch.
+
+Closing the stream returned by `generate_stream`, e.g. when the client
+disconnects, cancels the request and its rows leave the batch before the next
+decode step.
+
+Only plain decoder-only models whose KV cache has the standard
+[batch, heads, seq_len, head_dim] layout are supported.
+"""
+import queue
+import threading
+from typing import Dict, Iterable, List, Optional
+
+import torch
+import torch.nn.functional as F
+
+from fastchat.serve.inference import (
+    IncrementalDetokenizer,
+    find_stop_str,
+    prepare_logits_processor,
+)
+from fastchat.serve.prefix_cache import (
+    PrefixCache,
+    from_legacy_cache,
+    get_cache_cls,
+    to_legacy_cache,
+)
+
+
+def _left_pad(past_key_values, attention_mask, length):
+    pad = length - attention_mask.shape[1]
+    if pad == 0:
+        return past_key_values, attention_mask
+    past_key_values = [
+        (F.pad(k, (0, 0, pad, 0)), F.pad(v, (0, 0, pad, 0))) for k, v in past_key_values
+    ]
+    return past_key_values, F.pad(attention_mask, (pad, 0))
+
+
+class _Sequence:
+    """The decoding state of one request inside the running batch."""
+
+    def __init__(
+        self,
+        params: Dict,
+        input_ids: List[int],
+        stop_token_ids: List[int],
+        tokenizer,
+        outputs: queue.Queue,
+        index: Optional[int] = None,
+    ):
+        self.params = params
+        self.input_ids = input_ids
+        self.output_ids = list(input_ids)
+        self.input_echo_len = len(input_ids)
+        self.stop_token_ids = stop_token_ids
+
+        self.temperature = float(params.get("temperature", 1.0))
+        self.repetition_penalty = float(params.get("repetition_penalty", 1.0))
+        self.top_p = float(params.get("top_p", 1.0))
+        self.top_k = int(params.get("top_k", -1))  # -1 means disable
+        self.max_new_tokens = int(params.get("max_new_tokens", 256))
+        self.echo = bool(params.get("echo", True))
+        self.stop_str = params.get("stop", None)
+        self.logits_processor = prepare_logits_processor(
+            self.temperature, self.repetition_penalty, self.top_p, self.top_k
+        )
+
+        if self.echo:
+            self.detokenizer = IncrementalDetokenizer(tokenizer, input_ids)
+            self.rfind_start = len(params["prompt"])
+        else:
+            self.detokenizer = IncrementalDetokenizer(tokenizer)
+            self.rfind_start = 0
+        self.num_detokenized = len(input_ids)
+        self.stop_checked_len = self.rfind_start
+
+        self.step = 0
+        self.output = ""
+        self.finished = False
+        # Set by the consumer thread when the stream is closed early.
+        self.cancelled = False
+        # Shared by all samples of a request, which tag their outputs with index.
+        self.outputs = outputs
+        self.index = index
+
+    def make_output(self, finish_reason: Optional[str]):
+        ret = {
+            "text": self.output,
+            "logprobs": None,
+            "usage": {
+                "prompt_tokens": self.input_echo_len,
+                "completion_tokens": self.step,
+                "total_tokens": self.input_echo_len + self.step,
+            },
+            "finish_reason": finish_reason,
+        }
+        if self.index is not None:
+            ret["index"] = self.index
+        return ret
+
+
+class ContinuousBatchingEngine:
+    """Run many generation requests through one shared decode batch.
+
+    Requests are submitted from the worker's streaming threads through
+    `generate_stream`, which yields the same dicts as
+    `fastchat.serve.inference.generate_stream`. A single background thread owns
+    the model and drives every forward pass.
+    """
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        device: str,
+        context_len: int,
+        stream_interval: int = 2,
+        max_batch_size: int = 32,
+        prefix_cache: Optional[PrefixCache] = None,
+    ):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = model.device if hasattr(model, "device") else device
+        self.context_len = context_len
+        self.stream_interval = stream_interval
+        self.max_batch_size = max_batch_size
+        self.prefix_cache = prefix_cache
+
+        self.waiting = queue.Queue()
+        self.running: List[_Sequence] = []
+        # Batched KV cache, left padded so that all sequences end at the same
+        # position. `attention_mask` marks the real (non padding) entries.
+        self.past_key_values = None
+        self.attention_mask = None
+        self.cache_cls = None
+
+        self.thread = threading.Thread(target=self._run_loop, daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def supports(model, params: Dict) -> bool:
+        """Whether a request can be served by the batching engine.
+
+        Encoder-decoder models and requests asking for logprobs are not
+        supported and go through the regular generate_stream instead.
+        """
+        if model.config.is_encoder_decoder:
+            return False
+        return params.get("logprobs", None) is None
+
+    def get_num_running(self) -> int:
+        return len(self.running)
+
+    def generate_stream(self, params: Dict) -> Iterable[Dict]:
+        stop_token_ids = list(params.get("stop_token_ids", None) or [])
+        if self.tokenizer.eos_token_id not in stop_token_ids:
+            stop_token_ids.append(self.tokenizer.eos_token_id)
+        max_new_tokens = int(params.get("max_new_tokens", 256))
+        max_src_len = self.context_len - max_new_tokens - 1
+        input_ids = self.tokenizer(params["prompt"]).input_ids[-max_src_len:]
+
+        n = int(params.get("n", 1))
+        outputs = queue.Queue()
+        group = [
+            _Sequence(
+                params,
+                input_ids,
+                stop_token_ids,
+                self.tokenizer,
+                outputs,
+                i if n > 1 else None,
+            )
+            for i in range(n)
+        ]
+        self.waiting.put(group)
+        num_finished = 0
+        try:
+            while num_finished < n:
+                item = outputs.get()
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+                if item["finish_reason"] is not None:
+                    num_finished += 1
+        finally:
+            for seq in group:
+                seq.cancelled = True
+
+    def _run_loop(self):
+        while True:
+            try:
+                self._admit()
+                self._abort_cancelled()
+                if self.running:
+                    self._decode_step()
+            except Exception as e:
+                # Fail every request in the batch instead of killing the loop.
+                for seq in self.running:
+                    seq.outputs.put(e)
+                self.running = []
+                self.past_key_values = self.attention_mask = None
+
+    @torch.inference_mode()
+    def _admit(self):
+        # The samples of a request are admitted together, so a request with
+        # n > 1 may overshoot max_batch_size by up to n - 1 sequences.
+        while len(self.running) < self.max_batch_size:
+            try:
+                # Block only when there is nothing else to do.
+                group = self.waiting.get(block=not self.running)
+            except queue.Empty:
+                return
+            if all(s.cancelled for s in group):
+                continue
+            try:
+                self._prefill(group)
+            except Exception as e:
+                # The group is not in the batch, so fail it here or its
+                # consumer would wait forever.
+                for s in group:
+                    s.finished = True
+                group[0].outputs.put(e)
+
+    def _prefill(self, group: List[_Sequence]):
+        """Prefill the prompt shared by a group of samples once."""
+        seq = group[0]
+        num_cached, cached_key_values = 0, None
+        if self.prefix_cache is not None:
+            num_cached, cached_key_values = self.prefix_cache.lookup(seq.input_ids)
+        input_ids = torch.as_tensor([seq.input_ids[num_cached:]], device=self.device)
+        out = self.model(
+            input_ids=input_ids, past_key_values=cached_key_values, use_cache=True
+        )
+        cache_cls = get_cache_cls(out.past_key_values)
+        past_key_values = to_legacy_cache(out.past_key_values)
+        for k, v in past_key_values:
+            if k.dim() != 4 or k.shape[0] != 1 or k.shape[2] != len(seq.input_ids):
+                raise ValueError(
+                    "The KV cache layout of this model is not supported by "
+                    "continuous batching."
+                )
+        self.cache_cls = cache_cls
+
+        for s in group:
+            self._process_token(s, out.logits[0, -1, :])
+        if self.prefix_cache is not None and any(s.finished for s in group):
+            self.prefix_cache.insert(seq.input_ids, past_key_values, cache_cls)
+        group = [s for s in group if not s.finished]
+        if not group:
+            return
+
+        if len(group) > 1:
+            past_key_values = [
+                (k.repeat(len(group), 1, 1, 1), v.repeat(len(group), 1, 1, 1))
+                for k, v in past_key_values
+            ]
+        attention_mask = torch.ones(
+            (len(group), len(seq.input_ids)), dtype=torch.long, device=self.device
+        )
+        if self.past_key_values is None:
+            self.past_key_values, self.attention_mask = past_key_values, attention_mask
+        else:
+            length = max(self.attention_mask.shape[1], attention_mask.shape[1])
+            old_kv, old_mask = _left_pad(
+                self.past_key_values, self.attention_mask, length
+            )
+            new_kv, new_mask = _left_pad(past_key_values, attention_mask, length)
+            self.past_key_values = [
+                (torch.cat([ok, nk]), torch.cat([ov, nv]))
+                for (ok, ov), (nk, nv) in zip(old_kv, new_kv)
+            ]
+            self.attention_mask = torch.cat([old_mask, new_mask])
+        self.running.extend(group)
+
+    @torch.inference_mode()
+    def _decode_step(self):
+        batch_size = len(self.running)
+        input_ids = torch.as_tensor(
+            [[seq.output_ids[-1]] for seq in self.running], device=self.device
+        )
+        # The last sampled token is not in the cache yet.
+        position_ids = torch.as_tensor(
+            [[len(seq.output_ids) - 1] for seq in self.running], device=self.device
+        )
+        self.attention_mask = torch.cat(
+            [
+                self.attention_mask,
+                self.attention_mask.new_ones((batch_size, 1)),
+            ],
+            dim=1,
+        )
+        out = self.model(
+            input_ids=input_ids,
+            attention_mask=self.attention_mask,
+            position_ids=position_ids,
+            past_key_values=from_legacy_cache(self.past_key_values, self.cache_cls),
+            use_cache=True,
+        )
+        self.past_key_values = to_legacy_cache(out.past_key_values)
+
+        logits = out.logits[:, -1, :]
+        for i, seq in enumerate(self.running):
+            try:
+                self._process_token(seq, logits[i])
+            except Exception as e:
+                seq.finished = True
+                seq.outputs.put(e)
+        self._retire()
+
+    def _abort_cancelled(self):
+        """Retire the sequences whose streams were closed by the consumer."""
+        for seq in self.running:
+            if seq.cancelled:
+                seq.finished = True
+        self._retire()
+
+    def _retire(self):
+        keep = [i for i, seq in enumerate(self.running) if not seq.finished]
+        if len(keep) == len(self.running):
+            return
+        if self.prefix_cache is not None:
+            for i, seq in enumerate(self.running):
+                if seq.finished:
+                    self._cache_prefix(i, seq)
+        self.running = [self.running[i] for i in keep]
+        if not keep:
+            self.past_key_values = self.attention_mask = None
+            return
+
+        index = torch.as_tensor(keep, device=self.device)
+        attention_mask = self.attention_mask.index_select(0, index)
+        # Drop the leading columns that are padding for every remaining sequence.
+        start = int(attention_mask.any(dim=0).nonzero()[0])
+        self.attention_mask = attention_mask[:, start:]
+        self.past_key_values = [
+            (
+                k.index_select(0, index)[:, :, start:],
+                v.index_select(0, index)[:, :, start:],
+            )
+            for k, v in self.past_key_values
+        ]
+
+    def _cache_prefix(self, i: int, seq: _Sequence):
+        """Copy the KV state of one finished sequence into the prefix cache."""
+        num_tokens = int(self.attention_mask[i].sum())
+        past_key_values = [
+            (
+                k[i : i + 1, :, -num_tokens:].clone(),
+                v[i : i + 1, :, -num_tokens:].clone(),
+            )
+            for k, v in self.past_key_values
+        ]
+        self.prefix_cache.insert(
+            seq.output_ids[:num_tokens], past_key_values, self.cache_cls
+        )
+
+    def _process_token(self, seq: _Sequence, logits: torch.Tensor):
+        """Sample the next token of a sequence and stream its output."""
+        if seq.logits_processor:
+            if seq.repetition_penalty > 1.0:
+                tmp_output_ids = torch.as_tensor([seq.output_ids], device=logits.device)
+            else:
+                tmp_output_ids = None
+            logits = seq.logits_processor(tmp_output_ids, logits[None, :])[0]
+
+        if seq.temperature < 1e-5 or seq.top_p < 1e-8:  # greedy
+            token = int(torch.argmax(logits))
+        else:
+            probs = torch.softmax(logits.float(), dim=-1)
+            token = int(torch.multinomial(probs, num_samples=1))
+        seq.output_ids.append(token)
+
+        i = seq.step
+        stopped = token in seq.stop_token_ids
+        if i % self.stream_interval == 0 or i == seq.max_new_tokens - 1 or stopped:
+            seq.detokenizer.add_tokens(
+                seq.output_ids[seq.num_detokenized :],
+                final=stopped or i == seq.max_new_tokens - 1,
+            )
+            seq.num_detokenized = len(seq.output_ids)
+            output = seq.detokenizer.text
+
+            partially_stopped = False
+            if seq.stop_str:
+                pos, partially_stopped = find_stop_str(
+                    output, seq.stop_str, seq.rfind_start, seq.stop_checked_len
+                )
+                if pos != -1:
+                    output = output[:pos]
+                    stopped = True
+                else:
+                    seq.stop_checked_len = max(len(output), seq.rfind_start)
+            seq.output = output
+
+            # Prevent yielding partial stop sequence
+            if not partially_stopped:
+                seq.outputs.put(seq.make_output(None))
+
+        if stopped:
+            finish_reason = "stop"
+        elif i == seq.max_new_tokens - 1:
+            finish_reason = "length"
+        else:
+            seq.step += 1
+            return
+        seq.finished = True
+        seq.outputs.put(seq.make_output(finish_reason))
@@ -4,23 +4,29 @@ It sends worker addresses to clients.
 """
 import argparse
 import asyncio
+import bisect
 import dataclasses
 from enum import Enum, auto
+import heapq
+import itertools
 import json
 import logging
 import os
+import random
 import time
-from typing import List, Union
-import threading
+from typing import Dict, List, Optional, Union
 
+import aiohttp
 from fastapi import FastAPI, Request
 from fastapi.responses import StreamingResponse
-import numpy as np
-import requests
+from starlette.background import BackgroundTask
 import uvicorn
 
 from fastchat.constants import (
+    CONTROLLER_FANOUT_CONCURRENCY,
     CONTROLLER_HEART_BEAT_EXPIRATION,
+    LATENCY_EWMA_ALPHA,
+    LATENCY_EWMA_EXPECTED_TOKENS,
     WORKER_API_TIMEOUT,
     ErrorCode,
     SERVER_ERROR_MSG,
@@ -34,6 +40,9 @@ logger = build_logger("controller", "controller.log")
 class DispatchMethod(Enum):
     LOTTERY = auto()
     SHORTEST_QUEUE = auto()
+    POWER_OF_TWO = auto()
+    LEAST_OUTSTANDING = auto()
+    LATENCY_EWMA = auto()
 
     @classmethod
     def from_str(cls, name):
@@ -41,6 +50,12 @@ class DispatchMethod(Enum):
             return cls.LOTTERY
         elif name == "shortest_queue":
             return cls.SHORTEST_QUEUE
+        elif name == "power_of_two":
+            return cls.POWER_OF_TWO
+        elif name == "least_outstanding":
+            return cls.LEAST_OUTSTANDING
+        elif name == "latency_ewma":
+            return cls.LATENCY_EWMA
         else:
             raise ValueError(f"Invalid dispatch method")
 
@@ -53,11 +68,84 @@ class WorkerInfo:
     check_heart_beat: bool
     last_heart_beat: str
     multimodal: bool
+    # Requests dispatched by this controller that have not been released yet
+    num_outstanding: int = 0
+    # Requests dispatched since the last heart beat, which may not have reached
+    # the worker's queue yet
+    num_recent_dispatches: int = 0
+    # Worker-reported moving averages of time to first token and decode speed
+    ttft: Optional[float] = None
+    tokens_per_second: Optional[float] = None
+
+
+class ModelWorkerIndex:
+    """The workers that serve one model, indexed for fast dispatch.
+
+    Lottery dispatch bisects a cumulative speed table that is only rebuilt when
+    the set of workers changes. The load-based methods keep a heap of
+    (load, version, worker_name) entries and lazily drop the outdated ones.
+    """
+
+    def __init__(self):
+        self.worker_names: List[str] = []
+        self.cum_speeds = None
+        self.heap = []
+        # worker name -> version of its newest heap entry
+        self.versions: Dict[str, int] = {}
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.worker_names)
+
+    def add(self, worker_name: str, load: float):
+        if worker_name not in self.versions:
+            self.worker_names.append(worker_name)
+        self.cum_speeds = None
+        self.update(worker_name, load)
+
+    def remove(self, worker_name: str):
+        self.worker_names.remove(worker_name)
+        del self.versions[worker_name]
+        self.cum_speeds = None
+
+    def update(self, worker_name: str, load: float):
+        version = next(self.counter)
+        self.versions[worker_name] = version
+        heapq.heappush(self.heap, (load, version, worker_name))
+        if len(self.heap) > 4 * len(self.worker_names) + 16:
+            # Drop outdated entries so that the heap stays O(#workers).
+            self.heap = [x for x in self.heap if self.versions.get(x[2]) == x[1]]
+            heapq.heapify(self.heap)
+
+    def sample_by_speed(self, worker_info: Dict[str, WorkerInfo]) -> str:
+        if self.cum_speeds is None:
+            self.cum_speeds = list(
+                itertools.accumulate(
+                    worker_info[w_name].speed for w_name in self.worker_names
+                )
+            )
+        if not self.cum_speeds or self.cum_speeds[-1] < 1e-4:
+            return ""
+        pt = bisect.bisect_right(self.cum_speeds, random.random() * self.cum_speeds[-1])
+        return self.worker_names[min(pt, len(self.worker_names) - 1)]
+
+    def sample_two(self) -> List[str]:
+        if len(self.worker_names) <= 2:
+            return list(self.worker_names)
+        return random.sample(self.worker_names, 2)
+
+    def least_loaded(self) -> str:
+        while self.heap:
+            _, version, worker_name = self.heap[0]
+            if self.versions.get(worker_name) == version:
+                return worker_name
+            heapq.heappop(self.heap)
+        return ""
 
 
-def heart_beat_controller(controller):
+async def heart_beat_controller(controller):
     while True:
-        time.sleep(CONTROLLER_HEART_BEAT_EXPIRATION)
+        await asyncio.sleep(CONTROLLER_HEART_BEAT_EXPIRATION)
         controller.remove_stale_workers_by_expiration()
 
 
@@ -65,14 +153,28 @@ class Controller:
     def __init__(self, dispatch_method: str):
         # Dict[str -> WorkerInfo]
         self.worker_info = {}
+        # Dict[str -> ModelWorkerIndex], updated on register, heart beat and expiry
+        self.model_index = {}
         self.dispatch_method = DispatchMethod.from_str(dispatch_method)
+        # Fleet-wide latency averages, used for workers that have not reported yet
+        self.default_ttft = 1.0
+        self.default_tokens_per_second = 20.0
+        # One pooled HTTP session for all requests to workers. It is created
+        # lazily because it must be bound to the running event loop.
+        self.session = None
+        self.fanout_semaphore = None
+
+    def get_session(self) -> aiohttp.ClientSession:
+        if self.session is None:
+            # Relayed streams are long lived, so the connection pool is not
+            # capped. Status polls are bounded by fanout_semaphore instead.
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=0),
+            )
+            self.fanout_semaphore = asyncio.Semaphore(CONTROLLER_FANOUT_CONCURRENCY)
+        return self.session
 
-        self.heart_beat_thread = threading.Thread(
-            target=heart_beat_controller, args=(self,)
-        )
-        self.heart_beat_thread.start()
-
-    def register_worker(
+    async def register_worker(
         self,
         worker_name: str,
         check_heart_beat: bool,
@@ -85,55 +187,84 @@ class Controller:
             logger.info(f"Register an existing worker: {worker_name}")
 
         if not worker_status:
-            worker_status = self.get_worker_status(worker_name)
+            worker_status = await self.get_worker_status(worker_name)
         if not worker_status:
             return False
 
-        self.worker_info[worker_name] = WorkerInfo(
-            worker_status["model_names"],
-            worker_status["speed"],
-            worker_status["queue_length"],
-            check_heart_beat,
-            time.time(),
-            multimodal,
+        self.add_worker(
+            worker_name,
+            WorkerInfo(
+                worker_status["model_names"],
+                worker_status["speed"],
+                worker_status["queue_length"],
+                check_heart_beat,
+                time.time(),
+                multimodal,
+                worker_status["queue_length"],
+            ),
+        )
+        self.update_latency(
+            worker_name,
+            worker_status.get("ttft", None),
+            worker_status.get("tokens_per_second", None),
         )
 
         logger.info(f"Register done: {worker_name}, {worker_status}")
         return True
 
-    def get_worker_status(self, worker_name: str):
+    async def get_worker_status(self, worker_name: str):
+        session = self.get_session()
         try:
-            r = requests.post(worker_name + "/worker_get_status", timeout=5)
-        except requests.exceptions.RequestException as e:
+            async with self.fanout_semaphore:
+                async with session.post(
+                    worker_name + "/worker_get_status",
+                    timeout=aiohttp.ClientTimeout(total=5),
+                ) as r:
+                    if r.status != 200:
+                        logger.error(f"Get status fails: {worker_name}, {r.status}")
+                        return None
+                    return await r.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             logger.error(f"Get status fails: {worker_name}, {e}")
             return None
 
-        if r.status_code != 200:
-            logger.error(f"Get status fails: {worker_name}, {r}")
-            return None
-
-        return r.json()
+    def add_worker(self, worker_name: str, w_info: WorkerInfo):
+        if worker_name in self.worker_info:
+            self.remove_worker(worker_name)
+        self.worker_info[worker_name] = w_info
+        for model_name in w_info.model_names:
+            if model_name not in self.model_index:
+                self.model_index[model_name] = ModelWorkerIndex()
+            self.model_index[model_name].add(worker_name, self.get_load(w_info))
 
     def remove_worker(self, worker_name: str):
-        del self.worker_info[worker_name]
-
-    def refresh_all_workers(self):
-        old_info = dict(self.worker_info)
-        self.worker_info = {}
+        w_info = self.worker_info.pop(worker_name)
+        for model_name in w_info.model_names:
+            index = self.model_index[model_name]
+            index.remove(worker_name)
+            if len(index) == 0:
+                del self.model_index[model_name]
+
+    async def refresh_all_workers(self):
+        worker_names = list(self.worker_info)
+        all_status = await asyncio.gather(
+            *[self.get_worker_status(w_name) for w_name in worker_names]
+        )
 
-        for w_name, w_info in old_info.items():
-            if not self.register_worker(
-                w_name, w_info.check_heart_beat, None, w_info.multimodal
-            ):
+        for w_name, worker_status in zip(worker_names, all_status):
+            w_info = self.worker_info.get(w_name)
+            if w_info is None:
+                continue
+            if worker_status is None:
                 logger.info(f"Remove stale worker: {w_name}")
+                self.remove_worker(w_name)
+                continue
+            await self.register_worker(
+                w_name, w_info.check_heart_beat, worker_status, w_info.multimodal
+            )
 
     def list_models(self):
-        model_names = set()
-
-        for w_name, w_info in self.worker_info.items():
-            model_names.update(w_info.model_names)
-
-        return list(model_names)
+        return list(self.model_index)
 
     def list_multimodal_models(self):
         model_names = set()
@@ -153,66 +284,135 @@ class Controller:
 
         return list(model_names)
 
+    def list_workers(self):
+        """The routing information of every worker, for clients that dispatch
+        requests themselves."""
+        return {
+            w_name: {
+                "model_names": w_info.model_names,
+                "speed": w_info.speed,
+                "queue_length": w_info.queue_length,
+                "multimodal": w_info.multimodal,
+            }
+            for w_name, w_info in self.worker_info.items()
+        }
+
     def get_worker_address(self, model_name: str):
+        index = self.model_index.get(model_name)
+        if index is None:
+            return ""
+
         if self.dispatch_method == DispatchMethod.LOTTERY:
-            worker_names = []
-            worker_speeds = []
-            for w_name, w_info in self.worker_info.items():
-                if model_name in w_info.model_names:
-                    worker_names.append(w_name)
-                    worker_speeds.append(w_info.speed)
-            worker_speeds = np.array(worker_speeds, dtype=np.float32)
-            norm = np.sum(worker_speeds)
-            if norm < 1e-4:
-                return ""
-            worker_speeds = worker_speeds / norm
-            if True:  # Directly return address
-                pt = np.random.choice(np.arange(len(worker_names)), p=worker_speeds)
-                worker_name = worker_names[pt]
-                return worker_name
+            w_name = index.sample_by_speed(self.worker_info)
+        elif self.dispatch_method == DispatchMethod.POWER_OF_TWO:
+            w_name = min(
+                index.sample_two(),
+                key=lambda w: self.get_load(self.worker_info[w]),
+                default="",
+            )
+        else:
+            w_name = index.least_loaded()
+        if not w_name:
+            return ""
+
+        w_info = self.worker_info[w_name]
+        w_info.num_outstanding += 1
+        w_info.num_recent_dispatches += 1
+        if self.dispatch_method == DispatchMethod.SHORTEST_QUEUE:
+            # Count the new request until the next heart beat corrects it.
+            w_info.queue_length += 1
+        self.update_load(w_name)
+        logger.info(f"model: {model_name}, ret: {w_name}")
+        return w_name
+
+    def counts_outstanding(self) -> bool:
+        """Whether the dispatch method needs `release_worker_address` calls."""
+        return self.dispatch_method not in (
+            DispatchMethod.LOTTERY,
+            DispatchMethod.SHORTEST_QUEUE,
+        )
+
+    def release_worker_address(self, worker_name: str):
+        """Mark a request dispatched by `get_worker_address` as finished."""
+        w_info = self.worker_info.get(worker_name)
+        if w_info is None:
+            return False
+        w_info.num_outstanding = max(w_info.num_outstanding - 1, 0)
+        self.update_load(worker_name)
+        return True
 
-            # Check status before returning
-            while True:
-                pt = np.random.choice(np.arange(len(worker_names)), p=worker_speeds)
-                worker_name = worker_names[pt]
-
-                if self.get_worker_status(worker_name):
-                    break
-                else:
-                    self.remove_worker(worker_name)
-                    worker_speeds[pt] = 0
-                    norm = np.sum(worker_speeds)
-                    if norm < 1e-4:
-                        return ""
-                    worker_speeds = worker_speeds / norm
-                    continue
-            return worker_name
-        elif self.dispatch_method == DispatchMethod.SHORTEST_QUEUE:
-            worker_names = []
-            worker_qlen = []
-            for w_name, w_info in self.worker_info.items():
-                if model_name in w_info.model_names:
-                    worker_names.append(w_name)
-                    worker_qlen.append(w_info.queue_length / w_info.speed)
-            if len(worker_names) == 0:
-                return ""
-            min_index = np.argmin(worker_qlen)
-            w_name = worker_names[min_index]
-            self.worker_info[w_name].queue_length += 1
-            logger.info(
-                f"names: {worker_names}, queue_lens: {worker_qlen}, ret: {w_name}"
+    def get_load(self, w_info: WorkerInfo) -> float:
+        """The dispatch cost of a worker. Lower is better."""
+        if self.dispatch_method == DispatchMethod.SHORTEST_QUEUE:
+            return w_info.queue_length / w_info.speed
+        elif self.dispatch_method == DispatchMethod.LATENCY_EWMA:
+            # The expected latency of a new request if the worker served its
+            # outstanding requests and the new one back to back.
+            ttft = w_info.ttft if w_info.ttft is not None else self.default_ttft
+            tokens_per_second = (
+                w_info.tokens_per_second or self.default_tokens_per_second
             )
-            return w_name
+            latency = ttft + LATENCY_EWMA_EXPECTED_TOKENS / tokens_per_second
+            return (self.get_num_pending(w_info) + 1) * latency
         else:
-            raise ValueError(f"Invalid dispatch method: {self.dispatch_method}")
+            return self.get_num_pending(w_info) / w_info.speed
 
-    def receive_heart_beat(self, worker_name: str, queue_length: int):
+    @staticmethod
+    def get_num_pending(w_info: WorkerInfo) -> int:
+        """The requests of a worker by the controller's count or its own.
+
+        The worker also counts requests from other controllers, and the
+        controller counts the ones still on their way to the worker.
+        """
+        return max(w_info.num_outstanding, w_info.queue_length)
+
+    def update_load(self, worker_name: str):
+        w_info = self.worker_info[worker_name]
+        load = self.get_load(w_info)
+        for model_name in w_info.model_names:
+            self.model_index[model_name].update(worker_name, load)
+
+    def update_latency(
+        self,
+        worker_name: str,
+        ttft: Optional[float],
+        tokens_per_second: Optional[float],
+    ):
+        w_info = self.worker_info[worker_name]
+        if ttft is not None:
+            w_info.ttft = ttft
+            self.default_ttft += LATENCY_EWMA_ALPHA * (ttft - self.default_ttft)
+        if tokens_per_second:
+            w_info.tokens_per_second = tokens_per_second
+            self.default_tokens_per_second += LATENCY_EWMA_ALPHA * (
+                tokens_per_second - self.default_tokens_per_second
+            )
+        self.update_load(worker_name)
+
+    def receive_heart_beat(
+        self,
+        worker_name: str,
+        queue_length: int,
+        ttft: Optional[float] = None,
+        tokens_per_second: Optional[float] = None,
+    ):
         if worker_name not in self.worker_info:
             logger.info(f"Receive unknown heart beat. {worker_name}")
             return False
 
-        self.worker_info[worker_name].queue_length = queue_length
-        self.worker_info[worker_name].last_heart_beat = time.time()
+        w_info = self.worker_info[worker_name]
+        # Kept apart from num_outstanding, which also counts the requests that
+        # were dispatched but have not reached the worker's queue yet.
+        w_info.queue_length = queue_length
+        # A request dispatched before the previous heart beat has reached the
+        # worker by now, so the worker counts it unless it finished and its
+        # release was lost, e.g. when the client disconnected.
+        w_info.num_outstanding = min(
+            w_info.num_outstanding, queue_length + w_info.num_recent_dispatches
+        )
+        w_info.num_recent_dispatches = 0
+        w_info.last_heart_beat = time.time()
+        self.update_latency(worker_name, ttft, tokens_per_second)
         logger.info(f"Receive heart beat. {worker_name}")
         return True
 
@@ -244,13 +444,15 @@ class Controller:
 
     # Let the controller act as a worker to achieve hierarchical
     # management. This can be used to connect isolated sub networks.
-    def worker_api_get_status(self):
+    async def worker_api_get_status(self):
         model_names = set()
         speed = 0
         queue_length = 0
 
-        for w_name in self.worker_info:
-            worker_status = self.get_worker_status(w_name)
+        all_status = await asyncio.gather(
+            *[self.get_worker_status(w_name) for w_name in list(self.worker_info)]
+        )
+        for worker_status in all_status:
             if worker_status is not None:
                 model_names.update(worker_status["model_names"])
                 speed += worker_status["speed"]
@@ -263,32 +465,56 @@ class Controller:
             "queue_length": queue_length,
         }
 
-    def worker_api_generate_stream(self, params):
-        worker_addr = self.get_worker_address(params["model"])
+    async def worker_api_generate_stream(self, params, worker_addr):
+        """Relay the byte stream of a worker as it arrives.
+
+        The worker's null-delimited chunks are forwarded unchanged. The next read
+        from the worker only happens once the client has taken the previous
+        bytes, so slow clients apply backpressure all the way to the worker.
+        When the client disconnects, the upstream connection is closed.
+        """
         if not worker_addr:
             yield self.handle_no_worker(params)
+            return
 
+        session = self.get_session()
         try:
-            response = requests.post(
+            async with session.post(
                 worker_addr + "/worker_generate_stream",
                 json=params,
-                stream=True,
-                timeout=WORKER_API_TIMEOUT,
-            )
-            for chunk in response.iter_lines(decode_unicode=False, delimiter=b"\0"):
-                if chunk:
-                    yield chunk + b"\0"
-        except requests.exceptions.RequestException as e:
+                timeout=aiohttp.ClientTimeout(
+                    sock_connect=WORKER_API_TIMEOUT, sock_read=WORKER_API_TIMEOUT
+                ),
+            ) as response:
+                try:
+                    async for chunk in response.content.iter_any():
+                        yield chunk
+                finally:
+                    if not response.content.is_eof():
+                        # Do not return a half-read connection to the pool.
+                        response.close()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             yield self.handle_worker_timeout(worker_addr)
 
 
 app = FastAPI()
 
 
+@app.on_event("startup")
+async def app_startup():
+    asyncio.create_task(heart_beat_controller(controller))
+
+
+@app.on_event("shutdown")
+async def app_shutdown():
+    if controller.session is not None:
+        await controller.session.close()
+
+
 @app.post("/register_worker")
 async def register_worker(request: Request):
     data = await request.json()
-    controller.register_worker(
+    await controller.register_worker(
         data["worker_name"],
         data["check_heart_beat"],
         data.get("worker_status", None),
@@ -298,7 +524,7 @@ async def register_worker(request: Request):
 
 @app.post("/refresh_all_workers")
 async def refresh_all_workers():
-    models = controller.refresh_all_workers()
+    await controller.refresh_all_workers()
 
 
 @app.post("/list_models")
@@ -319,30 +545,54 @@ async def list_language_models():
     return {"models": models}
 
 
+@app.post("/list_workers")
+async def list_workers():
+    workers = controller.list_workers()
+    return {"workers": workers}
+
+
 @app.post("/get_worker_address")
 async def get_worker_address(request: Request):
     data = await request.json()
     addr = controller.get_worker_address(data["model"])
-    return {"address": addr}
+    return {"address": addr, "release": controller.counts_outstanding()}
+
+
+@app.post("/release_worker_address")
+async def release_worker_address(request: Request):
+    data = await request.json()
+    exist = controller.release_worker_address(data["worker_address"])
+    return {"exist": exist}
 
 
 @app.post("/receive_heart_beat")
 async def receive_heart_beat(request: Request):
     data = await request.json()
-    exist = controller.receive_heart_beat(data["worker_name"], data["queue_length"])
+    exist = controller.receive_heart_beat(
+        data["worker_name"],
+        data["queue_length"],
+        data.get("ttft", None),
+        data.get("tokens_per_second", None),
+    )
     return {"exist": exist}
 
 
 @app.post("/worker_generate_stream")
 async def worker_api_generate_stream(request: Request):
     params = await request.json()
-    generator = controller.worker_api_generate_stream(params)
-    return StreamingResponse(generator)
+    # Dispatch on the event loop, which owns the worker index.
+    worker_addr = controller.get_worker_address(params["model"])
+    generator = controller.worker_api_generate_stream(params, worker_addr)
+
+    async def release():
+        controller.release_worker_address(worker_addr)
+
+    return StreamingResponse(generator, background=BackgroundTask(release))
 
 
 @app.post("/worker_get_status")
 async def worker_api_get_status(request: Request):
-    return controller.worker_api_get_status()
+    return await controller.worker_api_get_status()
 
 
 @app.get("/test_connection")
@@ -357,8 +607,19 @@ def create_controller():
     parser.add_argument(
         "--dispatch-method",
         type=str,
-        choices=["lottery", "shortest_queue"],
+        choices=[
+            "lottery",
+            "shortest_queue",
+            "power_of_two",
+            "least_outstanding",
+            "latency_ewma",
+        ],
         default="shortest_queue",
+        help="lottery: sample workers by speed. shortest_queue: the shortest "
+        "reported queue. power_of_two: the less loaded of two random workers. "
+        "least_outstanding: the fewest unreleased requests from this "
+        "controller. latency_ewma: the lowest expected latency from "
+        "worker-reported TTFT and tokens/sec.",
     )
     parser.add_argument(
         "--ssl",
@@ -0,0 +1,132 @@
+"""
+Coalesce the items of a stream iterator into rate-limited UI frames.
+
+Stream iterators yield the whole text so far on every chunk, so only the
+latest item matters for the UI. coalesce_frames advances the iterator in a
+background thread and yields the latest item at most once per frame interval.
+An item is never held back longer than one interval, even if the stream stalls
+after it, and the first item is yielded as soon as it arrives.
+
+merge_streams advances several iterators (e.g., the two sides of a battle)
+in their own threads and yields their items as each one arrives, so a slow or
+failing iterator does not hold up the others.
+"""
+import queue
+import threading
+import time
+
+from fastchat.constants import STREAM_FRAME_INTERVAL
+
+_ITEM, _ERROR, _DONE = range(3)
+
+
+def _pull(stream_iter, events, stop, index=0):
+    try:
+        for data in stream_iter:
+            if stop.is_set():
+                break
+            events.put((index, _ITEM, data))
+    except Exception as e:
+        events.put((index, _ERROR, e))
+    else:
+        events.put((index, _DONE, None))
+    finally:
+        # Release the provider connection when the consumer has left
+        if stop.is_set() and hasattr(stream_iter, "close"):
+            stream_iter.close()
+
+
+def coalesce_frames(stream_iter, frame_interval=STREAM_FRAME_INTERVAL):
+    """Yield the latest item of stream_iter at most once per frame_interval.
+
+    Exceptions of stream_iter are raised here after its last items.
+    """
+    events = queue.Queue()
+    stop = threading.Event()
+    threading.Thread(
+        target=_pull, args=(stream_iter, events, stop), daemon=True
+    ).start()
+
+    pending = None
+    last_frame = -frame_interval
+    try:
+        while True:
+            timeout = None
+            if pending is not None:
+                timeout = max(0, last_frame + frame_interval - time.monotonic())
+            try:
+                _, kind, value = events.get(timeout=timeout)
+            except queue.Empty:  # The frame is due
+                kind, value = None, None
+            if kind == _ITEM:
+                pending = value
+            elif pending is not None:
+                # Show what arrived before the stream ended or failed
+                yield pending
+                pending = None
+                last_frame = time.monotonic()
+            if kind == _ERROR:
+                raise value
+            if kind == _DONE:
+                return
+            if pending is not None and time.monotonic() >= last_frame + frame_interval:
+                yield pending
+                pending = None
+                last_frame = time.monotonic()
+    finally:
+        stop.set()
+
+
+def merge_streams(stream_iters, timeout=None):
+    """Advance each iterator in its own thread and yield their items as they arrive.
+
+    Yields lists of (index, item, error) with every event available at that
+    time. error is None for items. An iterator that raises, or yields nothing
+    for timeout seconds, ends with one event whose error is the exception or
+    a TimeoutError, and the other iterators continue.
+    """
+    events = queue.Queue()
+    stops = [threading.Event() for _ in stream_iters]
+    last_active = {}
+    for i, stream_iter in enumerate(stream_iters):
+        threading.Thread(
+            target=_pull, args=(stream_iter, events, stops[i], i), daemon=True
+        ).start()
+        last_active[i] = time.monotonic()
+
+    try:
+        while last_active:
+            wait = None
+            if timeout is not None:
+                wait = max(0, min(last_active.values()) + timeout - time.monotonic())
+            try:
+                received = [events.get(timeout=wait)]
+            except queue.Empty:
+                received = []
+            while not events.empty():
+                received.append(events.get())
+
+            updates = []
+            for i, kind, value in received:
+                if i not in last_active:  # The iterator already timed out
+                    continue
+                if kind == _ITEM:
+                    updates.append((i, value, None))
+                    last_active[i] = time.monotonic()
+                else:
+                    if kind == _ERROR:
+                        updates.append((i, None, value))
+                    del last_active[i]
+            if timeout is not None:
+                for i in list(last_active):
+                    if time.monotonic() - last_active[i] >= timeout:
+                        updates.append(
+                            (i, None, TimeoutError(f"no output for {timeout} s"))
+                        )
+                        stops[i].set()
+                        del last_active[i]
+            if updates:
+                yield updates
+    finally:
+        for stop in stops:
+            stop.set()
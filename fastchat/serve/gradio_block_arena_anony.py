@@ -5,11 +5,9 @@ Users chat with two anonymous models.
 
 import json
 import time
-import re
 
 import gradio as gr
 from gradio_sandboxcomponent import SandboxComponent
-import numpy as np
 
 from fastchat.constants import (
     MODERATION_MSG,
@@ -19,9 +17,12 @@ from fastchat.constants import (
     CONVERSATION_TURN_LIMIT,
     INPUT_CHAR_LEN_LIMIT,
     SURVEY_LINK,
+    BATTLE_SIDE_TIMEOUT,
 )
 from fastchat.model.model_adapter import get_conversation_template
-from fastchat.serve.gradio_block_arena_named import flash_buttons, update_sandbox_system_messages_multi
+from fastchat.serve.battle_sampler import get_battle_pair_sampler, get_sample_weight
+from fastchat.serve.frame_coalescer import merge_streams
+from fastchat.serve.gradio_block_arena_named import flash_buttons, set_side_error, update_sandbox_system_messages_multi
 from fastchat.serve.gradio_web_server import (
     State,
     bot_response,
@@ -234,81 +235,19 @@ SAMPLING_BOOST_MODELS = []
 OUTAGE_MODELS = []
 
 
-def get_sample_weight(model, outage_models, sampling_weights, sampling_boost_models=[]):
-    if model in outage_models:
-        return 0
-    weight = sampling_weights.get(model, 0)
-    if model in sampling_boost_models:
-        weight *= 5
-    return weight
-
-
-def is_model_match_pattern(model, patterns):
-    flag = False
-    for pattern in patterns:
-        pattern = pattern.replace("*", ".*")
-        if re.match(pattern, model) is not None:
-            flag = True
-            break
-    return flag
-
-
 def get_battle_pair(
     models, battle_targets, outage_models, sampling_weights, sampling_boost_models
 ):
-    if len(models) == 1:
-        return models[0], models[0]
-
-    model_weights = []
-    for model in models:
-        weight = get_sample_weight(
-            model, outage_models, sampling_weights, sampling_boost_models
-        )
-        model_weights.append(weight)
-    total_weight = np.sum(model_weights)
-    
-    model_weights = model_weights / total_weight
-    # print(models)
-    # print(model_weights)
-    chosen_idx = np.random.choice(len(models), p=model_weights)
-    chosen_model = models[chosen_idx]
-    # for p, w in zip(models, model_weights):
-    #     print(p, w)
-
-    rival_models = []
-    rival_weights = []
-    for model in models:
-        if model == chosen_model:
-            continue
-        if model in ANON_MODELS and chosen_model in ANON_MODELS:
-            continue
-        if chosen_model in BATTLE_STRICT_TARGETS:
-            if not is_model_match_pattern(model, BATTLE_STRICT_TARGETS[chosen_model]):
-                continue
-        if model in BATTLE_STRICT_TARGETS:
-            if not is_model_match_pattern(chosen_model, BATTLE_STRICT_TARGETS[model]):
-                continue
-        weight = get_sample_weight(model, outage_models, sampling_weights)
-        if (
-            weight != 0
-            and chosen_model in battle_targets
-            and model in battle_targets[chosen_model]
-        ):
-            # boost to 20% chance
-            weight = 0.5 * total_weight / len(battle_targets[chosen_model])
-        rival_models.append(model)
-        rival_weights.append(weight)
-    # for p, w in zip(rival_models, rival_weights):
-    #     print(p, w)
-    rival_weights = rival_weights / np.sum(rival_weights)
-    rival_idx = np.random.choice(len(rival_models), p=rival_weights)
-    rival_model = rival_models[rival_idx]
-
-    swap = np.random.randint(2)
-    if swap == 0:
-        return chosen_model, rival_model
-    else:
-        return rival_model, chosen_model
+    sampler = get_battle_pair_sampler(
+        models,
+        battle_targets,
+        outage_models,
+        sampling_weights,
+        sampling_boost_models,
+        BATTLE_STRICT_TARGETS,
+        ANON_MODELS,
+    )
+    return sampler.sample()
 
 
 def add_text_multi(
@@ -488,52 +427,20 @@ def bot_response_multi(
             )
         )
 
-    model_tpy = []
-    for i in range(num_sides):
-        token_per_yield = 1
-        if states[i] is not None and states[i].model_name in [
-            "gemini-pro",
-            "gemma-1.1-2b-it",
-            "gemma-1.1-7b-it",
-            "phi-3-mini-4k-instruct",
-            "phi-3-mini-128k-instruct",
-            "snowflake-arctic-instruct",
-        ]:
-            token_per_yield = 30
-        elif states[i] is not None and  states[i].model_name in [
-            "qwen-max-0428",
-            "qwen-vl-max-0809",
-            "qwen1.5-110b-chat",
-            "llava-v1.6-34b",
-        ]:
-            token_per_yield = 7
-        elif states[i] is not None and states[i].model_name in [
-            "qwen2.5-72b-instruct",
-            "qwen2-72b-instruct",
-            "qwen-plus-0828",
-            "qwen-max-0919",
-            "llama-3.1-405b-instruct-bf16",
-        ]:
-            token_per_yield = 4
-        model_tpy.append(token_per_yield)
-
-    chatbots = [None] * num_sides
-    iters = 0
-    while True:
-        stop = True
-        iters += 1
-        for i in range(num_sides):
-            try:
-                # yield fewer times if chunk size is larger
-                if model_tpy[i] == 1 or (iters % model_tpy[i] == 1 or iters < 3):
-                    ret = next(gen[i])
-                    states[i], chatbots[i] = ret[0], ret[1]
-                stop = False
-            except StopIteration:
-                pass
+    # Each side runs in its own thread, so a slow or failing provider does not
+    # hold up the frames of the other side
+    chatbots = [
+        state.to_gradio_chatbot() if state is not None else None for state in states
+    ]
+    for updates in merge_streams(gen, timeout=BATTLE_SIDE_TIMEOUT):
+        for i, ret, error in updates:
+            if error is None:
+                states[i], chatbots[i] = ret[0], ret[1]
+            elif states[i] is not None:
+                logger.info(f"bot_response_multi side {i} error: {error}")
+                set_side_error(states[i], error)
+                chatbots[i] = states[i].to_gradio_chatbot()
         yield states + chatbots + [disable_btn] * 8
-        if stop:
-            break
 
 
 def build_side_by_side_ui_anony(models):
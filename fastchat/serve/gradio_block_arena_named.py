@@ -16,8 +16,12 @@ from fastchat.constants import (
     INPUT_CHAR_LEN_LIMIT,
     CONVERSATION_TURN_LIMIT,
     SURVEY_LINK,
+    SERVER_ERROR_MSG,
+    BATTLE_SIDE_TIMEOUT,
+    ErrorCode,
 )
 from fastchat.model.model_adapter import get_conversation_template
+from fastchat.serve.frame_coalescer import merge_streams
 from fastchat.serve.gradio_web_server import (
     State,
     add_text,
@@ -288,6 +292,18 @@ def add_text_multi(
     )
 
 
+def set_side_error(state, error):
+    """Show an error as the answer of a battle side that failed or timed out."""
+    # A side that timed out keeps running until its provider yields again, and
+    # then writes that chunk to its conversation before it sees that it was
+    # stopped. Give the state its own copy, so the error is what gets saved.
+    state.conv = state.conv.copy()
+    state.conv.update_last_message(
+        f"{SERVER_ERROR_MSG}\n\n"
+        f"(error_code: {ErrorCode.GRADIO_STREAM_UNKNOWN_ERROR}, {error})"
+    )
+
+
 def bot_response_multi(
     state0,
     state1,
@@ -325,51 +341,20 @@ def bot_response_multi(
             )
         )
 
-    model_tpy = []
-    for i in range(num_sides):
-        token_per_yield = 1
-        if states[i] is not None and states[i].model_name in [
-            "gemini-pro",
-            "gemma-1.1-2b-it",
-            "gemma-1.1-7b-it",
-            "phi-3-mini-4k-instruct",
-            "phi-3-mini-128k-instruct",
-            "snowflake-arctic-instruct",
-        ]:
-            token_per_yield = 30
-        elif states[i] is not None and states[i].model_name in [
-            "qwen-max-0428",
-            "qwen-vl-max-0809",
-            "qwen1.5-110b-chat",
-        ]:
-            token_per_yield = 7
-        elif states[i] is not None and  states[i].model_name in [
-            "qwen2.5-72b-instruct",
-            "qwen2-72b-instruct",
-            "qwen-plus-0828",
-            "qwen-max-0919",
-            "llama-3.1-405b-instruct-bf16",
-        ]:
-            token_per_yield = 4
-        model_tpy.append(token_per_yield)
-
-    chatbots = [None] * num_sides
-    iters = 0
-    while True:
-        stop = True
-        iters += 1
-        for i in range(num_sides):
-            try:
-                # yield fewer times if chunk size is larger
-                if model_tpy[i] == 1 or (iters % model_tpy[i] == 1 or iters < 3):
-                    ret = next(gen[i])
-                    states[i], chatbots[i] = ret[0], ret[1]
-                stop = False
-            except StopIteration:
-                pass
+    # Each side runs in its own thread, so a slow or failing provider does not
+    # hold up the frames of the other side
+    chatbots = [
+        state.to_gradio_chatbot() if state is not None else None for state in states
+    ]
+    for updates in merge_streams(gen, timeout=BATTLE_SIDE_TIMEOUT):
+        for i, ret, error in updates:
+            if error is None:
+                states[i], chatbots[i] = ret[0], ret[1]
+            elif states[i] is not None:
+                logger.info(f"bot_response_multi side {i} error: {error}")
+                set_side_error(states[i], error)
+                chatbots[i] = states[i].to_gradio_chatbot()
         yield states + chatbots + [disable_btn] * 8
-        if stop:
-            break
 
 
 def flash_buttons():
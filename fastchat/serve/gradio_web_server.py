@@ -36,6 +36,7 @@ from fastchat.model.model_adapter import (
 )
 from fastchat.model.model_registry import get_model_info, model_info
 from fastchat.serve.api_provider import get_api_provider_stream_iter
+from fastchat.serve.frame_coalescer import coalesce_frames
 from fastchat.serve.gradio_global_state import Context
 from fastchat.serve.remote_logger import get_remote_logger
 from fastchat.serve.sandbox.code_runner import SandboxGradioSandboxComponents, SandboxEnvironment, DEFAULT_SANDBOX_INSTRUCTIONS, RUN_CODE_BUTTON_HTML, ChatbotSandboxState, SUPPORTED_SANDBOX_ENVIRONMENTS, create_chatbot_sandbox_state, on_click_code_message_run, on_edit_code, update_sandbox_config, update_visibility_for_single_model
@@ -428,17 +429,37 @@ def model_worker_stream_iter(
         gen_params["images"] = images
 
     # Stream output
-    response = requests.post(
-        worker_addr + "/worker_generate_stream",
-        headers=headers,
-        json=gen_params,
-        stream=True,
-        timeout=WORKER_API_TIMEOUT,
-    )
-    for chunk in response.iter_lines(decode_unicode=False, delimiter=b"\0"):
-        if chunk:
-            data = json.loads(chunk.decode())
-            yield data
+    response = None
+    try:
+        response = requests.post(
+            worker_addr + "/worker_generate_stream",
+            headers=headers,
+            json=gen_params,
+            stream=True,
+            timeout=WORKER_API_TIMEOUT,
+        )
+        for chunk in response.iter_lines(decode_unicode=False, delimiter=b"\0"):
+            if chunk:
+                data = json.loads(chunk.decode())
+                yield data
+    finally:
+        # Closing the connection early makes the worker stop generating when
+        # the user leaves or stops the generation.
+        if response is not None:
+            response.close()
+        release_worker_address(worker_addr)
+
+
+def release_worker_address(worker_addr):
+    """Tell the controller that a request dispatched to worker_addr is done."""
+    try:
+        requests.post(
+            controller_url + "/release_worker_address",
+            json={"worker_address": worker_addr},
+            timeout=5,
+        )
+    except requests.exceptions.RequestException as e:
+        logger.info(f"release worker address error: {e}")
 
 
 def is_limit_reached(model_name, ip):
@@ -578,7 +599,8 @@ def bot_response(
 
     try:
         data = {"text": ""}
-        for i, data in enumerate(stream_iter):
+        # Merge the chunks that arrive within a frame into one UI update
+        for i, data in enumerate(coalesce_frames(stream_iter)):
             if data["error_code"] == 0:
                 output = data["text"].strip()
                 conv.update_last_message(output + "▌")
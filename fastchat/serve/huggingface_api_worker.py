@@ -135,6 +135,14 @@ class HuggingfaceApiWorker(BaseModelWorker):
         }
         return ret
 
+    def count_token_batch(self, params):
+        # No tokenizer here
+        ret = {
+            "counts": [0] * len(params["prompts"]),
+            "error_code": 0,
+        }
+        return ret
+
     def generate_stream_gate(self, params):
         self.call_ct += 1
 
@@ -264,6 +272,13 @@ async def api_count_token(request: Request):
     return worker.count_token(params)
 
 
+@app.post("/count_token_batch")
+async def api_count_token_batch(request: Request):
+    params = await request.json()
+    worker = worker_map[params["model"]]
+    return worker.count_token_batch(params)
+
+
 @app.post("/worker_get_conv_template")
 async def api_get_conv(request: Request):
     params = await request.json()
@@ -6,7 +6,7 @@ import math
 import os
 import sys
 import time
-from typing import Iterable, Optional, Dict
+from typing import Dict, Iterable, List, Optional, Tuple
 import warnings
 
 import psutil
@@ -39,6 +39,7 @@ from fastchat.modules.awq import AWQConfig
 from fastchat.modules.gptq import GptqConfig
 from fastchat.modules.exllama import ExllamaConfig
 from fastchat.modules.xfastertransformer import XftConfig
+from fastchat.serve.prefix_cache import PrefixCache, get_cache_cls, to_legacy_cache
 from fastchat.utils import is_partial_stop, is_sentence_complete, get_context_length
 
 
@@ -58,6 +59,87 @@ def prepare_logits_processor(
     return processor_list
 
 
+class IncrementalDetokenizer:
+    """Detokenize a growing list of token ids by decoding only a small window.
+
+    Re-decoding the whole output on every step is quadratic in the output length.
+    Instead, we keep a prefix offset and a read offset into the token ids and
+    only decode the tokens after the prefix offset. The prefix tokens give the
+    tokenizer enough context to produce the right leading spaces, and text that
+    ends with an incomplete UTF-8 sequence is held back until it is complete.
+    """
+
+    # The number of prompt tokens used as decoding context for the first tokens.
+    INITIAL_PREFIX_LEN = 5
+
+    def __init__(self, tokenizer, token_ids: Optional[List[int]] = None):
+        self.tokenizer = tokenizer
+        self.reset(token_ids or [])
+
+    def reset(self, token_ids: List[int]):
+        self.token_ids = list(token_ids)
+        # The decoded text in pieces, joined when it is read
+        self.text_pieces = [self._decode(self.token_ids)]
+        self.prefix_offset = max(len(self.token_ids) - self.INITIAL_PREFIX_LEN, 0)
+        self.read_offset = len(self.token_ids)
+
+    @property
+    def text(self) -> str:
+        if len(self.text_pieces) > 1:
+            self.text_pieces = ["".join(self.text_pieces)]
+        return self.text_pieces[0]
+
+    def _decode(self, token_ids: List[int]) -> str:
+        return self.tokenizer.decode(
+            token_ids,
+            skip_special_tokens=True,
+            spaces_between_special_tokens=False,
+            clean_up_tokenization_spaces=True,
+        )
+
+    def add_tokens(self, token_ids: List[int], final: bool = False) -> str:
+        """Append new token ids and return the newly decoded text."""
+        self.token_ids.extend(token_ids)
+        prefix_text = self._decode(
+            self.token_ids[self.prefix_offset : self.read_offset]
+        )
+        new_text = self._decode(self.token_ids[self.prefix_offset :])
+        if len(new_text) <= len(prefix_text) or (
+            new_text.endswith("\ufffd") and not final
+        ):
+            # Wait for more tokens to complete the character.
+            return ""
+        delta = new_text[len(prefix_text) :]
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.token_ids)
+        self.text_pieces.append(delta)
+        return delta
+
+
+def find_stop_str(
+    output: str, stop_str, start: int, checked_len: int
+) -> Tuple[int, bool]:
+    """Search the stop strings in output[start:], skipping the text before
+    checked_len that earlier calls have already searched.
+
+    Returns the position of the first stop string found (-1 if none) and
+    whether the output ends with a prefix of a stop string.
+    """
+    if isinstance(stop_str, str):
+        stop_str = [stop_str]
+    elif not isinstance(stop_str, Iterable):
+        raise ValueError("Invalid stop field type.")
+
+    for each_stop in stop_str:
+        pos = output.find(each_stop, max(start, checked_len - len(each_stop) + 1))
+        if pos != -1:
+            return pos, False
+    for each_stop in stop_str:
+        if is_partial_stop(output, each_stop):
+            return -1, True
+    return -1, False
+
+
 @torch.inference_mode()
 def generate_stream(
     model,
@@ -67,6 +149,7 @@ def generate_stream(
     context_len: int,
     stream_interval: int = 2,
     judge_sent_end: bool = False,
+    prefix_cache: Optional[PrefixCache] = None,
 ):
     if hasattr(model, "device"):
         device = model.device
@@ -114,6 +197,29 @@ def generate_stream(
     else:
         start_ids = torch.as_tensor([input_ids], device=device)
 
+    if echo:
+        detokenizer = IncrementalDetokenizer(tokenizer, output_ids)
+        rfind_start = len_prompt
+    else:
+        detokenizer = IncrementalDetokenizer(tokenizer)
+        rfind_start = 0
+    num_detokenized = len(output_ids)
+    stop_checked_len = rfind_start
+    logprobs_start = 0 if echo else input_echo_len
+    # The logprobs of the output so far. They are yielded without copies, so
+    # they are only appended to or replaced.
+    logprob_tokens, text_offset, top_logprobs = [], [], []
+
+    # Reuse the KV state of the longest cached prompt prefix.
+    use_prefix_cache = (
+        prefix_cache is not None
+        and not model.config.is_encoder_decoder
+        and logprobs is None
+    )
+    num_cached, cached_key_values = 0, None
+    if use_prefix_cache:
+        num_cached, cached_key_values = prefix_cache.lookup(input_ids)
+
     past_key_values = out = None
     token_logprobs = [None]  # The first token has no logprobs.
     sent_interrupt = False
@@ -129,7 +235,11 @@ def generate_stream(
                 )
                 logits = model.lm_head(out[0])
             else:
-                out = model(input_ids=start_ids, use_cache=True)
+                out = model(
+                    input_ids=start_ids[:, num_cached:],
+                    past_key_values=cached_key_values,
+                    use_cache=True,
+                )
                 logits = out.logits
             past_key_values = out.past_key_values
 
@@ -142,6 +252,8 @@ def generate_stream(
                     shift_input_ids[0].tolist(), shift_logits[0]
                 ):
                     token_logprobs.append(logit[label_id])
+                # Only the output is returned
+                del token_logprobs[:logprobs_start]
         else:  # decoding
             if model.config.is_encoder_decoder:
                 out = model.decoder(
@@ -204,40 +316,27 @@ def generate_stream(
 
         # Yield the output tokens
         if i % stream_interval == 0 or i == max_new_tokens - 1 or stopped:
-            if echo:
-                tmp_output_ids = output_ids
-                rfind_start = len_prompt
-            else:
-                tmp_output_ids = output_ids[input_echo_len:]
-                rfind_start = 0
-
-            output = tokenizer.decode(
-                tmp_output_ids,
-                skip_special_tokens=True,
-                spaces_between_special_tokens=False,
-                clean_up_tokenization_spaces=True,
-            )
+            new_ids = output_ids[num_detokenized:]
+            num_detokenized = len(output_ids)
+            detokenizer.add_tokens(new_ids, final=stopped or i == max_new_tokens - 1)
+            output = detokenizer.text
+
             ret_logprobs = None
             if logprobs is not None:
+                # Only decode the tokens that are new since the last yield.
+                for token_id in output_ids[logprobs_start + len(logprob_tokens) :]:
+                    if text_offset:
+                        text_offset.append(text_offset[-1] + len(logprob_tokens[-1]))
+                    else:
+                        text_offset.append(0)
+                    logprob_tokens.append(tokenizer.decode(token_id))
+                    top_logprobs.append({})
                 ret_logprobs = {
-                    "text_offset": [],
-                    "tokens": [
-                        tokenizer.decode(token)
-                        for token in (
-                            output_ids if echo else output_ids[input_echo_len:]
-                        )
-                    ],
-                    "token_logprobs": token_logprobs
-                    if echo
-                    else token_logprobs[input_echo_len:],
-                    "top_logprobs": [{}]
-                    * len(token_logprobs if echo else token_logprobs[input_echo_len:]),
+                    "text_offset": text_offset,
+                    "tokens": logprob_tokens,
+                    "token_logprobs": token_logprobs,
+                    "top_logprobs": top_logprobs,
                 }
-                # Compute text_offset
-                curr_pos = 0
-                for text in ret_logprobs["tokens"]:
-                    ret_logprobs["text_offset"].append(curr_pos)
-                    curr_pos += len(text)
 
             # TODO: For the issue of incomplete sentences interrupting output, apply a patch and others can also modify it to a more elegant way
             if judge_sent_end and stopped and not is_sentence_complete(output):
@@ -248,29 +347,25 @@ def generate_stream(
                     output_ids.pop()
                 stopped = False
                 sent_interrupt = True
+                # Roll the detokenizer back to the modified output ids.
+                detokenizer.reset(output_ids if echo else output_ids[input_echo_len:])
+                num_detokenized = len(output_ids)
+                # Copies, since the yielded logprobs share the lists
+                num_logprobs = num_detokenized - 1 - logprobs_start
+                logprob_tokens = logprob_tokens[:num_logprobs]
+                text_offset = text_offset[:num_logprobs]
+                top_logprobs = top_logprobs[:num_logprobs]
 
             partially_stopped = False
             if stop_str:
-                if isinstance(stop_str, str):
-                    pos = output.rfind(stop_str, rfind_start)
-                    if pos != -1:
-                        output = output[:pos]
-                        stopped = True
-                    else:
-                        partially_stopped = is_partial_stop(output, stop_str)
-                elif isinstance(stop_str, Iterable):
-                    for each_stop in stop_str:
-                        pos = output.rfind(each_stop, rfind_start)
-                        if pos != -1:
-                            output = output[:pos]
-                            stopped = True
-                            break
-                        else:
-                            partially_stopped = is_partial_stop(output, each_stop)
-                            if partially_stopped:
-                                break
+                pos, partially_stopped = find_stop_str(
+                    output, stop_str, rfind_start, stop_checked_len
+                )
+                if pos != -1:
+                    output = output[:pos]
+                    stopped = True
                 else:
-                    raise ValueError("Invalid stop field type.")
+                    stop_checked_len = max(len(output), rfind_start)
 
             # Prevent yielding partial stop sequence
             if not partially_stopped:
@@ -306,6 +401,14 @@ def generate_stream(
         "finish_reason": finish_reason,
     }
 
+    if use_prefix_cache and past_key_values is not None:
+        legacy_cache = to_legacy_cache(past_key_values)
+        prefix_cache.insert(
+            output_ids[: legacy_cache[0][0].shape[2]],
+            legacy_cache,
+            get_cache_cls(past_key_values),
+        )
+
     # Clean
     del past_key_values, out
     gc.collect()
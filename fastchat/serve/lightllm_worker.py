@@ -247,6 +247,12 @@ async def api_count_token(request: Request):
     return worker.count_token(params)
 
 
+@app.post("/count_token_batch")
+async def api_count_token_batch(request: Request):
+    params = await request.json()
+    return worker.count_token_batch(params)
+
+
 @app.post("/worker_get_conv_template")
 async def api_get_conv(request: Request):
     return worker.get_conv_template()
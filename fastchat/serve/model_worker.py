@@ -3,6 +3,7 @@ A model worker that executes the model.
 """
 import argparse
 import base64
+import functools
 import gc
 import json
 import os
@@ -25,6 +26,9 @@ from fastchat.modules.exllama import ExllamaConfig
 from fastchat.modules.xfastertransformer import XftConfig
 from fastchat.modules.gptq import GptqConfig
 from fastchat.serve.base_model_worker import BaseModelWorker, app
+from fastchat.serve.continuous_batching import ContinuousBatchingEngine
+from fastchat.serve.inference import generate_stream
+from fastchat.serve.prefix_cache import PrefixCache
 from fastchat.utils import (
     build_logger,
     get_context_length,
@@ -61,6 +65,9 @@ class ModelWorker(BaseModelWorker):
         embed_in_truncate: bool = False,
         seed: Optional[int] = None,
         debug: bool = False,
+        continuous_batching: bool = False,
+        max_batch_size: int = 32,
+        prefix_cache_gb: float = 0,
         **kwargs,
     ):
         super().__init__(
@@ -98,9 +105,74 @@ class ModelWorker(BaseModelWorker):
         self.embed_in_truncate = embed_in_truncate
         self.seed = seed
 
+        # Only the default generate_stream works with the standard HF KV cache.
+        is_default_stream_func = self.generate_stream_func is generate_stream
+        self.prefix_cache = None
+        if prefix_cache_gb > 0:
+            if not is_default_stream_func:
+                logger.warning(
+                    "The prefix cache only supports models that use the default "
+                    "generate_stream. Disabling it."
+                )
+            else:
+                self.prefix_cache = PrefixCache(int(prefix_cache_gb * 2**30))
+                self.generate_stream_func = functools.partial(
+                    generate_stream, prefix_cache=self.prefix_cache
+                )
+
+        self.batch_engine = None
+        if continuous_batching:
+            if not is_default_stream_func or self.model.config.is_encoder_decoder:
+                logger.warning(
+                    "Continuous batching only supports decoder-only models that "
+                    "use the default generate_stream. Falling back to per-request "
+                    "generation."
+                )
+            else:
+                if limit_worker_concurrency < max_batch_size:
+                    logger.warning(
+                        f"--limit-worker-concurrency ({limit_worker_concurrency}) "
+                        f"is smaller than --max-batch-size ({max_batch_size}), "
+                        "so the decode batch will never be full."
+                    )
+                self.batch_engine = ContinuousBatchingEngine(
+                    self.model,
+                    self.tokenizer,
+                    device,
+                    self.context_len,
+                    stream_interval=stream_interval,
+                    max_batch_size=max_batch_size,
+                    prefix_cache=self.prefix_cache,
+                )
+
         if not no_register:
             self.init_heart_beat()
 
+    def get_status(self):
+        status = super().get_status()
+        if self.prefix_cache is not None:
+            status["prefix_cache"] = self.prefix_cache.get_stats()
+        return status
+
+    def get_model_details(self):
+        details = super().get_model_details()
+        # Requests with n > 1 share one prefill only in the batching engine.
+        details["parallel_sampling"] = self.batch_engine is not None
+        return details
+
+    def generate_samples(self, params, n):
+        """Generate the n samples of a request one after another."""
+        for i in range(n):
+            for output in self.generate_stream_func(
+                self.model,
+                self.tokenizer,
+                dict(params),
+                self.device,
+                self.context_len,
+                self.stream_interval,
+            ):
+                yield {**output, "index": i}
+
     def generate_stream_gate(self, params):
         if self.device == "npu":
             import torch_npu
@@ -108,17 +180,28 @@ class ModelWorker(BaseModelWorker):
             torch_npu.npu.set_device("npu:0")
         self.call_ct += 1
 
+        n = int(params.get("n", 1))
+        completion_tokens = [0] * n
+        finished = [False] * n
         try:
             if self.seed is not None:
                 set_seed(self.seed)
-            for output in self.generate_stream_func(
-                self.model,
-                self.tokenizer,
-                params,
-                self.device,
-                self.context_len,
-                self.stream_interval,
+            if self.batch_engine is not None and self.batch_engine.supports(
+                self.model, params
             ):
+                output_stream = self.batch_engine.generate_stream(params)
+            elif n > 1:
+                output_stream = self.generate_samples(params, n)
+            else:
+                output_stream = self.generate_stream_func(
+                    self.model,
+                    self.tokenizer,
+                    params,
+                    self.device,
+                    self.context_len,
+                    self.stream_interval,
+                )
+            for output in output_stream:
                 ret = {
                     "text": output["text"],
                     "error_code": 0,
@@ -129,7 +212,27 @@ class ModelWorker(BaseModelWorker):
                     ret["finish_reason"] = output["finish_reason"]
                 if "logprobs" in output:
                     ret["logprobs"] = output["logprobs"]
+                if "index" in output:
+                    ret["index"] = output["index"]
+                index = output.get("index", 0)
+                if "usage" in output:
+                    completion_tokens[index] = output["usage"]["completion_tokens"]
+                finished[index] = output.get("finish_reason") is not None
                 yield json.dumps(ret).encode() + b"\0"
+        except GeneratorExit:
+            # The client disconnected. Stop the decode loop right away.
+            output_stream.close()
+            if not all(finished):
+                generated_tokens = sum(
+                    num_tokens
+                    for num_tokens, done in zip(completion_tokens, finished)
+                    if not done
+                )
+                self.record_cancellation(generated_tokens)
+                logger.info(
+                    f"Request cancelled after {generated_tokens} generated tokens."
+                )
+            raise
         except torch.cuda.OutOfMemoryError as e:
             ret = {
                 "text": f"{SERVER_ERROR_MSG}\n\n({e})",
@@ -325,6 +428,26 @@ def create_model_worker():
         help="Limit the model concurrency to prevent OOM.",
     )
     parser.add_argument("--stream-interval", type=int, default=2)
+    parser.add_argument(
+        "--continuous-batching",
+        action="store_true",
+        help="Decode concurrent requests together in one iteration-level batch.",
+    )
+    parser.add_argument(
+        "--max-batch-size",
+        type=int,
+        default=32,
+        help="The maximum number of sequences in a continuous batch. "
+        "Set --limit-worker-concurrency to at least this value.",
+    )
+    parser.add_argument(
+        "--prefix-cache-gb",
+        type=float,
+        default=0,
+        help="Memory budget in GiB for reusing the KV cache of shared prompt "
+        "prefixes across requests (e.g., turns of the same conversation). "
+        "0 disables the prefix cache.",
+    )
     parser.add_argument("--no-register", action="store_true")
     parser.add_argument(
         "--seed",
@@ -406,6 +529,9 @@ def create_model_worker():
         embed_in_truncate=args.embed_in_truncate,
         seed=args.seed,
         debug=args.debug,
+        continuous_batching=args.continuous_batching,
+        max_batch_size=args.max_batch_size,
+        prefix_cache_gb=args.prefix_cache_gb,
     )
     return args, worker
 
@@ -0,0 +1,199 @@
+"""
+A columnar store for the cleaned battles.
+
+The battles are kept as Parquet files partitioned by the UTC date of the vote
+(`<root>/date=YYYY-MM-DD/*.parquet`) instead of one large JSON file. Scalar
+fields are stored natively, nested fields (the conversations, conv_metadata,
+category tags) as JSON strings in their own columns. Readers only decode the
+columns they ask for, and filters on the date or on scalar columns skip whole
+partitions and row groups, so computing a leaderboard does not need to parse
+the conversations.
+
+`load_battles` also accepts a clean battle JSON/JSONL file, so the analysis
+scripts take either. Reading a clean battle file without filters does not
+need pyarrow, so the scripts keep working with JSON files without it.
+
+Requirement:
+pip install "fschat[data]"
+
+Usage:
+python3 -m fastchat.serve.monitor.battle_store --input clean_battle_20240101.json --output battle_store
+"""
+import argparse
+import glob
+import json
+import os
+import shutil
+import uuid
+
+import pandas as pd
+
+# Column metadata marking a column that holds JSON-encoded values
+JSON_FIELD_METADATA = {b"encoding": b"json"}
+
+
+def _date_partitioning():
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    return ds.partitioning(pa.schema([("date", pa.string())]), flavor="hive")
+
+
+def _is_nested(column):
+    for value in column:
+        if value is not None and value == value:
+            return isinstance(value, (dict, list))
+    return False
+
+
+def battles_to_table(battles):
+    """Convert battles (a dataframe or a list of dicts) to an Arrow table."""
+    import pyarrow as pa
+
+    df = pd.DataFrame(battles).sort_values("tstamp", kind="stable")
+    df["date"] = pd.to_datetime(df["tstamp"], unit="s").dt.strftime("%Y-%m-%d")
+
+    json_columns = [
+        c for c in df.columns if df[c].dtype == object and _is_nested(df[c])
+    ]
+    for c in json_columns:
+        df[c] = [
+            None if x is None else json.dumps(x, ensure_ascii=False) for x in df[c]
+        ]
+    table = pa.Table.from_pandas(df, preserve_index=False)
+
+    schema = pa.schema(
+        [
+            f.with_metadata(JSON_FIELD_METADATA) if f.name in json_columns else f
+            for f in table.schema
+        ]
+    )
+    return table.cast(schema)
+
+
+def write_battles(battles, root, mode="append", write_id=None):
+    """
+    Write battles to the store at `root`.
+
+    mode="append" adds new files next to the existing ones, mode="overwrite"
+    replaces the whole store. The new files are named `part-<write_id>-<i>.parquet`
+    so a write can be found and removed with `delete_write`.
+    """
+    import pyarrow.dataset as ds
+
+    assert mode in ["append", "overwrite"], f"Invalid mode: {mode}"
+    if len(battles) == 0:
+        return
+    if mode == "overwrite" and os.path.exists(root):
+        shutil.rmtree(root)
+
+    ds.write_dataset(
+        battles_to_table(battles),
+        root,
+        format="parquet",
+        partitioning=_date_partitioning(),
+        basename_template=f"part-{write_id or uuid.uuid4().hex}-{{i}}.parquet",
+        existing_data_behavior="overwrite_or_ignore",
+    )
+
+
+def delete_write(root, write_id):
+    """Remove the files of a write that may have been interrupted."""
+    for filename in glob.glob(os.path.join(root, "*", f"part-{write_id}-*.parquet")):
+        os.remove(filename)
+
+
+def _decode_json_columns(table):
+    df = table.to_pandas()
+    for field in table.schema:
+        if field.metadata == JSON_FIELD_METADATA:
+            df[field.name] = [
+                None if x is None else json.loads(x) for x in df[field.name]
+            ]
+    return df
+
+
+def _flatten_filters(filters):
+    # filters is a list of (column, op, value) or a list of such lists
+    for f in filters:
+        if isinstance(f, tuple):
+            yield f
+        else:
+            yield from f
+
+
+def load_battles(path, columns=None, filters=None):
+    """
+    Load battles from a battle store directory or a clean battle JSON/JSONL file.
+
+    columns: the columns to read, all of them if None.
+    filters: row filters in the DNF format of `pyarrow.parquet.read_table`, e.g.
+        [("anony", "==", True), ("date", ">=", "2024-01-01")]. The store
+        pushes them down to the partitions and row groups.
+    """
+    if os.path.isdir(path):
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+        import pyarrow.parquet as pq
+
+        expression = None if filters is None else pq.filters_to_expression(filters)
+        partitioning = _date_partitioning()
+        dataset = ds.dataset(path, format="parquet", partitioning=partitioning)
+        # Later appends may have added columns, so do not take the first file's schema
+        schema = pa.unify_schemas(
+            [f.physical_schema for f in dataset.get_fragments()]
+            + [partitioning.schema]
+        )
+        dataset = ds.dataset(
+            path, schema=schema, format="parquet", partitioning=partitioning
+        )
+        # Return the battles in time order as the clean battle files do
+        read_columns = columns
+        if columns is not None and "tstamp" not in columns:
+            read_columns = columns + ["tstamp"]
+        table = dataset.to_table(columns=read_columns, filter=expression)
+        table = table.sort_by("tstamp")
+        if columns is not None:
+            table = table.select(columns)
+        return _decode_json_columns(table)
+
+    # A clean battle file
+    df = pd.read_json(
+        path, lines=path.endswith(".jsonl"), dtype=False, convert_dates=False
+    )
+    if len(df):
+        df["date"] = pd.to_datetime(df["tstamp"], unit="s").dt.strftime("%Y-%m-%d")
+    if filters is not None:
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+        import pyarrow.parquet as pq
+
+        # Evaluate the filters with Arrow so both paths share their semantics
+        expression = pq.filters_to_expression(filters)
+        names = sorted({name for name, _, _ in _flatten_filters(filters)})
+        index = pa.Table.from_pandas(
+            df[names].assign(__row=range(len(df))), preserve_index=False
+        )
+        rows = ds.dataset(index).to_table(columns=["__row"], filter=expression)
+        df = df.iloc[rows["__row"].to_numpy()].reset_index(drop=True)
+    if columns is not None:
+        df = df[columns]
+    return df
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--input", type=str, required=True, help="A clean battle JSON/JSONL file."
+    )
+    parser.add_argument(
+        "--output", type=str, required=True, help="The battle store directory."
+    )
+    parser.add_argument(
+        "--mode", type=str, choices=["append", "overwrite"], default="overwrite"
+    )
+    args = parser.parse_args()
+
+    battles = load_battles(args.input)
+    write_battles(battles, args.output, args.mode)
+    print(f"Write {len(battles)} battles to {args.output}")
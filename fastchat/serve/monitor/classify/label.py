@@ -11,6 +11,7 @@ import threading
 import orjson
 
 from category import Category
+from fastchat.serve.monitor.battle_store import load_battles
 
 
 LOCK = threading.RLock()
@@ -190,9 +191,13 @@ if __name__ == "__main__":
     )
 
     print("loading input data (might take min)")
-    with open(config["input_file"], "rb") as f:
-        data = orjson.loads(f.read())
-    input_data = pd.DataFrame(data)
+    if os.path.isdir(config["input_file"]):
+        # A battle store
+        input_data = load_battles(config["input_file"]).drop(columns=["date"])
+    else:
+        with open(config["input_file"], "rb") as f:
+            data = orjson.loads(f.read())
+        input_data = pd.DataFrame(data)
 
     # much faster than pd.apply
     input_data["uid"] = input_data.question_id.map(str) + input_data.tstamp.map(str)
@@ -17,7 +17,9 @@ import tiktoken
 from collections import Counter
 import shortuuid
 
+from fastchat.data.keyword_matcher import KeywordMatcher
 from fastchat.serve.monitor.basic_stats import get_log_files, NUM_SERVERS
+from fastchat.serve.monitor.battle_store import write_battles
 from fastchat.utils import detect_language
 
 
@@ -77,6 +79,12 @@ for i in range(len(IDENTITY_WORDS)):
 for i in range(len(ERROR_WORDS)):
     ERROR_WORDS[i] = ERROR_WORDS[i].lower()
 
+# The words and the scanned messages are already lower-cased
+KEYWORD_MATCHER = KeywordMatcher(
+    {"identity": IDENTITY_WORDS, "error": ERROR_WORDS, "unfinished": UNFINISHED_WORDS},
+    ignore_case=False,
+)
+
 
 def remove_html(raw):
     if isinstance(raw, str) and raw.startswith("<h3>"):
@@ -128,6 +136,33 @@ def read_file(filename):
     return data
 
 
+def read_new_votes(filename, offset=0):
+    """
+    Read the votes appended to a log file after byte `offset`.
+
+    Return the votes and the offset after the last complete line, so a line that
+    is still being written is read in the next call. Malformed lines are skipped.
+    """
+    data = []
+    with open(filename, "rb") as fin:
+        fin.seek(offset)
+        for l in fin:
+            if not l.endswith(b"\n"):
+                break
+            offset += len(l)
+            # Every vote type ends with "vote", skip parsing the other lines
+            if b'vote"' not in l:
+                continue
+            try:
+                row = json.loads(l)
+            except json.JSONDecodeError:
+                print(f"Error decoding json: {filename} {l}")
+                continue
+            if row["type"] in VOTES:
+                data.append(row)
+    return data, offset
+
+
 def read_file_parallel(log_files, num_threads=16):
     data_all = []
     with Pool(num_threads) as p:
@@ -224,23 +259,16 @@ def process_data(
                 else:
                     flag_none_msg = True
 
-        for word in IDENTITY_WORDS:
-            if word in messages:
-                if word not in count_leak:
-                    count_leak[word] = 0
-                count_leak[word] += 1
-                flag_leaked_identity = True
-                break
-
-        for word in ERROR_WORDS:
-            if word in messages:
-                flag_error = True
-                break
-
-        for word in UNFINISHED_WORDS:
-            if word in messages:
-                flag_unfinished = True
-                break
+        found = KEYWORD_MATCHER.count(messages)
+        if found["identity"]:
+            # Count the first leaked word only
+            word = next(iter(found["identity"]))
+            if word not in count_leak:
+                count_leak[word] = 0
+            count_leak[word] += 1
+            flag_leaked_identity = True
+        flag_error = len(found["error"]) > 0
+        flag_unfinished = len(found["unfinished"]) > 0
 
         if flag_none_msg:
             count_dict["none_msg"] += 1
@@ -314,16 +342,10 @@ def process_data(
     return battles, count_dict, count_leak, all_ips
 
 
-def clean_battle_data(
-    log_files,
-    exclude_model_names,
-    ban_ip_list=None,
-    sanitize_ip=False,
-    anony_only=False,
-    num_threads=16,
+def process_data_parallel(
+    data, exclude_model_names, sanitize_ip, ban_ip_list, num_threads=16
 ):
-    data = read_file_parallel(log_files, num_threads=16)
-
+    """Run process_data over chunks of data in a process pool and merge the results."""
     battles = []
     count_dict = {}
     count_leak = {}
@@ -351,6 +373,21 @@ def clean_battle_data(
                     all_ips[ip] = sub_all_ips[ip]
                 else:
                     all_ips[ip]["count"] += sub_all_ips[ip]["count"]
+    return battles, count_dict, count_leak, all_ips
+
+
+def clean_battle_data(
+    log_files,
+    exclude_model_names,
+    ban_ip_list=None,
+    sanitize_ip=False,
+    anony_only=False,
+    num_threads=16,
+):
+    data = read_file_parallel(log_files, num_threads=16)
+    battles, count_dict, count_leak, all_ips = process_data_parallel(
+        data, exclude_model_names, sanitize_ip, ban_ip_list, num_threads
+    )
     battles.sort(key=lambda x: x["tstamp"])
     last_updated_tstamp = battles[-1]["tstamp"]
 
@@ -382,6 +419,11 @@ if __name__ == "__main__":
     parser.add_argument("--exclude-model-names", type=str, nargs="+")
     parser.add_argument("--ban-ip-file", type=str)
     parser.add_argument("--sanitize-ip", action="store_true", default=False)
+    parser.add_argument(
+        "--store-dir",
+        type=str,
+        help="Also write all battles, with conversations, to this battle store.",
+    )
     args = parser.parse_args()
 
     log_files = get_log_files(args.max_num_files)
@@ -395,6 +437,10 @@ if __name__ == "__main__":
         last_updated_tstamp, tz=timezone("US/Pacific")
     ).strftime("%Y%m%d")
 
+    if args.store_dir:
+        write_battles(battles, args.store_dir, mode="overwrite")
+        print(f"Write {len(battles)} battles to {args.store_dir}")
+
     if args.mode == "simple":
         for x in battles:
             for key in [
@@ -12,8 +12,11 @@ import random
 
 from tqdm import tqdm
 
+from fastchat.data.keyword_matcher import KeywordMatcher
+
 BLOCKED_WORDS_FILENAME = "blocked_words.json"
 blocked_words = []
+blocked_words_matcher = KeywordMatcher({"blocked": blocked_words}, ignore_case=False)
 frequency = defaultdict(lambda: 0)
 
 
@@ -51,9 +54,8 @@ def detect_type(conv):
             if "<redacted>" in msg:
                 return TypeCode.REDACTED
 
-            for w in blocked_words:
-                if w in msg:
-                    return TypeCode.BLOCKED_WORD
+            if blocked_words_matcher.contains(msg, "blocked"):
+                return TypeCode.BLOCKED_WORD
 
     for key in ["model_a", "model_b"]:
         if conv[key] in ["vicuna-33b", "mpt-30b-chat"]:
@@ -75,6 +77,9 @@ if __name__ == "__main__":
     # Read blocked words
     if os.path.exists(BLOCKED_WORDS_FILENAME):
         blocked_words = json.load(open(BLOCKED_WORDS_FILENAME))
+        blocked_words_matcher = KeywordMatcher(
+            {"blocked": blocked_words}, ignore_case=False
+        )
 
     # Count frequency
     for conv in convs:
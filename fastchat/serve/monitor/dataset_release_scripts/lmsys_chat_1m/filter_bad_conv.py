@@ -18,8 +18,11 @@ import random
 from tqdm import tqdm
 import opencc
 
+from fastchat.data.keyword_matcher import KeywordMatcher
+
 BLOCKED_WORDS_FILENAME = "blocked_words.json"
 blocked_words = []
+blocked_words_matcher = KeywordMatcher({"blocked": blocked_words}, ignore_case=False)
 frequency = defaultdict(lambda: 0)
 
 cc_converter = opencc.OpenCC("t2s")
@@ -60,9 +63,8 @@ def detect_type(conv):
             if "<redacted>" in msg:
                 return TypeCode.REDACTED
 
-            for w in blocked_words:
-                if w in msg:
-                    return TypeCode.BLOCKED_WORD
+            if blocked_words_matcher.contains(msg, "blocked"):
+                return TypeCode.BLOCKED_WORD
 
     return TypeCode.CORRECT
 
@@ -81,6 +83,9 @@ if __name__ == "__main__":
     if os.path.exists(BLOCKED_WORDS_FILENAME):
         blocked_words = json.load(open(BLOCKED_WORDS_FILENAME))
         blocked_words = [cc_converter.convert(w) for w in blocked_words]
+        blocked_words_matcher = KeywordMatcher(
+            {"blocked": blocked_words}, ignore_case=False
+        )
 
     # Start filter
     ct_bad_format = 0
@@ -13,35 +13,37 @@ import matplotlib.pyplot as plt
 
 import numpy as np
 
+from fastchat.serve.monitor.battle_store import load_battles
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--output_dir", type=str, default="output")
     parser.add_argument("--model", type=str, default=None)
-    parser.add_argument("--input_file", type=str, required=True)
+    parser.add_argument(
+        "--input_file",
+        type=str,
+        required=True,
+        help="A clean battle JSON file or a battle store directory.",
+    )
     parser.add_argument("--percentile", type=float, default=0.9999)
     args = parser.parse_args()
     output_dir = args.output_dir
     input_file = args.input_file
 
-    with open(input_file) as f:
-        data = json.load(f)
+    df = load_battles(input_file).drop(columns=["date"])
 
     os.makedirs(output_dir, exist_ok=True)
 
     # Preprocessing
-    all_convs_new = []
     convs = []
-    for row in data:
+    for conversation in df["conversation_a"]:
         conv = ""
-        for turns in row["conversation_a"]:
+        for turns in conversation:
             if turns["role"] == "user":
                 conv += f"{turns['content']}\n"
 
         convs.append(conv[:10000])
-        row["post_process_conv"] = conv[:10000]
-        all_convs_new.append(row)
-
-    df = pd.DataFrame(all_convs_new)
+    df["post_process_conv"] = convs
     print("Number of conversations: ", len(df))
 
     prompt_counts = df["post_process_conv"].value_counts()
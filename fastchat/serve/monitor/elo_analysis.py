@@ -15,14 +15,17 @@ from tqdm import tqdm
 
 from fastchat.model.model_registry import get_model_info
 from fastchat.serve.monitor.basic_stats import get_log_files
+from fastchat.serve.monitor.battle_store import load_battles
 from fastchat.serve.monitor.clean_battle_data import clean_battle_data
 from fastchat.serve.monitor.rating_systems import (
+    add_style_features,
     compute_elo,
     compute_bt,
     compute_style_control,
     compute_bootstrap_elo,
     compute_bootstrap_bt,
     compute_bootstrap_style_control,
+    compute_sandwich_bt,
 )
 
 pd.options.display.float_format = "{:.2f}".format
@@ -63,7 +66,14 @@ def compute_pairwise_win_fraction(battles, model_order, limit_show_number=None):
     row_beats_col_freq = (a_win_ptbl + b_win_ptbl.T) / (
         num_battles_ptbl + num_battles_ptbl.T
     )
+    return order_pairwise_win_fraction(
+        row_beats_col_freq, model_order, limit_show_number
+    )
+
 
+def order_pairwise_win_fraction(
+    row_beats_col_freq, model_order, limit_show_number=None
+):
     if model_order is None:
         prop_wins = row_beats_col_freq.mean(axis=1).sort_values(ascending=False)
         model_order = list(prop_wins.keys())
@@ -100,6 +110,10 @@ def visualize_leaderboard_table(rating):
 
 def visualize_pairwise_win_fraction(battles, model_order, scale=1):
     row_beats_col = compute_pairwise_win_fraction(battles, model_order)
+    return plot_pairwise_win_fraction(row_beats_col, scale)
+
+
+def plot_pairwise_win_fraction(row_beats_col, scale=1):
     fig = px.imshow(
         row_beats_col,
         color_continuous_scale="RdBu",
@@ -125,7 +139,10 @@ def visualize_battle_count(battles, model_order, scale=1):
     ptbl = pd.pivot_table(
         battles, index="model_a", columns="model_b", aggfunc="size", fill_value=0
     )
-    battle_counts = ptbl + ptbl.T
+    return plot_battle_count(ptbl + ptbl.T, model_order, scale)
+
+
+def plot_battle_count(battle_counts, model_order, scale=1):
     fig = px.imshow(
         battle_counts.loc[model_order, model_order],
         text_auto=True,
@@ -149,6 +166,10 @@ def visualize_average_win_rate(battles, limit_show_number, scale=1):
     row_beats_col_freq = compute_pairwise_win_fraction(
         battles, None, limit_show_number=limit_show_number
     )
+    return plot_average_win_rate(row_beats_col_freq, scale)
+
+
+def plot_average_win_rate(row_beats_col_freq, scale=1):
     fig = px.bar(
         row_beats_col_freq.mean(axis=1).sort_values(ascending=False),
         text_auto=".2f",
@@ -192,47 +213,67 @@ def visualize_bootstrap_elo_rating(df, df_final, limit_show_number, scale=1):
 
 
 def limit_user_votes(battles, daily_vote_per_user):
-    from datetime import datetime
+    import time
 
     print("Before limiting user votes: ", len(battles))
-    # add date
-    battles["date"] = battles["tstamp"].apply(
-        lambda x: datetime.fromtimestamp(x).strftime("%Y-%m-%d")
-    )
-
-    battles_new = pd.DataFrame()
-    for date in battles["date"].unique():
-        # only take the first daily_vote_per_user votes per judge per day
-        df_today = battles[battles["date"] == date]
-        df_sub = df_today.groupby("judge").head(daily_vote_per_user)
-
-        # add df_sub to a new dataframe
-        battles_new = pd.concat([battles_new, df_sub])
+    # local dates as datetime.fromtimestamp gives them. The UTC offset only
+    # changes at quarter hours, so it is looked up once per quarter hour.
+    tstamp = battles["tstamp"].to_numpy(dtype=np.float64)
+    quarters, inverse = np.unique(np.floor(tstamp / 900), return_inverse=True)
+    offsets = np.array([time.localtime(q * 900).tm_gmtoff for q in quarters])
+    days = np.floor((tstamp + offsets[inverse]) / 86400).astype(np.int64)
+
+    # only take the first daily_vote_per_user votes per judge per day
+    vote_idx = battles.groupby([days, battles["judge"].to_numpy()]).cumcount()
+    keep = vote_idx.to_numpy() < daily_vote_per_user
+    days = days[keep]
+    unique_days, inverse = np.unique(days, return_inverse=True)
+    dates = pd.to_datetime(unique_days, unit="D").strftime("%Y-%m-%d").to_numpy()
+    battles_new = battles[keep].assign(date=dates[inverse])
+
+    # group the days in the order they first appear
+    day_order = pd.factorize(days)[0]
+    if np.any(np.diff(day_order) < 0):
+        battles_new = battles_new.iloc[np.argsort(day_order, kind="stable")]
     print("After limiting user votes: ", len(battles_new))
     return battles_new
 
 
-def get_model_pair_stats(battles):
-    battles["ordered_pair"] = battles.apply(
-        lambda x: tuple(sorted([x["model_a"], x["model_b"]])), axis=1
+def get_pair_votes(battles):
+    """
+    Order the two models of every battle by name and return the first models,
+    the second models and the votes for the first model (1 win, 0.5 tie, 0 loss).
+    """
+    model_a = battles["model_a"].to_numpy(dtype=object)
+    model_b = battles["model_b"].to_numpy(dtype=object)
+    winner = battles["winner"]
+    swap = (battles["model_b"] < battles["model_a"]).to_numpy()
+    first = np.where(swap, model_b, model_a)
+    second = np.where(swap, model_a, model_b)
+
+    win = ((winner == "model_a").to_numpy() & (model_a == first)) | (
+        (winner == "model_b").to_numpy() & (model_b == first)
     )
+    tie = winner.isin(["tie", "tie (bothbad)"]).to_numpy()
+    votes = np.where(tie, 0.5, np.where(win, 1.0, 0.0))
+    return first, second, votes
 
-    model_pair_stats = {}
 
-    for index, row in battles.iterrows():
-        pair = row["ordered_pair"]
-        if pair not in model_pair_stats:
-            model_pair_stats[pair] = {"win": 0, "loss": 0, "tie": 0}
-
-        if row["winner"] in ["tie", "tie (bothbad)"]:
-            model_pair_stats[pair]["tie"] += 1
-        elif row["winner"] == "model_a" and row["model_a"] == min(pair):
-            model_pair_stats[pair]["win"] += 1
-        elif row["winner"] == "model_b" and row["model_b"] == min(pair):
-            model_pair_stats[pair]["win"] += 1
-        else:
-            model_pair_stats[pair]["loss"] += 1
+def get_model_pair_stats(battles):
+    first, second, votes = get_pair_votes(battles)
+    df = pd.DataFrame({"first": first, "second": second, "votes": votes})
+    counts = (
+        df.groupby(["first", "second"], sort=False)["votes"]
+        .value_counts()
+        .unstack(fill_value=0)
+        .reindex(columns=[1.0, 0.0, 0.5], fill_value=0)
+    )
+    # in the order of first appearance
+    counts = counts.reindex(pd.MultiIndex.from_arrays([first, second]).unique())
 
+    model_pair_stats = {}
+    for pair, (win, loss, tie) in zip(counts.index, counts.to_numpy().tolist()):
+        model_pair_stats[pair] = {"win": win, "loss": loss, "tie": tie}
     return model_pair_stats
 
 
@@ -251,54 +292,59 @@ def outlier_detect(
         user_list = user_vote_cnt[user_vote_cnt >= 5].index.tolist()
     print("#User to be checked: ", len(user_list))
 
+    # the first max_vote votes of every user
+    df = battles[battles["judge"].isin(user_list)]
+    df = df[df.groupby("judge").cumcount().to_numpy() < max_vote]
+    first, second, votes = get_pair_votes(df)
+
+    # only count win and loss of the pair
+    stats = pd.DataFrame.from_dict(model_pair_stats, orient="index")
+    stats = stats.reindex(pd.MultiIndex.from_arrays([first, second]))
+    win = stats["win"].to_numpy(dtype=np.float64)
+    loss = stats["loss"].to_numpy(dtype=np.float64)
+    num = win + loss
+
+    # p_upper = P(rating <= vote), p_lower = P(rating >= vote) over the
+    # ratings [1] * win + [0] * loss of the pair
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if randomized:
+            # a tiny noise on the ratings and the vote breaks the ties between them
+            noise = np.random.uniform(-1e-5, 1e-5, len(votes))
+            q = (noise + 1e-5) / 2e-5
+            ones_below = np.random.binomial(win.astype(np.int64), q)
+            zeros_below = np.random.binomial(loss.astype(np.int64), q)
+            num_below = np.select(
+                [votes == 1, votes == 0], [loss + ones_below, zeros_below], loss
+            )
+            num_above = np.select(
+                [votes == 1, votes == 0], [win - ones_below, num - zeros_below], win
+            )
+        else:
+            num_below = np.where(votes == 1, num, loss)
+            num_above = np.where(votes == 0, num, win)
+        # a pair without wins and losses gives nan as the mean of no ratings
+        p_upper = num_below / num
+        p_lower = num_above / num
+
+        # the martingales are the running products over the votes of a user
+        factors = pd.DataFrame({"upper": 1 / (2 * p_upper), "lower": 1 / (2 * p_lower)})
+    groups = factors.groupby(df["judge"].to_numpy(), sort=False)
+    martingales = groups.cumprod()
+    # unlike np.prod, cumprod skips nan, but a nan keeps the product nan
+    seen_nan = factors.isna().any(axis=1).groupby(df["judge"].to_numpy()).cummax()
+    flagged = ~seen_nan.to_numpy() & (martingales > 1 / alpha).any(axis=1).to_numpy()
+    num_votes = groups.cumcount().to_numpy() + 1
+    first_flagged = (
+        pd.Series(num_votes[flagged], index=df["judge"].to_numpy()[flagged])
+        .groupby(level=0)
+        .min()
+    )
+
     bad_user_list = []
     for user in user_list:
-        flag = False
-        p_upper = []
-        p_lower = []
-        df_2 = battles[battles["judge"] == user]
-        for row in df_2.iterrows():
-            if len(p_upper) >= max_vote:
-                break
-
-            model_pair = tuple(sorted([row[1]["model_a"], row[1]["model_b"]]))
-
-            if row[1]["winner"] in ["tie", "tie (bothbad)"]:
-                vote = 0.5
-            elif row[1]["winner"] == "model_a" and row[1]["model_a"] == model_pair[0]:
-                vote = 1
-            elif row[1]["winner"] == "model_b" and row[1]["model_b"] == model_pair[0]:
-                vote = 1
-            else:
-                vote = 0
-
-            stats = model_pair_stats[model_pair]
-            # count all votes
-            # ratings = np.array(
-            #     [1] * stats["win"] + [0.5] * stats["tie"] + [0] * stats["loss"]
-            # )
-
-            # only count win and loss
-            ratings = np.array([1] * stats["win"] + [0] * stats["loss"])
-            if randomized:
-                noise = np.random.uniform(-1e-5, 1e-5, len(ratings))
-                ratings += noise
-                vote += np.random.uniform(-1e-5, 1e-5)
-
-            p_upper += [(ratings <= vote).mean()]
-            p_lower += [(ratings >= vote).mean()]
-
-            M_upper = np.prod(1 / (2 * np.array(p_upper)))
-            M_lower = np.prod(1 / (2 * np.array(p_lower)))
-
-            # M_upper = np.prod((1 - c_param) / (c_param * np.array(p_upper) ** c_param))
-            # M_lower = np.prod((1 - c_param) / (c_param * np.array(p_lower) ** c_param))
-            if (M_upper > 1 / alpha) or (M_lower > 1 / alpha):
-                print(f"Identify bad user with {len(p_upper)} votes")
-                flag = True
-                break
-        if flag:
-            bad_user_list.append({"user_id": user, "votes": len(p_upper)})
+        if user in first_flagged.index:
+            print(f"Identify bad user with {first_flagged[user]} votes")
+            bad_user_list.append({"user_id": user, "votes": int(first_flagged[user])})
     print("Bad user length: ", len(bad_user_list))
     print(bad_user_list)
 
@@ -332,6 +378,7 @@ def report_elo_analysis_results(
     filter_func=lambda x: True,
     style_control=False,
     num_cpu=None,
+    ci_method="bootstrap",
 ):
     battles = pd.DataFrame(battles_json)
 
@@ -377,6 +424,9 @@ def report_elo_analysis_results(
                 battles, num_round=num_bootstrap
             )
             elo_rating_final, coef_final = compute_style_control(battles)
+        elif ci_method == "sandwich":
+            bootstrap_df = compute_sandwich_bt(battles, num_round=num_bootstrap)
+            elo_rating_final = compute_bt(battles)
         else:
             bootstrap_df = compute_bootstrap_bt(
                 battles, num_round=num_bootstrap, num_cpu=num_cpu
@@ -464,6 +514,52 @@ def report_elo_analysis_results(
     }
 
 
+def report_incremental_elo_results(rating, num_bootstrap=100, scale=1, num_cpu=None):
+    """Report the results of an IncrementalBTRating as report_elo_analysis_results.
+
+    Only the counts of the rating are used, so the cost does not grow with the
+    number of votes.
+    """
+    elo_rating_final = rating.fit()
+    bootstrap_df = rating.fit_bootstrap(num_bootstrap, num_cpu)
+    row_beats_col_freq, battle_counts = rating.get_pairwise_tables()
+
+    limit_show_number = int(25 * scale)
+    model_order = list(elo_rating_final.index)[:limit_show_number]
+
+    # Plots
+    leaderboard_table = visualize_leaderboard_table(elo_rating_final)
+    win_fraction_heatmap = plot_pairwise_win_fraction(
+        order_pairwise_win_fraction(row_beats_col_freq, model_order), scale=scale
+    )
+    battle_count_heatmap = plot_battle_count(battle_counts, model_order, scale=scale)
+    average_win_rate_bar = plot_average_win_rate(
+        order_pairwise_win_fraction(row_beats_col_freq, None, limit_show_number),
+        scale=scale,
+    )
+    bootstrap_elo_rating = visualize_bootstrap_elo_rating(
+        bootstrap_df, elo_rating_final, limit_show_number, scale=scale
+    )
+
+    last_updated_tstamp = rating.last_tstamp
+    last_updated_datetime = datetime.datetime.fromtimestamp(
+        last_updated_tstamp, tz=timezone("US/Pacific")
+    ).strftime("%Y-%m-%d %H:%M:%S %Z")
+
+    return {
+        "rating_system": "bt",
+        "elo_rating_final": elo_rating_final,
+        "leaderboard_table": leaderboard_table,
+        "win_fraction_heatmap": win_fraction_heatmap,
+        "battle_count_heatmap": battle_count_heatmap,
+        "average_win_rate_bar": average_win_rate_bar,
+        "bootstrap_elo_rating": bootstrap_elo_rating,
+        "last_updated_datetime": last_updated_datetime,
+        "last_updated_tstamp": last_updated_tstamp,
+        "bootstrap_df": bootstrap_df,
+    }
+
+
 def pretty_print_elo_rating(rating):
     model_order = list(rating.keys())
     model_order.sort(key=lambda k: -rating[k])
@@ -473,7 +569,11 @@ def pretty_print_elo_rating(rating):
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("--clean-battle-file", type=str)
+    parser.add_argument(
+        "--clean-battle-file",
+        type=str,
+        help="A clean battle JSON file or a battle store directory.",
+    )
     parser.add_argument("--max-num-files", type=int)
     parser.add_argument("--num-bootstrap", type=int, default=100)
     parser.add_argument(
@@ -490,13 +590,42 @@ if __name__ == "__main__":
     parser.add_argument("--scale", type=float, default=1)
     parser.add_argument("--style-control", action="store_true")
     parser.add_argument("--num-cpu", type=int, default=12)
+    parser.add_argument(
+        "--ci-method",
+        type=str,
+        choices=["bootstrap", "sandwich"],
+        default="bootstrap",
+        help="How BT confidence intervals are computed. sandwich skips bootstrapping "
+        "and draws --num-bootstrap samples from the asymptotic normal distribution. "
+        "Style control always bootstraps.",
+    )
     args = parser.parse_args()
 
     np.random.seed(42)
 
     if args.clean_battle_file:
-        # Read data from a cleaned battle files
-        battles = pd.read_json(args.clean_battle_file)
+        # Read data from a cleaned battle files. Only anonymous votes are used and
+        # the conversations are only needed to filter long conversations.
+        columns = [
+            "model_a",
+            "model_b",
+            "winner",
+            "judge",
+            "anony",
+            "language",
+            "tstamp",
+        ]
+        if "long" in args.category:
+            columns += ["conversation_a", "conversation_b"]
+        if args.style_control:
+            # question_id identifies the battles of the cached style features
+            columns += ["conv_metadata", "question_id"]
+        battles = load_battles(
+            args.clean_battle_file, columns=columns, filters=[("anony", "==", True)]
+        )
+        if args.style_control:
+            # Parse conv_metadata once for all categories and cache the result.
+            add_style_features(battles, args.clean_battle_file.rstrip("/"))
     else:
         # Read data from all log files
         log_files = get_log_files(args.max_num_files)
@@ -529,6 +658,7 @@ if __name__ == "__main__":
             filter_func=filter_func,
             style_control=args.style_control,
             num_cpu=args.num_cpu,
+            ci_method=args.ci_method,
         )
 
     for cat in args.category:
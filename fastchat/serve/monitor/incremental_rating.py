@@ -0,0 +1,330 @@
+"""
+Incrementally updated Bradley-Terry ratings.
+
+Instead of refitting from the full battle log, the ratings are kept together
+with their sufficient statistics: the counts of every unique
+(model_a, model_b, outcome) triple, which is the weight table
+`preprocess_for_bt` builds. New votes are added to the counts and BT is refit
+warm started from the previous ratings, so a refresh costs time proportional
+to the new votes plus one small L-BFGS solve. Only the votes with a tstamp
+after the last added one minus a late window are read again, and the ids of
+the votes in that window are kept to skip the ones that were added before.
+The live leaderboard of monitor.py uses it with --incremental-dir, together
+with ingest_battle_logs.
+
+The script applies the per-battle filters of elo_analysis (anonymous votes,
+--exclude-models, --langs, --exclude-tie, --exclude-unknown-lang) to the new
+votes. The filters are kept in the state, and a run with other filters is
+rejected because it would mix two populations of votes. --daily-vote-per-user and --run-outlier-detect depend on the other votes
+of a user or a model pair, so they are not supported and need a full refit.
+
+Usage:
+python3 -m fastchat.serve.monitor.incremental_rating --state bt_state.pkl --battle-file clean_battle_new.json
+"""
+import argparse
+import math
+import pickle
+
+import numpy as np
+import pandas as pd
+
+from fastchat.serve.monitor.battle_store import load_battles
+from fastchat.serve.monitor.rating_systems import (
+    fit_bt,
+    fit_bootstrap_bt,
+    scale_and_offset,
+)
+
+# Same outcome ids as preprocess_for_bt
+OUTCOME_MODEL_B, OUTCOME_TIE, OUTCOME_MODEL_A = 0, 1, 2
+
+
+class IncrementalBTRating:
+    """BT ratings that can be updated with new votes without the old ones."""
+
+    def __init__(
+        self,
+        base=10.0,
+        scale=400.0,
+        init_rating=1000.0,
+        tol=1e-6,
+        late_window=24 * 3600,
+        filter_settings=None,
+    ):
+        self.base = base
+        self.scale = scale
+        self.init_rating = init_rating
+        self.tol = tol
+        # seconds before last_tstamp in which votes may still arrive late
+        self.late_window = late_window
+        # the keyword arguments of filter_battles for the added votes
+        self.filter_settings = filter_settings or get_filter_settings()
+
+        self.models = []
+        self.model_to_id = {}
+        # counts[a, b, outcome]: number of votes with this result
+        self.counts = np.zeros((0, 0, 3), dtype=np.int64)
+        # ratings on the natural scale from the last fit, None before fitting
+        self.ratings = None
+        self.num_battles = 0
+        self.last_tstamp = None
+        # (question_id, tstamp) of the added battles inside the late window
+        self.battle_ids = set()
+
+    def _get_model_ids(self, names):
+        """Map model names to ids, registering unseen models."""
+        new_models = [m for m in pd.unique(names) if m not in self.model_to_id]
+        if new_models:
+            for m in new_models:
+                self.model_to_id[m] = len(self.models)
+                self.models.append(m)
+            n = len(self.models)
+            counts = np.zeros((n, n, 3), dtype=np.int64)
+            old_n = self.counts.shape[0]
+            counts[:old_n, :old_n] = self.counts
+            self.counts = counts
+        return pd.Series(names).map(self.model_to_id).to_numpy()
+
+    def _window_start(self):
+        if self.last_tstamp is None:
+            return None
+        return self.last_tstamp - self.late_window
+
+    def get_filters(self):
+        """Return the load_battles filters that skip the votes added before."""
+        start = self._window_start()
+        if start is None:
+            return []
+        return [("tstamp", ">=", start)]
+
+    def add_battles(self, battles):
+        """Add the votes of a battle dataframe to the sufficient statistics.
+
+        Battles older than the late window are skipped. Inside the window,
+        battles with a (question_id, tstamp) that was added before are skipped,
+        so the votes read with `get_filters` can be passed again after new
+        votes were appended, including votes that arrived late or share a
+        tstamp with older ones.
+        """
+        start = self._window_start()
+        if start is not None and "tstamp" in battles:
+            battles = battles[(battles["tstamp"] >= start).to_numpy()]
+        if "question_id" in battles and "tstamp" in battles:
+            ids = pd.MultiIndex.from_arrays(
+                [battles["question_id"], battles["tstamp"]]
+            )
+            if self.battle_ids:
+                is_new = ~ids.isin(list(self.battle_ids))
+                battles = battles[is_new]
+                ids = ids[is_new]
+            self.battle_ids.update(ids)
+        if len(battles) == 0:
+            return
+        model_a = self._get_model_ids(battles["model_a"].to_numpy())
+        model_b = self._get_model_ids(battles["model_b"].to_numpy())
+        outcomes = np.full(len(battles), OUTCOME_TIE)
+        outcomes[(battles["winner"] == "model_a").to_numpy()] = OUTCOME_MODEL_A
+        outcomes[(battles["winner"] == "model_b").to_numpy()] = OUTCOME_MODEL_B
+
+        n = len(self.models)
+        flat_idx = (model_a * n + model_b) * 3 + outcomes
+        self.counts += np.bincount(flat_idx, minlength=n * n * 3).reshape(n, n, 3)
+        self.num_battles += len(battles)
+        if "tstamp" in battles:
+            tstamp = battles["tstamp"].max()
+            if self.last_tstamp is None or tstamp > self.last_tstamp:
+                self.last_tstamp = tstamp
+
+    def add_new_battles(self, battle_file):
+        """Read the votes of a battle file or store that may be new and add them.
+
+        The votes are filtered with the filter settings of the state. Returns
+        the number of added battles.
+        """
+        columns = ["question_id", "model_a", "model_b", "winner", "tstamp"]
+        settings = self.filter_settings
+        if settings["langs"] or settings["exclude_unknown_lang"]:
+            columns.append("language")
+        # Only read the votes after the late window and let add_battles skip
+        # the ones inside it that it has seen
+        battles = load_battles(
+            battle_file, columns, [("anony", "==", True)] + self.get_filters()
+        )
+        battles = filter_battles(battles, **settings)
+        num_battles = self.num_battles
+        self.add_battles(battles)
+        return self.num_battles - num_battles
+
+    def get_pairwise_tables(self):
+        """Return the (win fraction, battle count) tables of the votes without ties.
+
+        They are the tables elo_analysis builds with pivot tables of the battles.
+        """
+        a_wins = self.counts[:, :, OUTCOME_MODEL_A]
+        b_wins = self.counts[:, :, OUTCOME_MODEL_B]
+        num_battles = a_wins + b_wins
+        battle_counts = num_battles + num_battles.T
+        with np.errstate(divide="ignore", invalid="ignore"):
+            win_fraction = (a_wins + b_wins.T) / battle_counts
+        return (
+            pd.DataFrame(win_fraction, index=self.models, columns=self.models),
+            pd.DataFrame(battle_counts, index=self.models, columns=self.models),
+        )
+
+    def get_weight_table(self):
+        """Return the (matchups, outcomes, weights) table of preprocess_for_bt."""
+        a, b, outcome = np.nonzero(self.counts)
+        matchups = np.column_stack([a, b]).astype(np.int32)
+        outcomes = outcome.astype(np.float64) / 2.0
+        weights = self.counts[a, b, outcome].astype(np.float64)
+        return matchups, outcomes, weights
+
+    def _initial_ratings(self):
+        initial_ratings = np.zeros(len(self.models), dtype=np.float64)
+        if self.ratings is not None:
+            # models that appeared since the last fit start at 0
+            initial_ratings[: len(self.ratings)] = self.ratings
+        return initial_ratings
+
+    def fit(self):
+        """Refit BT warm started from the previous ratings and return them scaled."""
+        matchups, outcomes, weights = self.get_weight_table()
+        self.ratings = fit_bt(
+            matchups,
+            outcomes,
+            weights,
+            len(self.models),
+            math.log(self.base),
+            self.tol,
+            initial_ratings=self._initial_ratings(),
+        )
+        return self.get_ratings()
+
+    def get_ratings(self):
+        scaled_ratings = scale_and_offset(
+            self.ratings, self.models, self.scale, self.init_rating
+        )
+        return pd.Series(scaled_ratings, index=self.models).sort_values(ascending=False)
+
+    def fit_bootstrap(self, num_round, num_cpu=None):
+        """Bootstrap the ratings, warm starting every round from the last fit."""
+        if self.ratings is None or len(self.ratings) < len(self.models):
+            self.fit()
+        matchups, outcomes, weights = self.get_weight_table()
+        return fit_bootstrap_bt(
+            matchups,
+            outcomes,
+            self.models,
+            weights,
+            num_round,
+            self.base,
+            self.scale,
+            self.init_rating,
+            self.tol,
+            num_cpu,
+            initial_ratings=self.ratings,
+        )
+
+    def save(self, filename):
+        # Votes before the window are skipped by tstamp, so forget their ids
+        start = self._window_start()
+        if start is not None:
+            self.battle_ids = {i for i in self.battle_ids if i[1] >= start}
+        with open(filename, "wb") as fout:
+            pickle.dump(self.__dict__, fout)
+
+    @classmethod
+    def load(cls, filename, filter_settings=None):
+        """Load a saved state, checking that its votes were filtered the same way."""
+        with open(filename, "rb") as fin:
+            state = pickle.load(fin)
+        rating = cls()
+        rating.__dict__.update(state)
+        if filter_settings is not None and rating.filter_settings != filter_settings:
+            raise ValueError(
+                f"The filters {filter_settings} differ from the filters "
+                f"{rating.filter_settings} of {filename}. Use a new state to "
+                "change them."
+            )
+        return rating
+
+
+def get_filter_settings(
+    exclude_models=[], langs=[], exclude_tie=False, exclude_unknown_lang=False
+):
+    """Return the filter_battles keyword arguments in a comparable form."""
+    return {
+        "exclude_models": sorted(exclude_models),
+        "langs": sorted(langs),
+        "exclude_tie": exclude_tie,
+        "exclude_unknown_lang": exclude_unknown_lang,
+    }
+
+
+def filter_battles(
+    battles,
+    exclude_models=[],
+    langs=[],
+    exclude_tie=False,
+    exclude_unknown_lang=False,
+):
+    """The per-battle filters of elo_analysis.report_elo_analysis_results."""
+    if len(langs) > 0:
+        battles = battles[battles["language"].isin(langs)]
+    if exclude_unknown_lang:
+        battles = battles[~battles["language"].str.contains("unknown")]
+    battles = battles[
+        ~(
+            battles["model_a"].isin(exclude_models)
+            | battles["model_b"].isin(exclude_models)
+        )
+    ]
+    if exclude_tie:
+        battles = battles[~battles["winner"].str.contains("tie")]
+    return battles
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--state", type=str, required=True)
+    parser.add_argument(
+        "--battle-file",
+        type=str,
+        required=True,
+        help="A clean battle file or a battle store directory. Only votes that "
+        "are not in the state yet are added.",
+    )
+    parser.add_argument(
+        "--late-window",
+        type=float,
+        default=None,
+        help="Seconds before the last added vote in which late votes are still "
+        "added. Defaults to the value in the state, or one day.",
+    )
+    parser.add_argument("--exclude-models", type=str, nargs="+", default=[])
+    parser.add_argument("--exclude-tie", action="store_true", default=False)
+    parser.add_argument("--exclude-unknown-lang", action="store_true", default=False)
+    parser.add_argument("--langs", type=str, nargs="+", default=[])
+    parser.add_argument("--num-bootstrap", type=int, default=0)
+    parser.add_argument("--num-cpu", type=int, default=None)
+    args = parser.parse_args()
+
+    filter_settings = get_filter_settings(
+        args.exclude_models, args.langs, args.exclude_tie, args.exclude_unknown_lang
+    )
+    try:
+        rating = IncrementalBTRating.load(args.state, filter_settings)
+    except FileNotFoundError:
+        rating = IncrementalBTRating(filter_settings=filter_settings)
+    if args.late_window is not None:
+        rating.late_window = args.late_window
+
+    num_battles = rating.num_battles
+    num_added = rating.add_new_battles(args.battle_file)
+    print(f"Added {num_added} battles to {num_battles} battles")
+
+    print(rating.fit())
+    if args.num_bootstrap > 0:
+        bootstrap_df = rating.fit_bootstrap(args.num_bootstrap, args.num_cpu)
+        print(bootstrap_df.quantile([0.025, 0.975]).T)
+    rating.save(args.state)
@@ -0,0 +1,147 @@
+"""
+Incrementally ingest the arena vote logs into a battle store.
+
+A checkpoint keeps the byte offset up to which every log file has been read.
+Each pass only reads the lines appended since then, cleans the new votes with the
+rules of clean_battle_data in a process pool and appends the battles to the
+battle store. A pass without new logs only stats the log files.
+
+Usage:
+python3 -m fastchat.serve.monitor.ingest_battle_logs --store-dir battle_store --checkpoint ingest_checkpoint.json --interval 600
+"""
+import argparse
+import json
+import os
+from multiprocessing import Pool
+import time
+import uuid
+
+from fastchat.serve.monitor.basic_stats import get_log_files
+from fastchat.serve.monitor.battle_store import delete_write, write_battles
+from fastchat.serve.monitor.clean_battle_data import (
+    process_data_parallel,
+    read_new_votes,
+)
+
+
+def load_checkpoint(checkpoint_file):
+    if not os.path.exists(checkpoint_file):
+        return {"offsets": {}, "pending_write": None}
+    with open(checkpoint_file) as fin:
+        return json.load(fin)
+
+
+def save_checkpoint(checkpoint, checkpoint_file):
+    # Write to a temporary file first so a crash never leaves a partial checkpoint
+    tmp_file = checkpoint_file + ".tmp"
+    with open(tmp_file, "w") as fout:
+        json.dump(checkpoint, fout, indent=2)
+    os.replace(tmp_file, checkpoint_file)
+
+
+def get_new_files(log_files, offsets):
+    """Return the (filename, offset) of the log files that grew since the offsets."""
+    new_files = []
+    for filename in log_files:
+        offset = offsets.get(filename, 0)
+        size = os.path.getsize(filename)
+        if size < offset:
+            print(f"{filename} is shorter than its offset, reading it again")
+            offset = 0
+        if size > offset:
+            new_files.append((filename, offset))
+    return new_files
+
+
+def ingest_battle_logs(
+    log_files,
+    store_dir,
+    checkpoint_file,
+    exclude_model_names=[],
+    ban_ip_list=None,
+    sanitize_ip=False,
+    num_processes=16,
+):
+    """Append the battles of the newly logged votes to the store and return their number."""
+    checkpoint = load_checkpoint(checkpoint_file)
+    if checkpoint["pending_write"] is not None:
+        # The last pass stopped between writing the store and saving the offsets
+        delete_write(store_dir, checkpoint["pending_write"])
+        checkpoint["pending_write"] = None
+
+    offsets = checkpoint["offsets"]
+    new_files = get_new_files(log_files, offsets)
+    if not new_files:
+        return 0
+
+    with Pool(min(num_processes, len(new_files))) as p:
+        ret_all = p.starmap(read_new_votes, new_files)
+    data = []
+    for (filename, _), (votes, offset) in zip(new_files, ret_all):
+        data.extend(votes)
+        offsets[filename] = offset
+
+    battles = []
+    if data:
+        battles, count_dict, count_leak, _ = process_data_parallel(
+            data, exclude_model_names, sanitize_ip, ban_ip_list, num_processes
+        )
+        battles.sort(key=lambda x: x["tstamp"])
+        print(f"#new votes: {len(data)}, #new battles: {len(battles)}")
+        print(count_dict)
+        print(f"leaked_identity: {count_leak}")
+
+    if battles:
+        checkpoint["pending_write"] = write_id = uuid.uuid4().hex
+        save_checkpoint(checkpoint, checkpoint_file)
+        write_battles(battles, store_dir, mode="append", write_id=write_id)
+        checkpoint["pending_write"] = None
+    save_checkpoint(checkpoint, checkpoint_file)
+    return len(battles)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--store-dir", type=str, required=True)
+    parser.add_argument(
+        "--checkpoint",
+        type=str,
+        required=True,
+        help="A JSON file with the byte offsets of the ingested logs.",
+    )
+    parser.add_argument("--max-num-files", type=int)
+    parser.add_argument("--exclude-model-names", type=str, nargs="+")
+    parser.add_argument("--ban-ip-file", type=str)
+    parser.add_argument("--sanitize-ip", action="store_true", default=False)
+    parser.add_argument("--num-processes", type=int, default=16)
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=None,
+        help="Seconds between two passes. Run a single pass if not set.",
+    )
+    args = parser.parse_args()
+
+    ban_ip_list = json.load(open(args.ban_ip_file)) if args.ban_ip_file else None
+
+    while True:
+        tic = time.time()
+        try:
+            num_battles = ingest_battle_logs(
+                get_log_files(args.max_num_files),
+                args.store_dir,
+                args.checkpoint,
+                args.exclude_model_names or [],
+                ban_ip_list,
+                args.sanitize_ip,
+                args.num_processes,
+            )
+            print(f"Ingested {num_battles} battles in {time.time() - tic:.2f} s")
+        except Exception as e:
+            if args.interval is None:
+                raise
+            # The offsets were not advanced, so the next pass retries
+            print(f"Ingestion failed: {e}")
+        if args.interval is None:
+            break
+        time.sleep(args.interval)
@@ -0,0 +1,191 @@
+"""
+Split an elo_results pickle into small leaderboard artifacts for the monitor.
+
+The pickle written by elo_analysis holds the bootstrap samples and the plots of
+every category, and the monitor had to load all of it at startup. This script
+writes what the monitor shows, one category at a time: the leaderboard table as
+Parquet and the plots as plotly JSON, with a manifest.json listing them.
+
+load_leaderboard_artifacts returns dict-like results with the layout of the
+pickle. A category's files are only read when it is accessed, and they are
+read again after they change on disk.
+
+Usage:
+python3 -m fastchat.serve.monitor.leaderboard_artifacts --elo-results-file elo_results_20240101.pkl --output-dir leaderboard
+"""
+import argparse
+from collections import OrderedDict
+from collections.abc import Mapping
+import json
+import os
+import pickle
+
+import pandas as pd
+import plotly.io as pio
+
+PLOT_KEYS = [
+    "win_fraction_heatmap",
+    "battle_count_heatmap",
+    "bootstrap_elo_rating",
+    "average_win_rate_bar",
+]
+MANIFEST_FILE = "manifest.json"
+# The table and plots of about a dozen categories
+MAX_CACHED_FILES = 64
+
+
+def _replace_file(filename, write):
+    # Readers never see a partially written file
+    tmp_file = filename + ".tmp"
+    write(tmp_file)
+    os.replace(tmp_file, filename)
+
+
+def _write_json(obj, filename):
+    with open(filename, "w") as fout:
+        json.dump(obj, fout, indent=2)
+
+
+def _read_json(filename):
+    with open(filename) as fin:
+        return json.load(fin)
+
+
+def export_leaderboard_artifacts(elo_results, output_dir):
+    """Write the tables and plots of elo_results and their manifest to output_dir."""
+    groups = elo_results if "text" in elo_results else {"text": elo_results}
+
+    manifest = {}
+    for group, results in groups.items():
+        manifest[group] = {}
+        for category, result in results.items():
+            category_dir = os.path.join(output_dir, group, category)
+            os.makedirs(category_dir, exist_ok=True)
+            entry = {
+                "last_updated_datetime": result["last_updated_datetime"],
+                "files": {},
+            }
+
+            filename = os.path.join(group, category, "leaderboard_table_df.parquet")
+            _replace_file(
+                os.path.join(output_dir, filename),
+                result["leaderboard_table_df"].to_parquet,
+            )
+            entry["files"]["leaderboard_table_df"] = filename
+
+            for key in PLOT_KEYS:
+                if result.get(key) is None:
+                    continue
+                filename = os.path.join(group, category, f"{key}.json")
+                _replace_file(
+                    os.path.join(output_dir, filename),
+                    lambda path: pio.write_json(result[key], path),
+                )
+                entry["files"][key] = filename
+            manifest[group][category] = entry
+
+    _replace_file(
+        os.path.join(output_dir, MANIFEST_FILE),
+        lambda path: _write_json(manifest, path),
+    )
+
+
+class _FileCache:
+    """Load files on first use and reload them when their mtime changes.
+
+    Only the max_files most recently used files are kept, so the memory used
+    is bounded by the categories being viewed, not by all of them.
+    """
+
+    def __init__(self, max_files=MAX_CACHED_FILES):
+        self.max_files = max_files
+        self.cache = OrderedDict()
+
+    def load(self, filename, loader):
+        mtime = os.path.getmtime(filename)
+        entry = self.cache.get(filename)
+        if entry is None or entry[0] != mtime:
+            entry = self.cache[filename] = (mtime, loader(filename))
+        self.cache.move_to_end(filename)
+        while len(self.cache) > self.max_files:
+            self.cache.popitem(last=False)
+        return entry[1]
+
+
+def _load_table(filename):
+    return pd.read_parquet(filename)
+
+
+class CategoryArtifacts(Mapping):
+    """The results of one category, loading each artifact on access."""
+
+    def __init__(self, root, group, category, file_cache):
+        self.root = root
+        self.group = group
+        self.category = category
+        self.file_cache = file_cache
+
+    def _entry(self):
+        return _load_manifest(self.root, self.file_cache)[self.group][self.category]
+
+    def __getitem__(self, key):
+        entry = self._entry()
+        if key == "last_updated_datetime":
+            return entry["last_updated_datetime"]
+        filename = os.path.join(self.root, entry["files"][key])
+        loader = _load_table if key == "leaderboard_table_df" else pio.read_json
+        return self.file_cache.load(filename, loader)
+
+    def __iter__(self):
+        return iter(["last_updated_datetime"] + list(self._entry()["files"]))
+
+    def __len__(self):
+        return 1 + len(self._entry()["files"])
+
+
+class GroupArtifacts(Mapping):
+    """The categories of one group ("text" or "vision")."""
+
+    def __init__(self, root, group, file_cache):
+        self.root = root
+        self.group = group
+        self.file_cache = file_cache
+
+    def _categories(self):
+        return _load_manifest(self.root, self.file_cache)[self.group]
+
+    def __getitem__(self, category):
+        if category not in self._categories():
+            raise KeyError(category)
+        return CategoryArtifacts(self.root, self.group, category, self.file_cache)
+
+    def __iter__(self):
+        return iter(self._categories())
+
+    def __len__(self):
+        return len(self._categories())
+
+
+def _load_manifest(root, file_cache):
+    return file_cache.load(os.path.join(root, MANIFEST_FILE), _read_json)
+
+
+def load_leaderboard_artifacts(root, max_cached_files=MAX_CACHED_FILES):
+    """Return {group: {category: results}} backed by the artifacts in root."""
+    file_cache = _FileCache(max_cached_files)
+    return {
+        group: GroupArtifacts(root, group, file_cache)
+        for group in _load_manifest(root, file_cache)
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--elo-results-file", type=str, required=True)
+    parser.add_argument("--output-dir", type=str, required=True)
+    args = parser.parse_args()
+
+    with open(args.elo_results_file, "rb") as fin:
+        elo_results = pickle.load(fin)
+    export_leaderboard_artifacts(elo_results, args.output_dir)
+    print(f"Write leaderboard artifacts to {args.output_dir}")
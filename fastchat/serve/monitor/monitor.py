@@ -21,7 +21,16 @@ import numpy as np
 from fastchat.constants import SURVEY_LINK
 from fastchat.serve.monitor.basic_stats import report_basic_stats, get_log_files
 from fastchat.serve.monitor.clean_battle_data import clean_battle_data
-from fastchat.serve.monitor.elo_analysis import report_elo_analysis_results
+from fastchat.serve.monitor.elo_analysis import (
+    report_elo_analysis_results,
+    report_incremental_elo_results,
+)
+from fastchat.serve.monitor.incremental_rating import (
+    IncrementalBTRating,
+    get_filter_settings,
+)
+from fastchat.serve.monitor.ingest_battle_logs import ingest_battle_logs
+from fastchat.serve.monitor.leaderboard_artifacts import load_leaderboard_artifacts
 from fastchat.utils import build_logger, get_window_url_params_js
 
 
@@ -78,24 +87,60 @@ We prompt GPT-4-Turbo as judge to compare the models' responses against a baseli
     return arena_hard_title
 
 
+def update_incremental_elo_results(
+    log_files, incremental_dir, ban_ip_list, exclude_model_names
+):
+    """Ingest the new votes and add them to the BT state kept in incremental_dir.
+
+    Returns None if there are no battles yet.
+    """
+    store_dir = os.path.join(incremental_dir, "battle_store")
+    ingest_battle_logs(
+        log_files,
+        store_dir,
+        os.path.join(incremental_dir, "ingest_checkpoint.json"),
+        exclude_model_names or [],
+        ban_ip_list,
+    )
+
+    state_file = os.path.join(incremental_dir, "bt_state.pkl")
+    try:
+        rating = IncrementalBTRating.load(state_file, get_filter_settings())
+    except FileNotFoundError:
+        rating = IncrementalBTRating()
+    if os.path.isdir(store_dir):
+        rating.add_new_battles(store_dir)
+    if rating.num_battles == 0:
+        return None
+    elo_results = report_incremental_elo_results(rating, scale=2)
+    rating.save(state_file)
+    return elo_results
+
+
 def update_elo_components(
-    max_num_files, elo_results_file, ban_ip_file, exclude_model_names
+    max_num_files, elo_results_file, ban_ip_file, exclude_model_names, incremental_dir
 ):
     log_files = get_log_files(max_num_files)
 
     # Leaderboard
     if elo_results_file is None:  # Do live update
         ban_ip_list = json.load(open(ban_ip_file)) if ban_ip_file else None
-        battles = clean_battle_data(
-            log_files, exclude_model_names, ban_ip_list=ban_ip_list
-        )
-        elo_results = report_elo_analysis_results(battles, scale=2)
+        if incremental_dir is not None:
+            elo_results = update_incremental_elo_results(
+                log_files, incremental_dir, ban_ip_list, exclude_model_names
+            )
+        else:
+            battles = clean_battle_data(
+                log_files, exclude_model_names, ban_ip_list=ban_ip_list
+            )
+            elo_results = report_elo_analysis_results(battles, scale=2)
 
-        leader_component_values[0] = make_leaderboard_md_live(elo_results)
-        leader_component_values[1] = elo_results["win_fraction_heatmap"]
-        leader_component_values[2] = elo_results["battle_count_heatmap"]
-        leader_component_values[3] = elo_results["bootstrap_elo_rating"]
-        leader_component_values[4] = elo_results["average_win_rate_bar"]
+        if elo_results is not None:
+            leader_component_values[0] = make_leaderboard_md_live(elo_results)
+            leader_component_values[1] = elo_results["win_fraction_heatmap"]
+            leader_component_values[2] = elo_results["battle_count_heatmap"]
+            leader_component_values[3] = elo_results["bootstrap_elo_rating"]
+            leader_component_values[4] = elo_results["average_win_rate_bar"]
 
     # Basic stats
     basic_stats = report_basic_stats(log_files)
@@ -122,12 +167,21 @@ def update_elo_components(
 
 
 def update_worker(
-    max_num_files, interval, elo_results_file, ban_ip_file, exclude_model_names
+    max_num_files,
+    interval,
+    elo_results_file,
+    ban_ip_file,
+    exclude_model_names,
+    incremental_dir,
 ):
     while True:
         tic = time.time()
         update_elo_components(
-            max_num_files, elo_results_file, ban_ip_file, exclude_model_names
+            max_num_files,
+            elo_results_file,
+            ban_ip_file,
+            exclude_model_names,
+            incremental_dir,
         )
         durtaion = time.time() - tic
         print(f"update duration: {durtaion:.2f} s")
@@ -435,48 +489,47 @@ def build_arena_tab(
         )
         return
 
-    arena_dfs = {}
     category_elo_results = {}
     last_updated_time = elo_results["full"]["last_updated_datetime"].split(" ")[0]
 
+    # The results are looked up on every update, so artifacts loaded with
+    # load_leaderboard_artifacts are only read for the categories being shown
     for k in key_to_category_name.keys():
         if k not in elo_results:
             continue
-        arena_dfs[key_to_category_name[k]] = elo_results[k]["leaderboard_table_df"]
         category_elo_results[key_to_category_name[k]] = elo_results[k]
 
-    arena_df = arena_dfs["Overall"]
+    def get_arena_df(category):
+        return category_elo_results[category]["leaderboard_table_df"]
 
-    arena_overall_sc_df = None
-    if "Overall w/ Style Control" in arena_dfs:
-        arena_overall_sc_df = arena_dfs[
-            "Overall w/ Style Control"
-        ]  # for incorporating style control on the overall leaderboard
-        arena_overall_sc_df = arena_overall_sc_df[
-            arena_overall_sc_df["num_battles"] > 300
-        ]
+    def get_arena_overall_sc_df():
+        # for incorporating style control on the overall leaderboard
+        if "Overall w/ Style Control" not in category_elo_results:
+            return None
+        arena_overall_sc_df = get_arena_df("Overall w/ Style Control")
+        return arena_overall_sc_df[arena_overall_sc_df["num_battles"] > 300]
 
     def update_leaderboard_and_plots(category, filters):
         if len(filters) > 0 and "Style Control" in filters:
             cat_name = f"{category} w/ Style Control"
-            if cat_name in arena_dfs:
+            if cat_name in category_elo_results:
                 category = cat_name
             else:
                 gr.Warning("This category does not support style control.")
 
-        arena_subset_df = arena_dfs[category]
+        arena_subset_df = get_arena_df(category)
         arena_subset_df = arena_subset_df[arena_subset_df["num_battles"] > 300]
 
         elo_subset_results = category_elo_results[category]
 
         baseline_category = cat_name_to_baseline.get(category, "Overall")
-        arena_df = arena_dfs[baseline_category]
+        arena_df = get_arena_df(baseline_category)
         arena_values = get_arena_table(
             arena_df,
             model_table_df,
             arena_subset_df=arena_subset_df
             if category != "Overall"
-            else arena_overall_sc_df,
+            else get_arena_overall_sc_df(),
             hidden_models=(
                 None
                 if len(filters) > 0 and "Show Deprecated" in filters
@@ -558,7 +611,7 @@ def build_arena_tab(
         )
         return arena_values, p1, p2, p3, p4, more_stats_md, leaderboard_md
 
-    arena_df = arena_dfs["Overall"]
+    arena_df = get_arena_df("Overall")
 
     p1 = category_elo_results["Overall"]["win_fraction_heatmap"]
     p2 = category_elo_results["Overall"]["battle_count_heatmap"]
@@ -570,7 +623,7 @@ def build_arena_tab(
         arena_df,
         model_table_df,
         hidden_models=deprecated_model_name,
-        arena_subset_df=arena_overall_sc_df,
+        arena_subset_df=get_arena_overall_sc_df(),
         is_overall=True,
     )
 
@@ -578,7 +631,7 @@ def build_arena_tab(
     gr.Markdown(md, elem_id="leaderboard_markdown")
 
     # only keep category without style control
-    category_choices = list(arena_dfs.keys())
+    category_choices = list(category_elo_results.keys())
     category_choices = [x for x in category_choices if "Style Control" not in x]
 
     with gr.Row():
@@ -801,7 +854,7 @@ def get_arena_category_table(results_df, categories, metric="ranking"):
 def build_category_leaderboard_tab(
     combined_elo_df, title, categories, categories_width
 ):
-    full_table_vals = get_arena_category_table(combined_elo_df, categories)
+    # Both orders are built once and shared by all the sessions
     ranking_table_vals = get_arena_category_table(combined_elo_df, categories)
     rating_table_vals = get_arena_category_table(combined_elo_df, categories, "rating")
     with gr.Row():
@@ -810,10 +863,8 @@ def build_category_leaderboard_tab(
         )
         ranking_button = gr.Button("Sort by Rank")
         rating_button = gr.Button("Sort by Arena Score")
-        sort_rating = lambda _: get_arena_category_table(
-            combined_elo_df, categories, "rating"
-        )
-        sort_ranking = lambda _: get_arena_category_table(combined_elo_df, categories)
+        sort_rating = lambda _: rating_table_vals
+        sort_ranking = lambda _: ranking_table_vals
     with gr.Row():
         gr.Markdown(
             f"""&emsp; <span style='font-weight: bold; font-size: 150%;'>Chatbot Arena Overview</span>"""
@@ -822,7 +873,7 @@ def build_category_leaderboard_tab(
     overall_ranking_leaderboard = gr.Dataframe(
         headers=["Model"] + [key_to_category_name[k] for k in categories],
         datatype=["markdown"] + ["str" for k in categories],
-        value=full_table_vals,
+        value=ranking_table_vals,
         elem_id="full_leaderboard_dataframe",
         column_widths=[150]
         + categories_width,  # IMPORTANT: THIS IS HARDCODED WITH THE CURRENT CATEGORIES
@@ -911,11 +962,14 @@ def build_leaderboard_tab(
         default_md = "Loading ..."
         p1 = p2 = p3 = p4 = None
     else:
-        with open(elo_results_file, "rb") as fin:
-            elo_results = pickle.load(fin)
+        if os.path.isdir(elo_results_file):
+            elo_results = load_leaderboard_artifacts(elo_results_file)
+        else:
+            with open(elo_results_file, "rb") as fin:
+                elo_results = pickle.load(fin)
         if "text" in elo_results:
             elo_results_text = elo_results["text"]
-            elo_results_vision = elo_results["vision"]
+            elo_results_vision = elo_results.get("vision")
         else:
             elo_results_text = elo_results
             elo_results_vision = None
@@ -1122,12 +1176,24 @@ if __name__ == "__main__":
     parser.add_argument("--concurrency-count", type=int, default=10)
     parser.add_argument("--update-interval", type=int, default=300)
     parser.add_argument("--max-num-files", type=int)
-    parser.add_argument("--elo-results-file", type=str)
+    parser.add_argument(
+        "--elo-results-file",
+        type=str,
+        help="An elo_results pickle, or a directory written by leaderboard_artifacts.py whose categories are loaded on demand.",
+    )
     parser.add_argument("--leaderboard-table-file", type=str)
     parser.add_argument("--ban-ip-file", type=str)
     parser.add_argument("--exclude-model-names", type=str, nargs="+")
     parser.add_argument("--password", type=str, default=None, nargs="+")
     parser.add_argument("--arena-hard-leaderboard", type=str, default=None)
+    parser.add_argument(
+        "--incremental-dir",
+        type=str,
+        default=None,
+        help="Update the live leaderboard incrementally. The directory keeps a "
+        "battle store, its ingestion checkpoint and the BT state, so a refresh "
+        "only reads the new votes.",
+    )
     args = parser.parse_args()
 
     logger = build_logger("monitor", "monitor.log")
@@ -1142,6 +1208,7 @@ if __name__ == "__main__":
                 args.elo_results_file,
                 args.ban_ip_file,
                 args.exclude_model_names,
+                args.incremental_dir,
             ),
         )
         update_thread.start()
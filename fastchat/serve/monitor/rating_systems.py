@@ -1,10 +1,12 @@
+import hashlib
 import os
 import math
 import multiprocessing as mp
 from functools import partial
 import numpy as np
-from scipy.special import expit
+from scipy.special import expit, log_expit
 from scipy.optimize import minimize
+from scipy import sparse
 import pandas as pd
 from tqdm import tqdm
 
@@ -62,6 +64,78 @@ def preprocess_for_bt(df):
     return matchups, outcomes, models, weights
 
 
+def extract_style_features(conv_metadata, style_elements=STYLE_CONTROL_ELEMENTS_V1):
+    """materialize the style elements of every conv_metadata dict as an int64 (N, len(style_elements)) matrix"""
+    # elements are either counts or dicts of counts (e.g. per header level)
+    rows = [
+        [
+            val if isinstance(val, int) else sum(val.values())
+            for val in map(m.get, style_elements)
+        ]
+        for m in conv_metadata
+    ]
+    return np.array(rows, dtype=np.int64).reshape(len(rows), len(style_elements))
+
+
+def _get_last_modified(path):
+    """The mtime of a file, or the newest one in a directory such as a battle store."""
+    mtime = os.path.getmtime(path)
+    if os.path.isdir(path):
+        # Directories are included, so deleted files are noticed as well
+        for dirpath, dirnames, filenames in os.walk(path):
+            for name in dirnames + filenames:
+                mtime = max(mtime, os.path.getmtime(os.path.join(dirpath, name)))
+    return mtime
+
+
+def _hash_battle_ids(battles):
+    """A hash of which battles are in battles and in what order."""
+    digest = hashlib.sha1(battles["tstamp"].to_numpy(dtype=np.float64).tobytes())
+    if "question_id" in battles:
+        digest.update("\n".join(battles["question_id"].astype(str)).encode())
+    return digest.hexdigest()
+
+
+def add_style_features(
+    battles, battle_file=None, style_elements=STYLE_CONTROL_ELEMENTS_V1
+):
+    """
+    add the style elements as integer columns of battles, which preprocess_for_style uses instead
+    of parsing conv_metadata, so every category filtered from battles reuses them
+    with battle_file, the matrix is cached next to it and reused for the same battles, identified
+    by their tstamp and question_id, while it is newer than the file, or than every file of a
+    battle store directory
+    """
+    if battle_file is not None:
+        battle_file = battle_file.rstrip("/")
+    cache_file = None if battle_file is None else battle_file + ".style.npz"
+    features = None
+    if cache_file is not None:
+        battle_ids = _hash_battle_ids(battles)
+        if os.path.exists(cache_file):
+            if os.path.getmtime(cache_file) >= _get_last_modified(battle_file):
+                cache = np.load(cache_file)
+                same_elements = list(cache["style_elements"]) == list(style_elements)
+                same_battles = (
+                    "battle_ids" in cache.files
+                    and str(cache["battle_ids"]) == battle_ids
+                )
+                if same_elements and same_battles:
+                    features = cache["features"]
+    if features is None:
+        features = extract_style_features(battles["conv_metadata"], style_elements)
+        if cache_file is not None:
+            np.savez(
+                cache_file,
+                features=features,
+                style_elements=np.array(style_elements),
+                battle_ids=np.array(battle_ids),
+            )
+    for idx, element in enumerate(style_elements):
+        battles[element] = features[:, idx]
+    return battles
+
+
 def preprocess_for_style(
     df,
     apply_ratio=[1, 1, 1, 1],
@@ -72,21 +146,13 @@ def preprocess_for_style(
         df
     )  # this can use the same preprocessing as Elo
 
-    n = matchups.shape[0]
     k = int(len(style_elements) / 2)
 
-    def extract_style_feature(x, feature):
-        val = x[feature]
-        if isinstance(val, int):
-            return val
-        else:
-            return sum(val.values())
-
-    style_vector = np.zeros(shape=(2 * k, n), dtype=np.int32)
-    for idx, element in enumerate(style_elements):
-        style_vector[idx, :] = df.conv_metadata.map(
-            partial(extract_style_feature, feature=element)
-        ).values
+    if all(element in df.columns for element in style_elements):
+        # materialized by add_style_features
+        style_vector = df[style_elements].to_numpy(dtype=np.int64).T
+    else:
+        style_vector = extract_style_features(df.conv_metadata, style_elements).T
     style_vector = np.ascontiguousarray(style_vector)
 
     style_diff = (style_vector[:k] - style_vector[k:]).astype(float)
@@ -171,18 +237,20 @@ def bt_loss_and_grad(ratings, matchups, outcomes, weights, alpha=1.0):
         (np.log(probs) * outcomes + np.log(1.0 - probs) * (1.0 - outcomes)) * weights
     ).sum()
     matchups_grads = -alpha * (outcomes - probs) * weights
-    model_grad = np.zeros_like(ratings)
     # aggregate gradients at the model level using the indices in matchups
-    np.add.at(
-        model_grad,
-        matchups[:, [0, 1]],
-        matchups_grads[:, None] * np.array([1.0, -1.0], dtype=np.float64),
-    )
+    n_models = len(ratings)
+    model_grad = np.bincount(
+        matchups[:, 0], weights=matchups_grads, minlength=n_models
+    ) - np.bincount(matchups[:, 1], weights=matchups_grads, minlength=n_models)
     return loss, model_grad
 
 
-def fit_bt(matchups, outcomes, weights, n_models, alpha, tol=1e-6):
-    initial_ratings = np.zeros(n_models, dtype=np.float64)
+def fit_bt(
+    matchups, outcomes, weights, n_models, alpha, tol=1e-6, initial_ratings=None
+):
+    """fit BT ratings, optionally warm started from the ratings of a previous fit"""
+    if initial_ratings is None:
+        initial_ratings = np.zeros(n_models, dtype=np.float64)
     result = minimize(
         fun=bt_loss_and_grad,
         x0=initial_ratings,
@@ -194,6 +262,113 @@ def fit_bt(matchups, outcomes, weights, n_models, alpha, tol=1e-6):
     return result["x"]
 
 
+# added to the diagonal of the Newton hessians, far below the curvature of any battle
+NEWTON_RIDGE = 1e-10
+
+
+def bt_hessian(matchups, curvatures, n_models):
+    """
+    sum the per-matchup curvatures into one (n_models, n_models) matrix per row of curvatures
+      curvatures: float64 (R, M), the second derivative of the loss w.r.t. each matchup logit
+    """
+    num_rows = curvatures.shape[0]
+    offsets = np.arange(num_rows)[:, None] * n_models * n_models
+    idxs = (offsets + matchups[:, 0] * n_models + matchups[:, 1]).ravel()
+    # pair[r, a, b]: the total curvature of the matchups of a against b
+    pair = np.bincount(
+        idxs, weights=curvatures.ravel(), minlength=num_rows * n_models * n_models
+    ).reshape(num_rows, n_models, n_models)
+    # each matchup adds c to (a, a) and (b, b) and subtracts c from (a, b) and (b, a)
+    pair += pair.transpose(0, 2, 1)
+    hess = -pair
+    diag = np.arange(n_models)
+    hess[:, diag, diag] += pair.sum(axis=2)
+    return hess
+
+
+def fit_bt_batched(
+    matchups,
+    outcomes,
+    weights,
+    n_models,
+    alpha,
+    tol=1e-6,
+    max_iter=100,
+    initial_ratings=None,
+):
+    """
+    fit BT ratings for every row of weights (R, M) at once with Newton's method
+    the loss only depends on rating differences, so Newton steps are taken with zero sum,
+    which keeps the mean of the initial ratings just like L-BFGS in fit_bt does
+    """
+    num_rows = weights.shape[0]
+    if initial_ratings is None:
+        initial_ratings = np.zeros(n_models, dtype=np.float64)
+    ratings = np.tile(initial_ratings, (num_rows, 1))
+    a, b = matchups[:, 0], matchups[:, 1]
+    row_offsets = np.arange(num_rows)[:, None] * n_models
+    idxs_a, idxs_b = (row_offsets + a).ravel(), (row_offsets + b).ravel()
+    # adding the all-ones matrix makes the hessian invertible without changing the
+    # step, since the gradient always sums to zero, as long as every model has a battle
+    # and the battle graph is connected. bootstrap rows break both for rare models, so a
+    # tiny ridge keeps the system solvable and gives the models without battles no step
+    ones = np.ones((n_models, n_models)) + NEWTON_RIDGE * np.eye(n_models)
+
+    def batched_loss(ratings):
+        logits = alpha * (ratings[:, a] - ratings[:, b])
+        # log(1 - expit(x)) = log(expit(x)) - x
+        return -((log_expit(logits) - (1.0 - outcomes) * logits) * weights).sum(axis=1)
+
+    loss = batched_loss(ratings)
+    for _ in range(max_iter):
+        probs = expit(alpha * (ratings[:, a] - ratings[:, b]))
+        matchups_grads = (-alpha * (outcomes - probs) * weights).ravel()
+        grad = np.bincount(
+            idxs_a, weights=matchups_grads, minlength=num_rows * n_models
+        ) - np.bincount(idxs_b, weights=matchups_grads, minlength=num_rows * n_models)
+        grad = grad.reshape(num_rows, n_models)
+        if np.abs(grad).max() < tol:
+            break
+
+        hess = bt_hessian(
+            matchups, alpha**2 * probs * (1.0 - probs) * weights, n_models
+        )
+        step = np.linalg.solve(hess + ones, -grad[:, :, None])[:, :, 0]
+        # backtrack where a full step does not decrease the loss, which only happens
+        # far from the optimum, e.g. for models that won or lost all their battles
+        step_size = np.ones(num_rows)
+        for _ in range(20):
+            new_ratings = ratings + step_size[:, None] * step
+            new_loss = batched_loss(new_ratings)
+            worse = new_loss > loss + 1e-12 * np.abs(loss)
+            if not worse.any():
+                break
+            step_size[worse] /= 2
+        # rows that still do not decrease keep their ratings
+        ratings = np.where(worse[:, None], ratings, new_ratings)
+        loss = np.where(worse, loss, new_loss)
+    return ratings
+
+
+def bt_sandwich_covariance(ratings, matchups, outcomes, weights, alpha):
+    """
+    the robust (sandwich) covariance H^-1 B H^-1 of the BT ratings fit on the counts in weights
+    B sums the outer products of the per-battle gradients, so ties and model misspecification
+    are accounted for like in the bootstrap
+    """
+    probs = expit(alpha * (ratings[matchups[:, 0]] - ratings[matchups[:, 1]]))
+    n_models = len(ratings)
+    hess = bt_hessian(
+        matchups, (alpha**2 * probs * (1.0 - probs) * weights)[None], n_models
+    )[0]
+    meat = bt_hessian(
+        matchups, (alpha**2 * (outcomes - probs) ** 2 * weights)[None], n_models
+    )[0]
+    # the ratings are only identified up to a shift, so use the zero sum gauge
+    hess_inv = np.linalg.pinv(hess)
+    return hess_inv @ meat @ hess_inv
+
+
 def scale_and_offset(
     ratings,
     models,
@@ -225,32 +400,118 @@ def compute_bootstrap_bt(
     init_rating=1000.0,
     tol=1e-6,
     num_cpu=None,
+    solver="newton",
 ):
     matchups, outcomes, models, weights = preprocess_for_bt(battles)
+    return fit_bootstrap_bt(
+        matchups,
+        outcomes,
+        models,
+        weights,
+        num_round,
+        base,
+        scale,
+        init_rating,
+        tol,
+        num_cpu,
+        solver=solver,
+    )
+
+
+def fit_bootstrap_bt(
+    matchups,
+    outcomes,
+    models,
+    weights,
+    num_round,
+    base=10.0,
+    scale=400.0,
+    init_rating=1000.0,
+    tol=1e-6,
+    num_cpu=None,
+    initial_ratings=None,
+    solver="newton",
+):
+    """
+    bootstrap BT ratings from the unique (matchup, outcome) table built by preprocess_for_bt
+    solver="newton" fits all rounds at once in a single process, "lbfgs" fits one round per
+    call of fit_bt over a multiprocessing pool
+    """
+    num_battles = int(weights.sum())
     # bootstrap sample the unique outcomes and their counts directly using the multinomial distribution
     rng = np.random.default_rng(seed=0)
     idxs = rng.multinomial(
-        n=len(battles), pvals=weights / weights.sum(), size=(num_round)
+        n=num_battles, pvals=weights / weights.sum(), size=(num_round)
     )
     # only the distribution over their occurance counts changes between samples (and it can be 0)
-    boot_weights = idxs.astype(np.float64) / len(battles)
-
-    # the only thing different across samples is the distribution of weights
-    bt_fn = partial(
-        fit_bt, matchups, outcomes, n_models=len(models), alpha=np.log(base), tol=tol
-    )
-    with mp.Pool(num_cpu if num_cpu else os.cpu_count()) as pool:
-        results = list(tqdm(pool.imap_unordered(bt_fn, boot_weights), total=num_round))
-
-    ratings = np.array(results)
+    boot_weights = idxs.astype(np.float64) / num_battles
+
+    if solver == "newton":
+        ratings = fit_bt_batched(
+            matchups,
+            outcomes,
+            boot_weights,
+            len(models),
+            np.log(base),
+            tol,
+            initial_ratings=initial_ratings,
+        )
+    else:
+        # the only thing different across samples is the distribution of weights
+        bt_fn = partial(
+            fit_bt,
+            matchups,
+            outcomes,
+            n_models=len(models),
+            alpha=np.log(base),
+            tol=tol,
+            initial_ratings=initial_ratings,
+        )
+        with mp.Pool(num_cpu if num_cpu else os.cpu_count()) as pool:
+            results = list(
+                tqdm(pool.imap_unordered(bt_fn, boot_weights), total=num_round)
+            )
+        ratings = np.array(results)
     scaled_ratings = scale_and_offset(ratings, models, scale, init_rating)
     df = pd.DataFrame(scaled_ratings, columns=models)
     return df[df.median().sort_values(ascending=False).index]
 
 
-DIFF_MASK = np.array(
-    [1.0, -1.0], dtype=np.float64
-)  # create globally to not incur the instantiation cost in each call
+def compute_sandwich_bt(
+    battles, num_round, base=10.0, scale=400.0, init_rating=1000.0, tol=1e-6
+):
+    matchups, outcomes, models, weights = preprocess_for_bt(battles)
+    return fit_sandwich_bt(
+        matchups, outcomes, models, weights, num_round, base, scale, init_rating, tol
+    )
+
+
+def fit_sandwich_bt(
+    matchups,
+    outcomes,
+    models,
+    weights,
+    num_round,
+    base=10.0,
+    scale=400.0,
+    init_rating=1000.0,
+    tol=1e-6,
+):
+    """
+    confidence intervals from the sandwich covariance of a single BT fit instead of bootstrapping
+    returns num_round draws from the asymptotic normal distribution of the ratings, in the same
+    format as fit_bootstrap_bt so quantiles and plots work unchanged
+    """
+    alpha = np.log(base)
+    ratings = fit_bt_batched(
+        matchups, outcomes, (weights / weights.sum())[None], len(models), alpha, tol
+    )[0]
+    cov = bt_sandwich_covariance(ratings, matchups, outcomes, weights, alpha)
+    rng = np.random.default_rng(seed=0)
+    samples = rng.multivariate_normal(ratings, cov, size=num_round, method="eigh")
+    scaled_ratings = scale_and_offset(samples, models, scale, init_rating)
+    df = pd.DataFrame(scaled_ratings, columns=models)
+    return df[df.median().sort_values(ascending=False).index]
 
 
 def contextual_bt_loss_and_grad(
@@ -281,9 +542,9 @@ def contextual_bt_loss_and_grad(
     error = outcomes - probs
     grad = reg * params  # initialize the grad as the regularization grad
     matchups_grads = -alpha * error
-    np.add.at(
-        grad[:n_competitors], matchups[:, [0, 1]], matchups_grads[:, None] * DIFF_MASK
-    )
+    grad[:n_competitors] += np.bincount(
+        matchups[:, 0], weights=matchups_grads, minlength=n_competitors
+    ) - np.bincount(matchups[:, 1], weights=matchups_grads, minlength=n_competitors)
     grad[n_competitors:] -= np.dot(features.T, error)
     return loss, grad
 
@@ -323,6 +584,122 @@ def fit_contextual_bt(
     return result["x"]
 
 
+def fit_contextual_bt_batched(
+    matchups,
+    features,
+    outcomes,
+    n_models,
+    weights,
+    alpha=math.log(10.0),
+    reg=0.5,
+    tol=1e-6,
+    max_iter=100,
+):
+    """
+    fit contextual BT for every row of weights (R, N) at once with Newton's method
+    a row of weights holds how often each battle is repeated, so the counts of a bootstrap
+    sample give the same fit as fit_contextual_bt on its idxs
+    """
+    n_battles, n_features = features.shape
+    n_params = n_models + n_features
+    # per-battle arrays are laid out (N, R) so that every sum over battles is one sparse or
+    # dense matmul over all the rows of weights
+    weights = np.ascontiguousarray(weights.T)
+    num_rows = weights.shape[1]
+    outcomes = outcomes[:, None]
+
+    rows = np.arange(n_battles)
+    a, b = matchups[:, 0], matchups[:, 1]
+    # +1 for model_a and -1 for model_b of every battle
+    diff = sparse.csr_matrix(
+        (
+            np.repeat([1.0, -1.0], n_battles),
+            (np.concatenate([rows, rows]), np.concatenate([a, b])),
+        ),
+        shape=(n_battles, n_models),
+    )
+    diff_t = diff.T.tocsr()
+    # the same with the features of the battle, for the rating x feature block of the hessian
+    diff_features = sparse.csr_matrix(
+        (
+            np.concatenate([features, -features]).ravel(),
+            (
+                np.repeat(np.concatenate([rows, rows]), n_features),
+                (
+                    np.concatenate([a, b])[:, None] * n_features + np.arange(n_features)
+                ).ravel(),
+            ),
+        ),
+        shape=(n_battles, n_models * n_features),
+    ).T.tocsr()
+    # the rating block only depends on the total curvature of each pair of models
+    pair_ids, pair_idxs = np.unique(a * n_models + b, return_inverse=True)
+    pair_matchups = np.column_stack([pair_ids // n_models, pair_ids % n_models])
+    pairs_t = sparse.csr_matrix(
+        (np.ones(n_battles), (pair_idxs.ravel(), rows)),
+        shape=(len(pair_ids), n_battles),
+    )
+    feature_outer = (features[:, :, None] * features[:, None, :]).reshape(
+        n_battles, n_features * n_features
+    )
+    half_reg = reg / 2.0
+    params = np.zeros((num_rows, n_params), dtype=np.float64)
+
+    def batched_logits(params):
+        ratings, feature_params = params[:, :n_models], params[:, n_models:]
+        return alpha * (diff @ ratings.T) + features @ feature_params.T
+
+    def batched_loss(params, logits):
+        # log(1 - expit(x)) = log(expit(x)) - x
+        log_loss = -((log_expit(logits) - (1.0 - outcomes) * logits) * weights)
+        return log_loss.sum(axis=0) + half_reg * (params * params).sum(axis=1)
+
+    logits = batched_logits(params)
+    loss = batched_loss(params, logits)
+    diag = np.arange(n_params)
+    for _ in range(max_iter):
+        probs = expit(logits)
+        errors = (probs - outcomes) * weights
+        grad = reg * params
+        grad[:, :n_models] += alpha * (diff_t @ errors).T
+        grad[:, n_models:] += (features.T @ errors).T
+
+        curvatures = probs * (1.0 - probs) * weights
+        hess = np.empty((num_rows, n_params, n_params))
+        hess[:, :n_models, :n_models] = bt_hessian(
+            pair_matchups, alpha**2 * (pairs_t @ curvatures).T, n_models
+        )
+        hess[:, n_models:, n_models:] = (feature_outer.T @ curvatures).T.reshape(
+            num_rows, n_features, n_features
+        )
+        cross = alpha * (diff_features @ curvatures).T.reshape(
+            num_rows, n_models, n_features
+        )
+        hess[:, :n_models, n_models:] = cross
+        hess[:, n_models:, :n_models] = cross.transpose(0, 2, 1)
+        # the ridge keeps the hessian invertible when reg is 0
+        hess[:, diag, diag] += reg + NEWTON_RIDGE
+
+        step = np.linalg.solve(hess, -grad[:, :, None])[:, :, 0]
+        # backtrack where a full step does not decrease the loss
+        step_size = np.ones(num_rows)
+        for _ in range(20):
+            new_params = params + step_size[:, None] * step
+            new_logits = batched_logits(new_params)
+            new_loss = batched_loss(new_params, new_logits)
+            worse = new_loss > loss + 1e-12 * np.abs(loss)
+            if not worse.any():
+                break
+            step_size[worse] /= 2
+        # rows that still do not decrease keep their params
+        params = np.where(worse[:, None], params, new_params)
+        logits = np.where(worse[None, :], logits, new_logits)
+        loss = np.where(worse, loss, new_loss)
+        if np.abs(step_size[:, None] * step)[~worse].max(initial=0.0) < tol:
+            break
+    return params
+
+
 def compute_style_control(
     df, alpha=math.log(10.0), reg=0.5, init_rating=1000.0, scale=400.0, tol=1e-6
 ):
@@ -354,30 +731,61 @@ def compute_bootstrap_style_control(
     scale=400.0,
     tol=1e-6,
     num_cpu=None,
+    solver="newton",
+    max_batch_elements=2**24,
 ):
+    """
+    solver="newton" fits the bootstrap rounds together with fit_contextual_bt_batched, in batches
+    of at most max_batch_elements (rounds x battles), "lbfgs" fits one round per call of
+    fit_contextual_bt over a multiprocessing pool
+    """
     matchups, features, outcomes, models = preprocess_for_style(df)
+    n_battles = matchups.shape[0]
+
+    if solver == "newton":
+        batch_size = max(1, min(num_round, max_batch_elements // n_battles))
+        results = []
+        for start in tqdm(range(0, num_round, batch_size)):
+            size = min(batch_size, num_round - start)
+            # resampling the battles with replacement is a uniform multinomial draw of their counts
+            boot_weights = np.random.multinomial(
+                n_battles, np.full(n_battles, 1.0 / n_battles), size=size
+            ).astype(np.float64)
+            results.append(
+                fit_contextual_bt_batched(
+                    matchups,
+                    features,
+                    outcomes,
+                    len(models),
+                    boot_weights,
+                    alpha=alpha,
+                    reg=reg,
+                    tol=tol,
+                )
+            )
+        ratings_params = np.concatenate(results)
+    else:
+        contextual_bt_fn = partial(
+            fit_contextual_bt,
+            matchups,
+            features,
+            outcomes,
+            models,
+            alpha=alpha,
+            reg=reg,
+            tol=tol,
+        )
 
-    contextual_bt_fn = partial(
-        fit_contextual_bt,
-        matchups,
-        features,
-        outcomes,
-        models,
-        alpha=alpha,
-        reg=reg,
-        tol=tol,
-    )
-
-    boot_idxs = np.random.randint(
-        low=0, high=matchups.shape[0], size=(num_round, matchups.shape[0])
-    )
-
-    with mp.Pool(num_cpu if num_cpu else os.cpu_count()) as pool:
-        results = list(
-            tqdm(pool.imap_unordered(contextual_bt_fn, boot_idxs), total=num_round)
+        boot_idxs = np.random.randint(
+            low=0, high=n_battles, size=(num_round, n_battles)
         )
 
-    ratings_params = np.array(results)
+        with mp.Pool(num_cpu if num_cpu else os.cpu_count()) as pool:
+            results = list(
+                tqdm(pool.imap_unordered(contextual_bt_fn, boot_idxs), total=num_round)
+            )
+        ratings_params = np.array(results)
+
     ratings = ratings_params[:, : len(models)]
     params = ratings_params[:, len(models) :]
     scaled_ratings = scale_and_offset(ratings, models, scale, init_rating)
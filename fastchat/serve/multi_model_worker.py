@@ -56,6 +56,7 @@ from fastchat.model.model_codet5p import generate_stream_codet5p
 from fastchat.modules.gptq import GptqConfig
 from fastchat.modules.exllama import ExllamaConfig
 from fastchat.modules.xfastertransformer import XftConfig
+from fastchat.serve.base_model_worker import stream_until_disconnect
 from fastchat.serve.inference import generate_stream
 from fastchat.serve.model_worker import ModelWorker, worker_id, logger
 from fastchat.utils import build_logger, pretty_print_semaphore, get_context_length
@@ -100,8 +101,9 @@ async def api_generate_stream(request: Request):
     await acquire_worker_semaphore()
     worker = worker_map[params["model"]]
     generator = worker.generate_stream_gate(params)
-    background_tasks = create_background_tasks()
-    return StreamingResponse(generator, background=background_tasks)
+    return StreamingResponse(
+        stream_until_disconnect(generator, release_worker_semaphore)
+    )
 
 
 @app.post("/worker_generate")
@@ -130,6 +132,8 @@ async def api_get_status(request: Request):
         "model_names": [m for w in workers for m in w.model_names],
         "speed": 1,
         "queue_length": sum([w.get_queue_length() for w in workers]),
+        "num_cancelled": sum([w.num_cancelled for w in workers]),
+        "num_cancelled_tokens": sum([w.num_cancelled_tokens for w in workers]),
     }
 
 
@@ -140,6 +144,13 @@ async def api_count_token(request: Request):
     return worker.count_token(params)
 
 
+@app.post("/count_token_batch")
+async def api_count_token_batch(request: Request):
+    params = await request.json()
+    worker = worker_map[params["model"]]
+    return worker.count_token_batch(params)
+
+
 @app.post("/worker_get_conv_template")
 async def api_get_conv(request: Request):
     params = await request.json()
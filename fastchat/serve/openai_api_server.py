@@ -11,16 +11,16 @@ import asyncio
 import argparse
 import json
 import os
+import random
 from typing import Generator, Optional, Union, Dict, List, Any
 
 import aiohttp
 import fastapi
-from fastapi import Depends, HTTPException
+from fastapi import BackgroundTasks, Depends, HTTPException
 from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse, JSONResponse
 from fastapi.security.http import HTTPAuthorizationCredentials, HTTPBearer
-import httpx
 
 from pydantic_settings import BaseSettings
 import shortuuid
@@ -61,29 +61,50 @@ from fastchat.protocol.api_protocol import (
     APITokenCheckResponse,
     APITokenCheckResponseItem,
 )
-from fastchat.utils import build_logger
+from fastchat.utils import build_logger, merge_async_iterators
 
 logger = build_logger("openai_api_server", "openai_api_server.log")
 
 conv_template_map = {}
+model_details_map = {}
+# Workers without the /count_token_batch endpoint
+count_token_batch_unsupported = set()
+# Controllers whose dispatch method does not need finished requests released
+release_unneeded_controllers = set()
 
 fetch_timeout = aiohttp.ClientTimeout(total=3 * 3600)
+stream_timeout = aiohttp.ClientTimeout(
+    sock_connect=WORKER_API_TIMEOUT, sock_read=WORKER_API_TIMEOUT
+)
+
+# One pooled HTTP session for all requests to the controller and workers. It is
+# created lazily because it must be bound to the running event loop.
+session = None
+
+
+def get_session() -> aiohttp.ClientSession:
+    global session
+    if session is None:
+        # Streams are long lived, so do not cap the number of connections.
+        session = aiohttp.ClientSession(
+            timeout=fetch_timeout, connector=aiohttp.TCPConnector(limit=0)
+        )
+    return session
 
 
 async def fetch_remote(url, pload=None, name=None):
-    async with aiohttp.ClientSession(timeout=fetch_timeout) as session:
-        async with session.post(url, json=pload) as response:
-            chunks = []
-            if response.status != 200:
-                ret = {
-                    "text": f"{response.reason}",
-                    "error_code": ErrorCode.INTERNAL_ERROR,
-                }
-                return json.dumps(ret)
-
-            async for chunk, _ in response.content.iter_chunks():
-                chunks.append(chunk)
-        output = b"".join(chunks)
+    async with get_session().post(url, json=pload) as response:
+        chunks = []
+        if response.status != 200:
+            ret = {
+                "text": f"{response.reason}",
+                "error_code": ErrorCode.INTERNAL_ERROR,
+            }
+            return json.dumps(ret)
+
+        async for chunk, _ in response.content.iter_chunks():
+            chunks.append(chunk)
+    output = b"".join(chunks)
 
     if name is not None:
         res = json.loads(output)
@@ -98,9 +119,58 @@ class AppSettings(BaseSettings):
     # The address of the model controller.
     controller_address: str = "http://localhost:21001"
     api_keys: Optional[List[str]] = None
+    # Dispatch from a local copy of the controller's worker table.
+    direct_routing: bool = False
+    routing_refresh_interval: float = 5.0
+
+
+class RoutingTable:
+    """A local copy of the controller's worker table for direct routing.
+
+    The table is refreshed in the background, so dispatching a request needs no
+    round trip to the controller. Requests go to the worker with the fewest
+    outstanding requests from this server relative to its speed.
+    """
+
+    def __init__(self):
+        # worker address -> status reported by the controller
+        self.workers: Dict[str, Dict] = {}
+        self.model_workers: Dict[str, List[str]] = {}
+        self.num_outstanding: Dict[str, int] = {}
+
+    def update(self, workers: Dict[str, Dict]):
+        model_workers = {}
+        for w_name, w_status in workers.items():
+            for model_name in w_status["model_names"]:
+                model_workers.setdefault(model_name, []).append(w_name)
+        self.workers = workers
+        self.model_workers = model_workers
+        self.num_outstanding = {w: self.num_outstanding.get(w, 0) for w in workers}
+
+    def list_models(self) -> List[str]:
+        return list(self.model_workers)
+
+    def get_worker_address(self, model_name: str) -> str:
+        worker_names = self.model_workers.get(model_name)
+        if not worker_names:
+            return ""
+        w_name = min(
+            worker_names,
+            key=lambda w: (
+                self.num_outstanding[w] / (self.workers[w]["speed"] or 1),
+                random.random(),
+            ),
+        )
+        self.num_outstanding[w_name] += 1
+        return w_name
+
+    def release_worker_address(self, worker_addr: str):
+        if self.num_outstanding.get(worker_addr, 0) > 0:
+            self.num_outstanding[worker_addr] -= 1
 
 
 app_settings = AppSettings()
+routing_table = RoutingTable()
 app = fastapi.FastAPI()
 headers = {"User-Agent": "FastChat API Server"}
 get_bearer_token = HTTPBearer(auto_error=False)
@@ -139,11 +209,44 @@ async def validation_exception_handler(request, exc):
     return create_error_response(ErrorCode.VALIDATION_TYPE_ERROR, str(exc))
 
 
-async def check_model(request) -> Optional[JSONResponse]:
+async def refresh_routing_table():
+    controller_address = app_settings.controller_address
+    workers = await fetch_remote(controller_address + "/list_workers", None, "workers")
+    routing_table.update(workers)
+
+
+async def routing_table_refresher():
+    while True:
+        try:
+            await refresh_routing_table()
+        except (aiohttp.ClientError, asyncio.TimeoutError, KeyError, ValueError) as e:
+            logger.warning(f"Refresh routing table fails: {e}")
+        await asyncio.sleep(app_settings.routing_refresh_interval)
+
+
+@app.on_event("startup")
+async def app_startup():
+    if app_settings.direct_routing:
+        asyncio.create_task(routing_table_refresher())
+
+
+@app.on_event("shutdown")
+async def app_shutdown():
+    if session is not None:
+        await session.close()
+
+
+async def list_models() -> List[str]:
+    if app_settings.direct_routing:
+        return routing_table.list_models()
     controller_address = app_settings.controller_address
+    return await fetch_remote(controller_address + "/list_models", None, "models")
+
+
+async def check_model(request) -> Optional[JSONResponse]:
     ret = None
 
-    models = await fetch_remote(controller_address + "/list_models", None, "models")
+    models = await list_models()
     if request.model not in models:
         ret = create_error_response(
             ErrorCode.INVALID_MODEL,
@@ -153,19 +256,22 @@ async def check_model(request) -> Optional[JSONResponse]:
 
 
 async def check_length(request, prompt, max_tokens, worker_addr):
+    """Check that the prompt fits into the context of the model.
+
+    prompt can also be a list of prompts, which are counted in one request. The
+    returned length is the number of new tokens that fits for all of them.
+    """
     if (
         not isinstance(max_tokens, int) or max_tokens <= 0
     ):  # model worker not support max_tokens=None
         max_tokens = 1024 * 1024
 
-    context_len = await fetch_remote(
-        worker_addr + "/model_details", {"model": request.model}, "context_length"
-    )
-    token_num = await fetch_remote(
-        worker_addr + "/count_token",
-        {"model": request.model, "prompt": prompt},
-        "count",
+    prompts = [prompt] if isinstance(prompt, str) else prompt
+    context_len, token_nums = await asyncio.gather(
+        get_context_length(request.model, worker_addr),
+        count_tokens_batch(request.model, worker_addr, prompts),
     )
+    token_num = max(token_nums)
     length = min(max_tokens, context_len - token_num)
 
     if length <= 0:
@@ -372,10 +478,20 @@ async def get_worker_address(model_name: str) -> str:
     :return: Worker address from the controller
     :raises: :class:`ValueError`: No available worker for requested model
     """
-    controller_address = app_settings.controller_address
-    worker_addr = await fetch_remote(
-        controller_address + "/get_worker_address", {"model": model_name}, "address"
-    )
+    if app_settings.direct_routing:
+        worker_addr = routing_table.get_worker_address(model_name)
+    else:
+        controller_address = app_settings.controller_address
+        ret = await fetch_remote(
+            controller_address + "/get_worker_address", {"model": model_name}, ""
+        )
+        if not isinstance(ret, dict):  # The controller returned an error
+            ret = {"address": ""}
+        worker_addr = ret["address"]
+        if ret.get("release", True):
+            release_unneeded_controllers.discard(controller_address)
+        else:
+            release_unneeded_controllers.add(controller_address)
 
     # No available worker
     if worker_addr == "":
@@ -384,6 +500,23 @@ async def get_worker_address(model_name: str) -> str:
     return worker_addr
 
 
+async def release_worker_address(worker_addr: str):
+    """Tell the controller that a request dispatched to worker_addr is done."""
+    if app_settings.direct_routing:
+        routing_table.release_worker_address(worker_addr)
+        return
+    controller_address = app_settings.controller_address
+    if controller_address in release_unneeded_controllers:
+        return
+    try:
+        await fetch_remote(
+            controller_address + "/release_worker_address",
+            {"worker_address": worker_addr},
+        )
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.debug(f"release worker address error: {e}")
+
+
 async def get_conv(model_name: str, worker_addr: str):
     conv_template = conv_template_map.get((worker_addr, model_name))
     if conv_template is None:
@@ -394,11 +527,61 @@ async def get_conv(model_name: str, worker_addr: str):
     return conv_template
 
 
+async def get_model_details(model_name: str, worker_addr: str):
+    details = model_details_map.get((worker_addr, model_name))
+    if details is None:
+        details = await fetch_remote(
+            worker_addr + "/model_details", {"model": model_name}, ""
+        )
+        if "error_code" in details:
+            return details
+        model_details_map[(worker_addr, model_name)] = details
+    return details
+
+
+async def get_context_length(model_name: str, worker_addr: str) -> int:
+    details = await get_model_details(model_name, worker_addr)
+    return details["context_length"]
+
+
+async def count_tokens_batch(
+    model_name: str, worker_addr: str, prompts: List[str]
+) -> List[int]:
+    """Count the tokens of several prompts, in one request if the worker can."""
+    if worker_addr not in count_token_batch_unsupported:
+        try:
+            async with get_session().post(
+                worker_addr + "/count_token_batch",
+                json={"model": model_name, "prompts": prompts},
+            ) as response:
+                if response.status in (404, 405):
+                    # Only workers without the endpoint stop being asked
+                    count_token_batch_unsupported.add(worker_addr)
+                elif response.status == 200:
+                    ret = json.loads(await response.read())
+                    if isinstance(ret, dict) and "counts" in ret:
+                        return ret["counts"]
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            logger.debug(f"count token batch error: {e}")
+
+    return await asyncio.gather(
+        *[
+            fetch_remote(
+                worker_addr + "/count_token",
+                {"model": model_name, "prompt": prompt},
+                "count",
+            )
+            for prompt in prompts
+        ]
+    )
+
+
 @app.get("/v1/models", dependencies=[Depends(check_api_key)])
 async def show_available_models():
-    controller_address = app_settings.controller_address
-    ret = await fetch_remote(controller_address + "/refresh_all_workers")
-    models = await fetch_remote(controller_address + "/list_models", None, "models")
+    if not app_settings.direct_routing:
+        controller_address = app_settings.controller_address
+        ret = await fetch_remote(controller_address + "/refresh_all_workers")
+    models = await list_models()
 
     models.sort()
     # TODO: return real model permission details
@@ -409,7 +592,9 @@ async def show_available_models():
 
 
 @app.post("/v1/chat/completions", dependencies=[Depends(check_api_key)])
-async def create_chat_completion(request: ChatCompletionRequest):
+async def create_chat_completion(
+    request: ChatCompletionRequest, background_tasks: BackgroundTasks
+):
     """Creates a completion for the chat message"""
     error_check_ret = await check_model(request)
     if error_check_ret is not None:
@@ -419,6 +604,8 @@ async def create_chat_completion(request: ChatCompletionRequest):
         return error_check_ret
 
     worker_addr = await get_worker_address(request.model)
+    # Runs once the response, including a streamed one, has been sent.
+    background_tasks.add_task(release_worker_address, worker_addr)
 
     gen_params = await get_gen_params(
         request.model,
@@ -453,12 +640,8 @@ async def create_chat_completion(request: ChatCompletionRequest):
         return StreamingResponse(generator, media_type="text/event-stream")
 
     choices = []
-    chat_completions = []
-    for i in range(request.n):
-        content = asyncio.create_task(generate_completion(gen_params, worker_addr))
-        chat_completions.append(content)
     try:
-        all_tasks = await asyncio.gather(*chat_completions)
+        all_tasks = await generate_completions(gen_params, request.n, worker_addr)
     except Exception as e:
         return create_error_response(ErrorCode.INTERNAL_ERROR, str(e))
     usage = UsageInfo()
@@ -504,35 +687,35 @@ async def chat_completion_stream_generator(
         )
         yield f"data: {chunk.model_dump_json(exclude_unset=True)}\n\n"
 
-        previous_text = ""
-        async for content in generate_completion_stream(gen_params, worker_addr):
-            if content["error_code"] != 0:
-                yield f"data: {json.dumps(content, ensure_ascii=False)}\n\n"
-                yield "data: [DONE]\n\n"
-                return
-            decoded_unicode = content["text"].replace("\ufffd", "")
-            delta_text = decoded_unicode[len(previous_text) :]
-            previous_text = (
-                decoded_unicode
-                if len(decoded_unicode) > len(previous_text)
-                else previous_text
-            )
+    previous_texts = [""] * n
+    async for i, content in generate_completion_streams(gen_params, n, worker_addr):
+        if content["error_code"] != 0:
+            yield f"data: {json.dumps(content, ensure_ascii=False)}\n\n"
+            yield "data: [DONE]\n\n"
+            return
+        decoded_unicode = content["text"].replace("\ufffd", "")
+        delta_text = decoded_unicode[len(previous_texts[i]) :]
+        previous_texts[i] = (
+            decoded_unicode
+            if len(decoded_unicode) > len(previous_texts[i])
+            else previous_texts[i]
+        )
 
-            if len(delta_text) == 0:
-                delta_text = None
-            choice_data = ChatCompletionResponseStreamChoice(
-                index=i,
-                delta=DeltaMessage(content=delta_text),
-                finish_reason=content.get("finish_reason", None),
-            )
-            chunk = ChatCompletionStreamResponse(
-                id=id, choices=[choice_data], model=model_name
-            )
-            if delta_text is None:
-                if content.get("finish_reason", None) is not None:
-                    finish_stream_events.append(chunk)
-                continue
-            yield f"data: {chunk.model_dump_json(exclude_unset=True)}\n\n"
+        if len(delta_text) == 0:
+            delta_text = None
+        choice_data = ChatCompletionResponseStreamChoice(
+            index=i,
+            delta=DeltaMessage(content=delta_text),
+            finish_reason=content.get("finish_reason", None),
+        )
+        chunk = ChatCompletionStreamResponse(
+            id=id, choices=[choice_data], model=model_name
+        )
+        if delta_text is None:
+            if content.get("finish_reason", None) is not None:
+                finish_stream_events.append(chunk)
+            continue
+        yield f"data: {chunk.model_dump_json(exclude_unset=True)}\n\n"
     # There is not "content" field in the last delta message, so exclude_none to exclude field "content".
     for finish_chunk in finish_stream_events:
         yield f"data: {finish_chunk.model_dump_json(exclude_none=True)}\n\n"
@@ -540,7 +723,9 @@ async def chat_completion_stream_generator(
 
 
 @app.post("/v1/completions", dependencies=[Depends(check_api_key)])
-async def create_completion(request: CompletionRequest):
+async def create_completion(
+    request: CompletionRequest, background_tasks: BackgroundTasks
+):
     error_check_ret = await check_model(request)
     if error_check_ret is not None:
         return error_check_ret
@@ -551,15 +736,16 @@ async def create_completion(request: CompletionRequest):
     request.prompt = process_input(request.model, request.prompt)
 
     worker_addr = await get_worker_address(request.model)
-    for text in request.prompt:
-        max_tokens, error_check_ret = await check_length(
-            request, text, request.max_tokens, worker_addr
-        )
-        if error_check_ret is not None:
-            return error_check_ret
+    # Runs once the response, including a streamed one, has been sent.
+    background_tasks.add_task(release_worker_address, worker_addr)
+    max_tokens, error_check_ret = await check_length(
+        request, request.prompt, request.max_tokens, worker_addr
+    )
+    if error_check_ret is not None:
+        return error_check_ret
 
-        if isinstance(max_tokens, int) and max_tokens < request.max_tokens:
-            request.max_tokens = max_tokens
+    if isinstance(max_tokens, int) and max_tokens < request.max_tokens:
+        request.max_tokens = max_tokens
 
     if request.stream:
         generator = generate_completion_stream_generator(
@@ -585,16 +771,15 @@ async def create_completion(request: CompletionRequest):
                 best_of=request.best_of,
                 use_beam_search=request.use_beam_search,
             )
-            for i in range(request.n):
-                content = asyncio.create_task(
-                    generate_completion(gen_params, worker_addr)
-                )
-                text_completions.append(content)
+            text_completions.append(
+                generate_completions(gen_params, request.n, worker_addr)
+            )
 
         try:
             all_tasks = await asyncio.gather(*text_completions)
         except Exception as e:
             return create_error_response(ErrorCode.INTERNAL_ERROR, str(e))
+        all_tasks = [content for contents in all_tasks for content in contents]
 
         choices = []
         usage = UsageInfo()
@@ -625,52 +810,51 @@ async def generate_completion_stream_generator(
     id = f"cmpl-{shortuuid.random()}"
     finish_stream_events = []
     for text in request.prompt:
-        for i in range(n):
-            previous_text = ""
-            gen_params = await get_gen_params(
-                request.model,
-                worker_addr,
-                text,
-                temperature=request.temperature,
-                top_p=request.top_p,
-                top_k=request.top_k,
-                presence_penalty=request.presence_penalty,
-                frequency_penalty=request.frequency_penalty,
-                max_tokens=request.max_tokens,
-                logprobs=request.logprobs,
-                echo=request.echo,
-                stop=request.stop,
+        gen_params = await get_gen_params(
+            request.model,
+            worker_addr,
+            text,
+            temperature=request.temperature,
+            top_p=request.top_p,
+            top_k=request.top_k,
+            presence_penalty=request.presence_penalty,
+            frequency_penalty=request.frequency_penalty,
+            max_tokens=request.max_tokens,
+            logprobs=request.logprobs,
+            echo=request.echo,
+            stop=request.stop,
+        )
+        previous_texts = [""] * n
+        async for i, content in generate_completion_streams(gen_params, n, worker_addr):
+            if content["error_code"] != 0:
+                yield f"data: {json.dumps(content, ensure_ascii=False)}\n\n"
+                yield "data: [DONE]\n\n"
+                return
+            decoded_unicode = content["text"].replace("\ufffd", "")
+            delta_text = decoded_unicode[len(previous_texts[i]) :]
+            previous_texts[i] = (
+                decoded_unicode
+                if len(decoded_unicode) > len(previous_texts[i])
+                else previous_texts[i]
             )
-            async for content in generate_completion_stream(gen_params, worker_addr):
-                if content["error_code"] != 0:
-                    yield f"data: {json.dumps(content, ensure_ascii=False)}\n\n"
-                    yield "data: [DONE]\n\n"
-                    return
-                decoded_unicode = content["text"].replace("\ufffd", "")
-                delta_text = decoded_unicode[len(previous_text) :]
-                previous_text = (
-                    decoded_unicode
-                    if len(decoded_unicode) > len(previous_text)
-                    else previous_text
-                )
-                # todo: index is not apparent
-                choice_data = CompletionResponseStreamChoice(
-                    index=i,
-                    text=delta_text,
-                    logprobs=create_openai_logprobs(content.get("logprobs", None)),
-                    finish_reason=content.get("finish_reason", None),
-                )
-                chunk = CompletionStreamResponse(
-                    id=id,
-                    object="text_completion",
-                    choices=[choice_data],
-                    model=model_name,
-                )
-                if len(delta_text) == 0:
-                    if content.get("finish_reason", None) is not None:
-                        finish_stream_events.append(chunk)
-                    continue
-                yield f"data: {chunk.model_dump_json(exclude_unset=True)}\n\n"
+            # todo: index is not apparent
+            choice_data = CompletionResponseStreamChoice(
+                index=i,
+                text=delta_text,
+                logprobs=create_openai_logprobs(content.get("logprobs", None)),
+                finish_reason=content.get("finish_reason", None),
+            )
+            chunk = CompletionStreamResponse(
+                id=id,
+                object="text_completion",
+                choices=[choice_data],
+                model=model_name,
+            )
+            if len(delta_text) == 0:
+                if content.get("finish_reason", None) is not None:
+                    finish_stream_events.append(chunk)
+                continue
+            yield f"data: {chunk.model_dump_json(exclude_unset=True)}\n\n"
     # There is not "content" field in the last delta message, so exclude_none to exclude field "content".
     for finish_chunk in finish_stream_events:
         yield f"data: {finish_chunk.model_dump_json(exclude_unset=True)}\n\n"
@@ -678,34 +862,92 @@ async def generate_completion_stream_generator(
 
 
 async def generate_completion_stream(payload: Dict[str, Any], worker_addr: str):
-    controller_address = app_settings.controller_address
-    async with httpx.AsyncClient() as client:
-        delimiter = b"\0"
-        async with client.stream(
-            "POST",
-            worker_addr + "/worker_generate_stream",
-            headers=headers,
-            json=payload,
-            timeout=WORKER_API_TIMEOUT,
-        ) as response:
-            # content = await response.aread()
-            buffer = b""
-            async for raw_chunk in response.aiter_raw():
+    delimiter = b"\0"
+    async with get_session().post(
+        worker_addr + "/worker_generate_stream",
+        headers=headers,
+        json=payload,
+        timeout=stream_timeout,
+    ) as response:
+        buffer = b""
+        try:
+            async for raw_chunk in response.content.iter_any():
                 buffer += raw_chunk
                 while (chunk_end := buffer.find(delimiter)) >= 0:
                     chunk, buffer = buffer[:chunk_end], buffer[chunk_end + 1 :]
                     if not chunk:
                         continue
                     yield json.loads(chunk.decode())
+        finally:
+            if not response.content.is_eof():
+                # The client went away. Closing the connection makes the worker
+                # stop generating instead of returning it to the pool.
+                response.close()
 
 
 async def generate_completion(payload: Dict[str, Any], worker_addr: str):
     return await fetch_remote(worker_addr + "/worker_generate", payload, "")
 
 
+async def generate_completion_streams(
+    payload: Dict[str, Any], n: int, worker_addr: str
+):
+    """Stream n samples for one prompt as (index, content) pairs.
+
+    Workers that support parallel sampling get a single request with n and share
+    one prefill between the samples. Other workers get n concurrent requests.
+    The chunks of all samples are yielded as they arrive.
+    """
+    if n == 1:
+        async for content in generate_completion_stream(payload, worker_addr):
+            yield 0, content
+        return
+
+    details = await get_model_details(payload["model"], worker_addr)
+    if details.get("parallel_sampling", False):
+        async for content in generate_completion_stream(
+            {**payload, "n": n}, worker_addr
+        ):
+            yield content.get("index", 0), content
+    else:
+        async for i, content in merge_async_iterators(
+            *[generate_completion_stream(payload, worker_addr) for _ in range(n)]
+        ):
+            yield i, content
+
+
+async def generate_completions(payload: Dict[str, Any], n: int, worker_addr: str):
+    """Generate n samples for one prompt and return their final outputs."""
+    details = {}
+    if n > 1:
+        details = await get_model_details(payload["model"], worker_addr)
+    if not details.get("parallel_sampling", False):
+        return await asyncio.gather(
+            *[generate_completion(payload, worker_addr) for _ in range(n)]
+        )
+
+    outputs = [None] * n
+    async for i, content in generate_completion_streams(payload, n, worker_addr):
+        if content["error_code"] != 0:
+            return [content]
+        outputs[i] = content
+    for i, content in enumerate(outputs):
+        # Only the last chunk of a sample has its finish reason
+        if content is None or content.get("finish_reason") is None:
+            outputs[i] = {
+                "text": f"The stream of sample {i} ended before it finished",
+                "error_code": ErrorCode.INTERNAL_ERROR,
+            }
+    return outputs
+
+
 @app.post("/v1/embeddings", dependencies=[Depends(check_api_key)])
 @app.post("/v1/engines/{model_name}/embeddings", dependencies=[Depends(check_api_key)])
-async def create_embeddings(request: EmbeddingsRequest, model_name: str = None):
+async def create_embeddings(
+    request: EmbeddingsRequest,
+    background_tasks: BackgroundTasks,
+    model_name: str = None,
+):
     """Creates embeddings for the text"""
     if request.model is None:
         request.model = model_name
@@ -728,7 +970,7 @@ async def create_embeddings(request: EmbeddingsRequest, model_name: str = None):
             "input": batch,
             "encoding_format": request.encoding_format,
         }
-        embedding = await get_embedding(payload)
+        embedding = await get_embedding(payload, background_tasks)
         if "error_code" in embedding and embedding["error_code"] != 0:
             return create_error_response(embedding["error_code"], embedding["text"])
         data += [
@@ -751,10 +993,11 @@ async def create_embeddings(request: EmbeddingsRequest, model_name: str = None):
     ).model_dump(exclude_none=True)
 
 
-async def get_embedding(payload: Dict[str, Any]):
+async def get_embedding(payload: Dict[str, Any], background_tasks: BackgroundTasks):
     controller_address = app_settings.controller_address
     model_name = payload["model"]
     worker_addr = await get_worker_address(model_name)
+    background_tasks.add_task(release_worker_address, worker_addr)
 
     embedding = await fetch_remote(worker_addr + "/worker_get_embeddings", payload)
     return json.loads(embedding)
@@ -764,42 +1007,51 @@ async def get_embedding(payload: Dict[str, Any]):
 
 
 @app.post("/api/v1/token_check")
-async def count_tokens(request: APITokenCheckRequest):
+async def count_tokens(
+    request: APITokenCheckRequest, background_tasks: BackgroundTasks
+):
     """
     Checks the token count for each message in your list
     This is not part of the OpenAI API spec.
     """
-    checkedList = []
-    for item in request.prompts:
-        worker_addr = await get_worker_address(item.model)
-
-        context_len = await fetch_remote(
-            worker_addr + "/model_details",
-            {"prompt": item.prompt, "model": item.model},
-            "context_length",
-        )
-
-        token_num = await fetch_remote(
-            worker_addr + "/count_token",
-            {"prompt": item.prompt, "model": item.model},
-            "count",
+    checkedList = [None] * len(request.prompts)
+    model_indices = {}
+    for i, item in enumerate(request.prompts):
+        model_indices.setdefault(item.model, []).append(i)
+
+    # The prompts of each model are counted in one batched request.
+    async def check_model_prompts(model_name, indices):
+        worker_addr = await get_worker_address(model_name)
+        background_tasks.add_task(release_worker_address, worker_addr)
+
+        context_len, token_nums = await asyncio.gather(
+            get_context_length(model_name, worker_addr),
+            count_tokens_batch(
+                model_name, worker_addr, [request.prompts[i].prompt for i in indices]
+            ),
         )
+        for i, token_num in zip(indices, token_nums):
+            can_fit = True
+            if token_num + request.prompts[i].max_tokens > context_len:
+                can_fit = False
 
-        can_fit = True
-        if token_num + item.max_tokens > context_len:
-            can_fit = False
-
-        checkedList.append(
-            APITokenCheckResponseItem(
+            checkedList[i] = APITokenCheckResponseItem(
                 fits=can_fit, contextLength=context_len, tokenCount=token_num
             )
-        )
 
+    await asyncio.gather(
+        *[
+            check_model_prompts(model_name, indices)
+            for model_name, indices in model_indices.items()
+        ]
+    )
     return APITokenCheckResponse(prompts=checkedList)
 
 
 @app.post("/api/v1/chat/completions")
-async def create_chat_completion(request: APIChatCompletionRequest):
+async def create_chat_completion(
+    request: APIChatCompletionRequest, background_tasks: BackgroundTasks
+):
     """Creates a completion for the chat message"""
     error_check_ret = await check_model(request)
     if error_check_ret is not None:
@@ -809,6 +1061,8 @@ async def create_chat_completion(request: APIChatCompletionRequest):
         return error_check_ret
 
     worker_addr = await get_worker_address(request.model)
+    # Runs once the response, including a streamed one, has been sent.
+    background_tasks.add_task(release_worker_address, worker_addr)
 
     gen_params = await get_gen_params(
         request.model,
@@ -846,12 +1100,8 @@ async def create_chat_completion(request: APIChatCompletionRequest):
         return StreamingResponse(generator, media_type="text/event-stream")
 
     choices = []
-    chat_completions = []
-    for i in range(request.n):
-        content = asyncio.create_task(generate_completion(gen_params, worker_addr))
-        chat_completions.append(content)
     try:
-        all_tasks = await asyncio.gather(*chat_completions)
+        all_tasks = await generate_completions(gen_params, request.n, worker_addr)
     except Exception as e:
         return create_error_response(ErrorCode.INTERNAL_ERROR, str(e))
     usage = UsageInfo()
@@ -901,6 +1151,18 @@ def create_openai_api_server():
         type=lambda s: s.split(","),
         help="Optional list of comma separated API keys",
     )
+    parser.add_argument(
+        "--direct-routing",
+        action="store_true",
+        help="Dispatch requests from a periodically refreshed copy of the "
+        "controller's worker table instead of asking the controller every time",
+    )
+    parser.add_argument(
+        "--routing-refresh-interval",
+        type=float,
+        default=5.0,
+        help="Seconds between routing table refreshes in --direct-routing mode",
+    )
     parser.add_argument(
         "--ssl",
         action="store_true",
@@ -919,6 +1181,8 @@ def create_openai_api_server():
     )
     app_settings.controller_address = args.controller_address
     app_settings.api_keys = args.api_keys
+    app_settings.direct_routing = args.direct_routing
+    app_settings.routing_refresh_interval = args.routing_refresh_interval
 
     logger.info(f"args: {args}")
     return args
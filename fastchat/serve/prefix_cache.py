@@ -0,0 +1,180 @@
+"""
+A worker-side KV cache for shared prompt prefixes.
+
+Multi-turn conversations resend the whole history on every turn. This cache keeps
+the KV state of finished generations, indexed by chained hashes of fixed-size
+token blocks, so the next turn only needs to prefill the tokens after the longest
+cached prefix. A hash only narrows the search down: a hit is confirmed by comparing
+the tokens. Entries are evicted in LRU order once the memory budget is used up.
+"""
+from collections import OrderedDict
+import threading
+from typing import Dict, List
+
+
+def to_legacy_cache(past_key_values):
+    """Convert a model's past_key_values into a list of (key, value) tensors."""
+    if isinstance(past_key_values, (tuple, list)):
+        return [tuple(layer) for layer in past_key_values]
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return [tuple(layer) for layer in past_key_values.to_legacy_cache()]
+    return [(layer.keys, layer.values) for layer in past_key_values.layers]
+
+
+def from_legacy_cache(legacy_cache, cache_cls):
+    """Wrap (key, value) tensors into the cache type the model returned."""
+    if cache_cls is None:
+        return tuple(legacy_cache)
+    if hasattr(cache_cls, "from_legacy_cache"):
+        return cache_cls.from_legacy_cache(tuple(legacy_cache))
+    return cache_cls(legacy_cache)
+
+
+def get_cache_cls(past_key_values):
+    """The cache class to rebuild past_key_values with, or None for tuples."""
+    if isinstance(past_key_values, (tuple, list)):
+        return None
+    return type(past_key_values)
+
+
+class _Entry:
+    def __init__(
+        self, key, token_ids, block_hashes, past_key_values, cache_cls, num_bytes
+    ):
+        self.key = key
+        self.token_ids = token_ids
+        self.block_hashes = block_hashes
+        self.past_key_values = past_key_values
+        self.cache_cls = cache_cls
+        self.num_bytes = num_bytes
+
+
+class PrefixCache:
+    """An LRU cache from token prefixes to their KV state.
+
+    Only KV caches with the standard [batch, heads, seq_len, head_dim] layout are
+    stored. All methods are thread safe.
+    """
+
+    def __init__(self, max_bytes: int, block_size: int = 16):
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+
+        self.entries: "OrderedDict[int, _Entry]" = OrderedDict()
+        # block hash -> {key of an entry holding the block: number of tokens covered}
+        # Shared prefix blocks are held by several entries and stay indexed until
+        # the last of them is evicted.
+        self.index: Dict[int, Dict[int, int]] = {}
+        self.num_bytes = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.hit_tokens = 0
+        self.evictions = 0
+
+    def _block_hashes(self, token_ids: List[int], max_len: int) -> List[int]:
+        hashes = []
+        h = None
+        for end in range(self.block_size, max_len + 1, self.block_size):
+            h = hash((h, tuple(token_ids[end - self.block_size : end])))
+            hashes.append(h)
+        return hashes
+
+    def lookup(self, token_ids: List[int]):
+        """Find the KV state of the longest cached prefix of token_ids.
+
+        At least one token is always left uncached so that the caller gets the
+        logits of the last prompt token. Returns (num_cached_tokens,
+        past_key_values), or (0, None) on a miss.
+        """
+        hashes = self._block_hashes(token_ids, len(token_ids) - 1)
+        with self.lock:
+            for h in reversed(hashes):
+                entry, length = self._find_entry(h, token_ids)
+                if entry is None:
+                    continue
+                self.entries.move_to_end(entry.key)
+                self.hits += 1
+                self.hit_tokens += length
+                past_key_values = [
+                    (k[:, :, :length], v[:, :, :length])
+                    for k, v in entry.past_key_values
+                ]
+                return length, from_legacy_cache(past_key_values, entry.cache_cls)
+            self.misses += 1
+        return 0, None
+
+    def _find_entry(self, block_hash, token_ids):
+        """An entry whose first tokens are the prefix of token_ids that ends with
+        the block of block_hash, and the length of that prefix."""
+        for key, length in self.index.get(block_hash, {}).items():
+            entry = self.entries[key]
+            if entry.token_ids[:length] == tuple(token_ids[:length]):
+                return entry, length
+        return None, 0
+
+    def insert(self, token_ids: List[int], past_key_values, cache_cls):
+        """Store the KV state that covers token_ids.
+
+        past_key_values is a list of (key, value) tensors as returned by
+        `to_legacy_cache` and cache_cls is the class to rebuild it with.
+        """
+        length = len(token_ids) // self.block_size * self.block_size
+        if length == 0:
+            return
+        for k, v in past_key_values:
+            if k.dim() != 4 or k.shape[0] != 1 or k.shape[2] < length:
+                return
+
+        hashes = self._block_hashes(token_ids, length)
+        key = hashes[-1]
+        past_key_values = [
+            (k[:, :, :length], v[:, :, :length]) for k, v in past_key_values
+        ]
+        # Sliced tensors keep their whole storage alive, so count that.
+        num_bytes = sum(
+            k.untyped_storage().nbytes() + v.untyped_storage().nbytes()
+            for k, v in past_key_values
+        )
+        if num_bytes > self.max_bytes:
+            return
+
+        token_ids = tuple(token_ids[:length])
+        with self.lock:
+            if key in self.entries:
+                # Either the same tokens or a hash collision, which is not cached
+                if self.entries[key].token_ids == token_ids:
+                    self.entries.move_to_end(key)
+                return
+            entry = _Entry(
+                key, token_ids, hashes, past_key_values, cache_cls, num_bytes
+            )
+            self.entries[key] = entry
+            self.num_bytes += num_bytes
+            for i, h in enumerate(hashes):
+                self.index.setdefault(h, {})[key] = (i + 1) * self.block_size
+
+            while self.num_bytes > self.max_bytes:
+                self._evict_oldest()
+
+    def _evict_oldest(self):
+        _, entry = self.entries.popitem(last=False)
+        self.num_bytes -= entry.num_bytes
+        self.evictions += 1
+        for h in entry.block_hashes:
+            holders = self.index[h]
+            del holders[entry.key]
+            if not holders:
+                del self.index[h]
+
+    def get_stats(self) -> Dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_tokens": self.hit_tokens,
+            "evictions": self.evictions,
+            "num_entries": len(self.entries),
+            "num_bytes": self.num_bytes,
+            "max_bytes": self.max_bytes,
+        }
@@ -0,0 +1,65 @@
+"""
+Replay an answer that arrived in one piece as a short stream of UI frames.
+
+Providers called without streaming (e.g., o1 or gemini_no_stream) return the
+whole answer at once. Instead of yielding it a few characters at a time, the
+answer is revealed at REPLAY_CHARS_PER_SEC for at most REPLAY_MAX_DURATION
+seconds with one frame per STREAM_FRAME_INTERVAL. Each frame reveals the text
+due at that time, so a slow consumer gets fewer and larger frames, and the
+number of frames is bounded by the replay time, not by the text length.
+"""
+import asyncio
+import time
+
+from fastchat.constants import (
+    REPLAY_CHARS_PER_SEC,
+    REPLAY_MAX_DURATION,
+    STREAM_FRAME_INTERVAL,
+)
+
+
+def _replay_pos(length, pos, elapsed, duration, frame_interval):
+    """The end of the text to show in the frame starting at elapsed seconds."""
+    if elapsed + frame_interval >= duration:
+        return length
+    return max(pos + 1, int(length * (elapsed + frame_interval) / duration))
+
+
+def _replay_duration(length, chars_per_sec, max_duration):
+    return min(length / chars_per_sec, max_duration)
+
+
+def replay_text(
+    text,
+    frame_interval=STREAM_FRAME_INTERVAL,
+    chars_per_sec=REPLAY_CHARS_PER_SEC,
+    max_duration=REPLAY_MAX_DURATION,
+):
+    """Yield growing prefixes of text as stream data, one per frame."""
+    duration = _replay_duration(len(text), chars_per_sec, max_duration)
+    start = time.monotonic()
+    pos = 0
+    while pos < len(text):
+        if pos > 0:
+            time.sleep(frame_interval)
+        elapsed = time.monotonic() - start
+        pos = _replay_pos(len(text), pos, elapsed, duration, frame_interval)
+        yield {"text": text[:pos], "error_code": 0}
+
+
+async def replay_text_async(
+    text,
+    frame_interval=STREAM_FRAME_INTERVAL,
+    chars_per_sec=REPLAY_CHARS_PER_SEC,
+    max_duration=REPLAY_MAX_DURATION,
+):
+    """The async version of replay_text."""
+    duration = _replay_duration(len(text), chars_per_sec, max_duration)
+    start = time.monotonic()
+    pos = 0
+    while pos < len(text):
+        if pos > 0:
+            await asyncio.sleep(frame_interval)
+        elapsed = time.monotonic() - start
+        pos = _replay_pos(len(text), pos, elapsed, duration, frame_interval)
+        yield {"text": text[:pos], "error_code": 0}
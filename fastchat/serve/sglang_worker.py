@@ -25,7 +25,7 @@ from fastchat.serve.model_worker import (
     logger,
     worker_id,
 )
-from fastchat.utils import get_context_length, is_partial_stop
+from fastchat.utils import get_context_length, is_partial_stop, merge_async_iterators
 
 app = FastAPI()
 
@@ -92,6 +92,7 @@ class SGLWorker(BaseModelWorker):
         stop_str = params.get("stop", None)
         stop_token_ids = params.get("stop_token_ids", None) or []
         echo = params.get("echo", True)
+        n = int(params.get("n", 1))
 
         # Handle stop_str
         stop = []
@@ -124,22 +125,47 @@ class SGLWorker(BaseModelWorker):
                 prompt[-1] = prompt[-1].strip()
                 prompt.append(load_image(images[i]))
 
-        state = pipeline.run(
-            prompt,
-            max_new_tokens,
-            stop=stop,
-            temperature=temperature,
-            top_p=top_p,
-            top_k=top_k,
-            frequency_penalty=frequency_penalty,
-            presence_penalty=presence_penalty,
-            stream=True,
-        )
-
+        # The samples of a request with n > 1 run concurrently and share the
+        # prefill of their prompt through SGLang's radix cache.
+        states = [
+            pipeline.run(
+                prompt,
+                max_new_tokens,
+                stop=stop,
+                temperature=temperature,
+                top_p=top_p,
+                top_k=top_k,
+                frequency_penalty=frequency_penalty,
+                presence_penalty=presence_penalty,
+                stream=True,
+            )
+            for _ in range(n)
+        ]
         entire_output = prompt if echo else ""
+        if n == 1:
+            async for ret in self.stream_state(
+                states[0], entire_output, stop, max_new_tokens
+            ):
+                yield ret
+            return
+
+        async for i, ret in merge_async_iterators(
+            *[
+                self.stream_state(state, entire_output, stop, max_new_tokens)
+                for state in states
+            ]
+        ):
+            ret["index"] = i
+            yield ret
+
+    async def stream_state(self, state, entire_output, stop, max_new_tokens):
+        prompt_tokens = completion_tokens = 0
+        meta_info = {}
         async for out, meta_info in state.text_async_iter(
             var_name="response", return_meta_data=True
         ):
+            prompt_tokens = meta_info["prompt_tokens"]
+            completion_tokens = meta_info["completion_tokens"]
             partial_stop = any(is_partial_stop(out, i) for i in stop)
 
             # prevent yielding partial stop sequence
@@ -147,9 +173,6 @@ class SGLWorker(BaseModelWorker):
                 continue
 
             entire_output += out
-            prompt_tokens = meta_info["prompt_tokens"]
-            completion_tokens = meta_info["completion_tokens"]
-
             ret = {
                 "text": entire_output,
                 "usage": {
@@ -158,9 +181,31 @@ class SGLWorker(BaseModelWorker):
                     "total_tokens": prompt_tokens + completion_tokens,
                 },
                 "error_code": 0,
+                "finish_reason": None,
             }
             yield ret
 
+        # The last chunk carries the finish reason, as in the other workers.
+        # Newer SGLang versions report it as {"type": "length", ...}.
+        finish_reason = meta_info.get("finish_reason")
+        if isinstance(finish_reason, dict):
+            finish_reason = finish_reason.get("type")
+        if finish_reason != "length":
+            if completion_tokens >= max_new_tokens:
+                finish_reason = "length"
+            else:
+                finish_reason = "stop"
+        yield {
+            "text": entire_output,
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+            "error_code": 0,
+            "finish_reason": finish_reason,
+        }
+
     async def generate_stream_gate(self, params):
         try:
             async for ret in self.generate_stream(params):
@@ -223,6 +268,12 @@ async def api_count_token(request: Request):
     return worker.count_token(params)
 
 
+@app.post("/count_token_batch")
+async def api_count_token_batch(request: Request):
+    params = await request.json()
+    return worker.count_token_batch(params)
+
+
 @app.post("/worker_get_conv_template")
 async def api_get_conv(request: Request):
     return worker.get_conv_template()
@@ -230,7 +281,7 @@ async def api_get_conv(request: Request):
 
 @app.post("/model_details")
 async def api_model_details(request: Request):
-    return {"context_length": worker.context_len}
+    return {"context_length": worker.context_len, "parallel_sampling": True}
 
 
 if __name__ == "__main__":
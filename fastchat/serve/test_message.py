@@ -45,23 +45,31 @@ def main():
         "stop_token_ids": conv.stop_token_ids,
         "echo": False,
     }
-    response = requests.post(
-        worker_addr + "/worker_generate_stream",
-        headers=headers,
-        json=gen_params,
-        stream=True,
-    )
+    try:
+        response = requests.post(
+            worker_addr + "/worker_generate_stream",
+            headers=headers,
+            json=gen_params,
+            stream=True,
+        )
 
-    print(f"{conv.roles[0]}: {args.message}")
-    print(f"{conv.roles[1]}: ", end="")
-    prev = 0
-    for chunk in response.iter_lines(decode_unicode=False, delimiter=b"\0"):
-        if chunk:
-            data = json.loads(chunk.decode())
-            output = data["text"].strip()
-            print(output[prev:], end="", flush=True)
-            prev = len(output)
-    print("")
+        print(f"{conv.roles[0]}: {args.message}")
+        print(f"{conv.roles[1]}: ", end="")
+        prev = 0
+        for chunk in response.iter_lines(decode_unicode=False, delimiter=b"\0"):
+            if chunk:
+                data = json.loads(chunk.decode())
+                output = data["text"].strip()
+                print(output[prev:], end="", flush=True)
+                prev = len(output)
+        print("")
+    finally:
+        if not args.worker_address:
+            # Let the controller count the request as finished
+            requests.post(
+                controller_addr + "/release_worker_address",
+                json={"worker_address": worker_addr},
+            )
 
 
 if __name__ == "__main__":
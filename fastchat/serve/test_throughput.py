@@ -9,6 +9,14 @@ import time
 from fastchat.conversation import get_conv_template
 
 
+def release_worker_address(worker_addr):
+    """Tell the controller that a request dispatched to worker_addr is done."""
+    requests.post(
+        args.controller_address + "/release_worker_address",
+        json={"worker_address": worker_addr},
+    )
+
+
 def main():
     if args.worker_address:
         worker_addr = args.worker_address
@@ -25,6 +33,9 @@ def main():
         )
         worker_addr = ret.json()["address"]
         print(f"worker_addr: {worker_addr}")
+        # The address is only looked up here, not used for a request
+        if worker_addr != "":
+            release_worker_address(worker_addr)
 
     if worker_addr == "":
         return
@@ -55,15 +66,21 @@ def main():
         else:
             thread_worker_addr = worker_addr
         print(f"thread {i} goes to {thread_worker_addr}")
-        response = requests.post(
-            thread_worker_addr + "/worker_generate_stream",
-            headers=headers,
-            json=ploads[i],
-            stream=False,
-        )
-        k = list(
-            response.iter_lines(chunk_size=8192, decode_unicode=False, delimiter=b"\0")
-        )
+        try:
+            response = requests.post(
+                thread_worker_addr + "/worker_generate_stream",
+                headers=headers,
+                json=ploads[i],
+                stream=False,
+            )
+            k = list(
+                response.iter_lines(
+                    chunk_size=8192, decode_unicode=False, delimiter=b"\0"
+                )
+            )
+        finally:
+            if args.test_dispatch:
+                release_worker_address(thread_worker_addr)
         # print(k)
         response_new_words = json.loads(k[-2].decode("utf-8"))["text"]
         error_code = json.loads(k[-2].decode("utf-8"))["error_code"]
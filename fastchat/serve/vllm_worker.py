@@ -80,8 +80,10 @@ class VLLMWorker(BaseModelWorker):
         if self.tokenizer.eos_token_id is not None:
             stop_token_ids.append(self.tokenizer.eos_token_id)
         echo = params.get("echo", True)
+        n = int(params.get("n", 1))
         use_beam_search = params.get("use_beam_search", False)
-        best_of = params.get("best_of", None)
+        # vLLM rejects best_of < n
+        best_of = max(params.get("best_of", None) or n, n)
 
         request = params.get("request", None)
 
@@ -104,7 +106,7 @@ class VLLMWorker(BaseModelWorker):
             top_p = 1.0
 
         sampling_params = SamplingParams(
-            n=1,
+            n=n,
             temperature=temperature,
             top_p=top_p,
             use_beam_search=use_beam_search,
@@ -117,6 +119,12 @@ class VLLMWorker(BaseModelWorker):
             best_of=best_of,
         )
         results_generator = engine.generate(context, sampling_params, request_id)
+        if n > 1:
+            async for ret in self.stream_samples(
+                results_generator, echo, stop, request, request_id
+            ):
+                yield ret
+            return
 
         async for request_output in results_generator:
             prompt = request_output.prompt
@@ -169,6 +177,50 @@ class VLLMWorker(BaseModelWorker):
             if aborted:
                 break
 
+    async def stream_samples(self, results_generator, echo, stop, request, request_id):
+        """Stream the samples of a request with n > 1, tagged with their index."""
+        finished = set()
+        async for request_output in results_generator:
+            aborted = False
+            if request and await request.is_disconnected():
+                await engine.abort(request_id)
+                aborted = True
+
+            prompt_tokens = len(request_output.prompt_token_ids)
+            for output in request_output.outputs:
+                if output.index in finished:
+                    continue
+                text = request_output.prompt + output.text if echo else output.text
+                finish_reason = "abort" if aborted else output.finish_reason
+                # prevent yielding partial stop sequence
+                if finish_reason is None and any(
+                    is_partial_stop(text, i) for i in stop
+                ):
+                    continue
+
+                completion_tokens = len(output.token_ids)
+                ret = {
+                    "index": output.index,
+                    "text": text,
+                    "error_code": 0,
+                    "usage": {
+                        "prompt_tokens": prompt_tokens,
+                        "completion_tokens": completion_tokens,
+                        "total_tokens": prompt_tokens + completion_tokens,
+                    },
+                    "cumulative_logprob": output.cumulative_logprob,
+                    "finish_reason": finish_reason,
+                }
+                if finish_reason is not None:
+                    finished.add(output.index)
+                    yield (
+                        json.dumps({**ret, **{"finish_reason": None}}) + "\0"
+                    ).encode()
+                yield (json.dumps(ret) + "\0").encode()
+
+            if aborted:
+                break
+
     async def generate(self, params):
         async for x in self.generate_stream(params):
             pass
@@ -231,6 +283,12 @@ async def api_count_token(request: Request):
     return worker.count_token(params)
 
 
+@app.post("/count_token_batch")
+async def api_count_token_batch(request: Request):
+    params = await request.json()
+    return worker.count_token_batch(params)
+
+
 @app.post("/worker_get_conv_template")
 async def api_get_conv(request: Request):
     return worker.get_conv_template()
@@ -238,7 +296,7 @@ async def api_get_conv(request: Request):
 
 @app.post("/model_details")
 async def api_model_details(request: Request):
-    return {"context_length": worker.context_len}
+    return {"context_length": worker.context_len, "parallel_sampling": True}
 
 
 if __name__ == "__main__":
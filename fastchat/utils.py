@@ -1,6 +1,7 @@
 """
 Common utilities.
 """
+import asyncio
 from asyncio import AbstractEventLoop
 from io import BytesIO
 import base64
@@ -11,7 +12,7 @@ import os
 import platform
 import sys
 import time
-from typing import AsyncGenerator, Generator
+from typing import AsyncGenerator, AsyncIterator, Generator, Tuple
 import warnings
 
 import requests
@@ -299,6 +300,45 @@ def iter_over_async(
         yield obj
 
 
+async def merge_async_iterators(
+    *iterators: AsyncIterator,
+) -> AsyncGenerator[Tuple[int, object], None]:
+    """
+    Run several async iterators concurrently and yield their items as they arrive
+
+    :param iterators: the AsyncIterators to merge
+    :returns: (index of the iterator, item) pairs
+    """
+    queue = asyncio.Queue()
+    finished = object()
+
+    async def drain(i, iterator):
+        try:
+            async for item in iterator:
+                await queue.put((i, item))
+            await queue.put((i, finished))
+        except Exception as e:
+            await queue.put((i, e))
+        finally:
+            if hasattr(iterator, "aclose"):
+                await iterator.aclose()
+
+    tasks = [asyncio.create_task(drain(i, it)) for i, it in enumerate(iterators)]
+    try:
+        num_running = len(tasks)
+        while num_running > 0:
+            i, item = await queue.get()
+            if item is finished:
+                num_running -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield i, item
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
 def detect_language(text: str) -> str:
     """Detect the langauge of a string."""
     import polyglot  # pip3 install polyglot pyicu pycld2
@@ -0,0 +1,184 @@
+"""
+Compare a new OpenAI client per message with the shared clients of api_clients.
+
+A stub OpenAI-compatible server in this process streams `--num-chunks` chunks
+per answer, `--chunk-delay` seconds apart. The first part sends messages one at
+a time, with a new client per message as before and with the shared client.
+The second part sends `--concurrency` messages at once, from a thread pool the
+size of Gradio's and from one event loop with openai_api_stream_iter_async.
+The stub serves plain HTTP, so the TLS handshake that a new connection to a
+real provider also pays is not included.
+
+Usage:
+python3 -m playground.benchmark.benchmark_api_client_pool --num-messages 200 --concurrency 200
+"""
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import sys
+import threading
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+import numpy as np
+import uvicorn
+
+from fastchat.serve import api_provider
+from fastchat.serve.api_clients import create_api_client, get_api_client
+from fastchat.serve.api_provider import (
+    openai_api_stream_iter,
+    openai_api_stream_iter_async,
+)
+
+MODEL_NAME = "stub-model"
+MESSAGES = [{"role": "user", "content": "Hi"}]
+
+app = FastAPI()
+client_ports = set()
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    await request.json()
+    client_ports.add(request.client.port)
+
+    async def generator():
+        for i in range(app.state.num_chunks):
+            chunk = {
+                "id": "chatcmpl-stub",
+                "object": "chat.completion.chunk",
+                "created": 0,
+                "model": MODEL_NAME,
+                "choices": [{"index": 0, "delta": {"content": "token "}}],
+            }
+            yield f"data: {json.dumps(chunk)}\n\n"
+            await asyncio.sleep(app.state.chunk_delay)
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(generator(), media_type="text/event-stream")
+
+
+def start_server(port):
+    server = uvicorn.Server(
+        uvicorn.Config(app, host="localhost", port=port, log_level="warning")
+    )
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    return server, thread
+
+
+def send_message(api_base):
+    for data in openai_api_stream_iter(
+        MODEL_NAME, MESSAGES, 0.7, 1.0, 64, api_base=api_base, api_key="EMPTY"
+    ):
+        pass
+    return data["text"]
+
+
+async def send_message_async(api_base):
+    async for data in openai_api_stream_iter_async(
+        MODEL_NAME, MESSAGES, 0.7, 1.0, 64, api_base=api_base, api_key="EMPTY"
+    ):
+        pass
+    return data["text"]
+
+
+def report(name, latencies, elapsed):
+    latencies = np.array(latencies) * 1e3
+    print(
+        f"{name:>28}: p50 {np.percentile(latencies, 50):7.1f} ms, "
+        f"p99 {np.percentile(latencies, 99):7.1f} ms, total {elapsed:6.2f} s, "
+        f"#connections {len(client_ports)}"
+    )
+    client_ports.clear()
+
+
+def run_sequential(api_base, num_messages):
+    latencies = []
+    tic = time.perf_counter()
+    for _ in range(num_messages):
+        start = time.perf_counter()
+        send_message(api_base)
+        latencies.append(time.perf_counter() - start)
+    return latencies, time.perf_counter() - tic
+
+
+def run_threads(api_base, num_messages, num_threads):
+    def timed_send(_):
+        start = time.perf_counter()
+        send_message(api_base)
+        return time.perf_counter() - start
+
+    tic = time.perf_counter()
+    with ThreadPoolExecutor(num_threads) as executor:
+        latencies = list(executor.map(timed_send, range(num_messages)))
+    return latencies, time.perf_counter() - tic
+
+
+async def run_async(api_base, num_messages):
+    async def timed_send():
+        start = time.perf_counter()
+        await send_message_async(api_base)
+        return time.perf_counter() - start
+
+    tic = time.perf_counter()
+    latencies = await asyncio.gather(*[timed_send() for _ in range(num_messages)])
+    return latencies, time.perf_counter() - tic
+
+
+def main(args):
+    # Importing api_provider redirects stdout to its logger.
+    sys.stdout = sys.__stdout__
+    logging.getLogger().setLevel(logging.WARNING)
+    api_provider.logger.setLevel(logging.WARNING)
+
+    app.state.num_chunks = args.num_chunks
+    app.state.chunk_delay = args.chunk_delay
+    server, thread = start_server(args.port)
+    api_base = f"http://localhost:{args.port}/v1"
+
+    print(f"one message at a time, {args.num_messages} messages")
+    api_provider.get_api_client = create_api_client
+    report("new client per message", *run_sequential(api_base, args.num_messages))
+    api_provider.get_api_client = get_api_client
+    report("shared client", *run_sequential(api_base, args.num_messages))
+
+    print(f"{args.concurrency} messages at once")
+    report(
+        f"{args.num_threads} threads, shared client",
+        *run_threads(api_base, args.concurrency, args.num_threads),
+    )
+    report(
+        "one event loop, async client",
+        *asyncio.run(run_async(api_base, args.concurrency)),
+    )
+
+    server.should_exit = True
+    thread.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=21201)
+    parser.add_argument("--num-messages", type=int, default=200)
+    parser.add_argument("--num-chunks", type=int, default=20)
+    parser.add_argument(
+        "--chunk-delay",
+        type=float,
+        default=0.01,
+        help="Seconds between the chunks of a streamed answer.",
+    )
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument(
+        "--num-threads",
+        type=int,
+        default=40,
+        help="Worker threads for the sync client, like Gradio's default pool.",
+    )
+    args = parser.parse_args()
+    main(args)
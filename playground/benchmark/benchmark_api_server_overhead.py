@@ -0,0 +1,172 @@
+"""
+Measure the latency the OpenAI API server adds on top of a model worker, with
+dispatch through the controller and with --direct-routing.
+
+A controller, an instantly answering fake worker and the API server all run in
+this process, so the numbers only contain the serving overhead.
+
+Usage:
+python3 -m playground.benchmark.benchmark_api_server_overhead --num-requests 500
+"""
+import argparse
+import json
+import logging
+import sys
+import threading
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+import numpy as np
+import requests
+import uvicorn
+
+from fastchat.conversation import get_conv_template
+from fastchat.serve import controller as controller_module
+from fastchat.serve import openai_api_server
+from fastchat.serve.controller import Controller
+
+MODEL_NAME = "fake-model"
+
+worker_app = FastAPI()
+
+
+def fake_output():
+    return {
+        "text": "Hello!",
+        "error_code": 0,
+        "usage": {"prompt_tokens": 8, "completion_tokens": 2, "total_tokens": 10},
+        "finish_reason": "stop",
+    }
+
+
+@worker_app.post("/worker_get_conv_template")
+async def worker_get_conv_template(request: Request):
+    return {"conv": get_conv_template("vicuna_v1.1")}
+
+
+@worker_app.post("/model_details")
+async def model_details(request: Request):
+    return {"context_length": 4096}
+
+
+@worker_app.post("/count_token")
+async def count_token(request: Request):
+    return {"count": 8, "error_code": 0}
+
+
+@worker_app.post("/worker_generate")
+async def worker_generate(request: Request):
+    await request.json()
+    return fake_output()
+
+
+@worker_app.post("/worker_generate_stream")
+async def worker_generate_stream(request: Request):
+    await request.json()
+
+    async def generator():
+        yield json.dumps(fake_output()).encode() + b"\0"
+
+    return StreamingResponse(generator())
+
+
+def start_server(app, port):
+    server = uvicorn.Server(
+        uvicorn.Config(app, host="localhost", port=port, log_level="warning")
+    )
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    return server, thread
+
+
+def measure(url, payload, num_requests):
+    latencies = []
+    with requests.Session() as s:
+        for _ in range(num_requests):
+            tic = time.perf_counter()
+            r = s.post(url, json=payload)
+            latencies.append(time.perf_counter() - tic)
+            assert r.status_code == 200, r.text
+    return np.array(latencies) * 1e3
+
+
+def main(args):
+    # Importing the servers redirects stdout to their loggers.
+    sys.stdout = sys.__stdout__
+    controller_module.logger.setLevel(logging.WARNING)
+
+    controller_url = f"http://localhost:{args.port}"
+    worker_url = f"http://localhost:{args.port + 1}"
+    api_url = f"http://localhost:{args.port + 2}"
+
+    controller_module.controller = Controller(args.dispatch_method)
+    servers = [
+        start_server(controller_module.app, args.port),
+        start_server(worker_app, args.port + 1),
+    ]
+    r = requests.post(
+        controller_url + "/register_worker",
+        json={
+            "worker_name": worker_url,
+            "check_heart_beat": False,
+            "worker_status": {
+                "model_names": [MODEL_NAME],
+                "speed": 1,
+                "queue_length": 0,
+            },
+        },
+    )
+    assert r.status_code == 200
+
+    settings = openai_api_server.app_settings
+    settings.controller_address = controller_url
+    # Start the routing table refresher, then switch modes per run below.
+    settings.direct_routing = True
+    servers.append(start_server(openai_api_server.app, args.port + 2))
+    while not openai_api_server.routing_table.list_models():
+        time.sleep(0.01)
+
+    chat_payload = {
+        "model": MODEL_NAME,
+        "messages": [{"role": "user", "content": "Hi"}],
+        "max_tokens": 16,
+        "stream": args.stream,
+    }
+    worker_payload = {"model": MODEL_NAME, "prompt": "Hi", "max_new_tokens": 16}
+
+    baseline = measure(
+        worker_url + "/worker_generate", worker_payload, args.num_requests
+    )
+    print(f"{'mode':>16} {'p50 (ms)':>10} {'p99 (ms)':>10} {'p50 overhead (ms)':>18}")
+    print(
+        f"{'worker only':>16} {np.percentile(baseline, 50):>10.2f} "
+        f"{np.percentile(baseline, 99):>10.2f} {0:>18.2f}"
+    )
+    for direct_routing in [False, True]:
+        settings.direct_routing = direct_routing
+        latencies = measure(
+            api_url + "/v1/chat/completions", chat_payload, args.num_requests
+        )
+        mode = "direct routing" if direct_routing else "controller"
+        overhead = np.percentile(latencies, 50) - np.percentile(baseline, 50)
+        print(
+            f"{mode:>16} {np.percentile(latencies, 50):>10.2f} "
+            f"{np.percentile(latencies, 99):>10.2f} {overhead:>18.2f}"
+        )
+
+    for server, thread in servers:
+        server.should_exit = True
+        thread.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=21101)
+    parser.add_argument("--num-requests", type=int, default=500)
+    parser.add_argument("--dispatch-method", type=str, default="shortest_queue")
+    parser.add_argument("--stream", action="store_true")
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,121 @@
+"""
+Compare the bootstrap BT confidence intervals computed with one L-BFGS fit per
+round over a process pool, with all rounds in one batched Newton solve, and with
+the sandwich covariance of a single fit.
+
+The battles are synthetic, with arena-like skewed pair frequencies. The script
+reports the wall time of each method after the shared preprocessing, the
+largest difference of the median ratings to the L-BFGS path and how many
+leaderboard positions (median order and rank by confidence interval) change.
+
+Usage:
+python3 -m playground.benchmark.benchmark_bt_bootstrap --num-battles 10000000
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from fastchat.serve.monitor.rating_systems import (
+    fit_bootstrap_bt,
+    fit_sandwich_bt,
+    preprocess_for_bt,
+)
+
+
+def make_battles(num_battles, num_models, seed=0):
+    rng = np.random.default_rng(seed)
+    strength = np.sort(rng.normal(scale=1.5, size=num_models))
+    # Popular models are sampled much more often.
+    popularity = rng.pareto(1.0, size=num_models) + 1
+    popularity /= popularity.sum()
+    a = rng.choice(num_models, size=num_battles, p=popularity)
+    b = rng.choice(num_models, size=num_battles, p=popularity)
+    same = a == b
+    b[same] = (b[same] + rng.integers(1, num_models, size=same.sum())) % num_models
+
+    p_a = 1 / (1 + np.exp(strength[b] - strength[a]))
+    u = rng.random(num_battles)
+    winner = np.where(rng.random(num_battles) < p_a, 0, 1)
+    winner[u < 0.2] = 2
+    winner[u < 0.05] = 3
+    names = [f"model-{i}" for i in range(num_models)]
+    outcomes = ["model_a", "model_b", "tie", "tie (bothbad)"]
+    return pd.DataFrame(
+        {
+            "model_a": pd.Categorical.from_codes(a, names),
+            "model_b": pd.Categorical.from_codes(b, names),
+            "winner": pd.Categorical.from_codes(winner, outcomes),
+        }
+    )
+
+
+def get_ranking(bootstrap_df):
+    """The rank by confidence interval, as in report_elo_analysis_results."""
+    q025 = bootstrap_df.quantile(0.025)
+    q975 = bootstrap_df.quantile(0.975)
+    return pd.Series(
+        {model: 1 + int((q025.drop(model) > q975[model]).sum()) for model in q025.index}
+    )
+
+
+def main(args):
+    tic = time.perf_counter()
+    battles = make_battles(args.num_battles, args.num_models)
+    print(
+        f"#battles: {len(battles)}, #models: {args.num_models}, "
+        f"#rounds: {args.num_round}, generated in {time.perf_counter() - tic:.1f} s"
+    )
+    tic = time.perf_counter()
+    matchups, outcomes, models, weights = preprocess_for_bt(battles)
+    print(
+        f"preprocess_for_bt: {time.perf_counter() - tic:.1f} s, "
+        f"#unique (matchup, outcome): {len(matchups)}"
+    )
+    table = (matchups, outcomes, models, weights, args.num_round)
+
+    methods = {
+        "lbfgs (pool)": lambda: fit_bootstrap_bt(
+            *table, num_cpu=args.num_cpu, solver="lbfgs"
+        ),
+        "newton (batched)": lambda: fit_bootstrap_bt(*table, solver="newton"),
+        "sandwich": lambda: fit_sandwich_bt(*table),
+    }
+    print(
+        f"{'method':>18} {'time (s)':>10} {'CI width':>9} {'max |diff|':>11} "
+        f"{'order changes':>14} {'CI rank changes':>16}"
+    )
+    for name, method in methods.items():
+        tic = time.perf_counter()
+        bootstrap_df = method()
+        elapsed = time.perf_counter() - tic
+        if name == "lbfgs (pool)":
+            reference = bootstrap_df
+
+        # Compare with the L-BFGS path
+        median = bootstrap_df.median()
+        ref_median = reference.median()
+        max_diff = (median - ref_median).abs().max()
+        order_changes = sum(
+            a != b
+            for a, b in zip(median.sort_values().index, ref_median.sort_values().index)
+        )
+        rank_changes = int(
+            (get_ranking(bootstrap_df) != get_ranking(reference)[median.index]).sum()
+        )
+        width = bootstrap_df.quantile(0.975) - bootstrap_df.quantile(0.025)
+        print(
+            f"{name:>18} {elapsed:>10.2f} {width.mean():>9.2f} {max_diff:>11.3f} "
+            f"{order_changes:>14} {rank_changes:>16}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-battles", type=int, default=10_000_000)
+    parser.add_argument("--num-models", type=int, default=100)
+    parser.add_argument("--num-round", type=int, default=100)
+    parser.add_argument("--num-cpu", type=int, default=None)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,148 @@
+"""
+Stress the stream relay of a hierarchical controller with many concurrent streams.
+
+A controller and a fake worker that streams slowly run in this process. The
+benchmark opens `--num-streams` concurrent streams through the controller's
+/worker_generate_stream, checks that every byte arrives intact, and reports the
+wall time and the peak number of threads. It also checks that closing a client
+stream early cancels the upstream worker stream.
+
+Usage:
+python3 -m playground.benchmark.benchmark_controller_relay --num-streams 2000
+"""
+import argparse
+import asyncio
+import json
+import logging
+import sys
+import threading
+import time
+
+import aiohttp
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+import uvicorn
+
+from fastchat.serve import controller as controller_module
+from fastchat.serve.controller import Controller
+
+MODEL_NAME = "fake-model"
+
+worker_app = FastAPI()
+worker_stats = {"started": 0, "cancelled": 0}
+
+
+@worker_app.post("/worker_generate_stream")
+async def worker_generate_stream(request: Request):
+    params = await request.json()
+
+    async def generator():
+        worker_stats["started"] += 1
+        try:
+            for i in range(params["num_chunks"]):
+                await asyncio.sleep(params["interval"])
+                ret = {"text": "x" * (i + 1), "error_code": 0}
+                yield json.dumps(ret).encode() + b"\0"
+        except asyncio.CancelledError:
+            worker_stats["cancelled"] += 1
+            raise
+
+    return StreamingResponse(generator())
+
+
+def start_server(app, port):
+    server = uvicorn.Server(
+        uvicorn.Config(
+            app, host="localhost", port=port, log_level="warning", backlog=8192
+        )
+    )
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    return server, thread
+
+
+async def read_stream(session, url, params):
+    async with session.post(url, json=params) as response:
+        data = await response.read()
+    chunks = data.split(b"\0")[:-1]
+    assert len(chunks) == params["num_chunks"], data[:200]
+    assert json.loads(chunks[-1])["text"] == "x" * params["num_chunks"]
+
+
+async def run_streams(url, args):
+    params = {
+        "model": MODEL_NAME,
+        "num_chunks": args.num_chunks,
+        "interval": args.interval,
+    }
+    peak_threads = threading.active_count()
+
+    async def watch_threads():
+        nonlocal peak_threads
+        while True:
+            peak_threads = max(peak_threads, threading.active_count())
+            await asyncio.sleep(0.05)
+
+    watcher = asyncio.create_task(watch_threads())
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        tic = time.perf_counter()
+        await asyncio.gather(
+            *[read_stream(session, url, params) for _ in range(args.num_streams)]
+        )
+        elapsed = time.perf_counter() - tic
+
+        # Disconnect after the first chunk and check that the worker stops.
+        cancelled = worker_stats["cancelled"]
+        params["num_chunks"] = 1000
+        async with session.post(url, json=params) as response:
+            await response.content.readuntil(b"\0")
+        await asyncio.sleep(0.5)
+        upstream_cancelled = worker_stats["cancelled"] > cancelled
+    watcher.cancel()
+    return elapsed, peak_threads, upstream_cancelled
+
+
+def main(args):
+    # Importing the controller redirects stdout to its logger.
+    sys.stdout = sys.__stdout__
+    controller_module.logger.setLevel(logging.WARNING)
+
+    controller_url = f"http://localhost:{args.port}"
+    worker_url = f"http://localhost:{args.port + 1}"
+    controller_module.controller = Controller("least_outstanding")
+    servers = [
+        start_server(controller_module.app, args.port),
+        start_server(worker_app, args.port + 1),
+    ]
+    controller_module.controller.add_worker(
+        worker_url,
+        controller_module.WorkerInfo([MODEL_NAME], 1, 0, False, time.time(), False),
+    )
+
+    elapsed, peak_threads, upstream_cancelled = asyncio.run(
+        run_streams(controller_url + "/worker_generate_stream", args)
+    )
+    ideal = args.num_chunks * args.interval
+    print(
+        f"#streams: {args.num_streams}, #chunks per stream: {args.num_chunks}, "
+        f"ideal time per stream: {ideal:.2f} s"
+    )
+    print(f"wall time: {elapsed:.2f} s, peak threads: {peak_threads}")
+    print(f"upstream cancelled on client disconnect: {upstream_cancelled}")
+
+    for server, thread in servers:
+        server.should_exit = True
+        thread.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=21121)
+    parser.add_argument("--num-streams", type=int, default=2000)
+    parser.add_argument("--num-chunks", type=int, default=20)
+    parser.add_argument("--interval", type=float, default=0.05)
+    args = parser.parse_args()
+    main(args)
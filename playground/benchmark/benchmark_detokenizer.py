@@ -0,0 +1,82 @@
+"""
+Compare the per-token CPU cost of full re-decoding and incremental detokenization
+as the output grows.
+
+Usage:
+python3 -m playground.benchmark.benchmark_detokenizer --tokenizer lmsys/vicuna-7b-v1.5 --max-len 4096
+"""
+import argparse
+import time
+
+from transformers import AutoTokenizer
+
+from fastchat.serve.inference import IncrementalDetokenizer, find_stop_str
+
+SAMPLE_TEXT = (
+    "FastChat is an open platform for training, serving, and evaluating large "
+    "language model based chatbots. 它支持多种语言，包括中文和日本語。 "
+    "The controller manages the distributed workers, and each model worker hosts "
+    "one or more models. Émojis like 🚀 and 🤖 span several UTF-8 bytes. "
+)
+
+
+def full_decode(tokenizer, output_ids, stream_interval, stop_str):
+    """The previous generate_stream behavior: decode everything at every yield."""
+    costs = []
+    for i in range(len(output_ids)):
+        tic = time.perf_counter()
+        if i % stream_interval == 0:
+            output = tokenizer.decode(
+                output_ids[: i + 1],
+                skip_special_tokens=True,
+                spaces_between_special_tokens=False,
+                clean_up_tokenization_spaces=True,
+            )
+            output.rfind(stop_str, 0)
+        costs.append(time.perf_counter() - tic)
+    return costs
+
+
+def incremental_decode(tokenizer, output_ids, stream_interval, stop_str):
+    costs = []
+    detokenizer = IncrementalDetokenizer(tokenizer)
+    num_detokenized = 0
+    checked_len = 0
+    for i in range(len(output_ids)):
+        tic = time.perf_counter()
+        if i % stream_interval == 0:
+            detokenizer.add_tokens(output_ids[num_detokenized : i + 1])
+            num_detokenized = i + 1
+            find_stop_str(detokenizer.text, stop_str, 0, checked_len)
+            checked_len = len(detokenizer.text)
+        costs.append(time.perf_counter() - tic)
+    return costs
+
+
+def main(args):
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer, use_fast=not args.slow)
+    output_ids = []
+    while len(output_ids) < args.max_len:
+        output_ids.extend(tokenizer(SAMPLE_TEXT, add_special_tokens=False).input_ids)
+    output_ids = output_ids[: args.max_len]
+
+    full = full_decode(tokenizer, output_ids, args.stream_interval, args.stop)
+    incr = incremental_decode(tokenizer, output_ids, args.stream_interval, args.stop)
+
+    print(f"{'tokens':>12} {'full (us/token)':>18} {'incremental (us/token)':>24}")
+    window = args.max_len // 8
+    for end in range(window, args.max_len + 1, window):
+        f = sum(full[end - window : end]) / window * 1e6
+        g = sum(incr[end - window : end]) / window * 1e6
+        print(f"{end - window:>5}-{end:<6} {f:>18.1f} {g:>24.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokenizer", type=str, default="lmsys/vicuna-7b-v1.5")
+    parser.add_argument("--slow", action="store_true", help="Use the slow tokenizer")
+    parser.add_argument("--max-len", type=int, default=4096)
+    parser.add_argument("--stream-interval", type=int, default=2)
+    parser.add_argument("--stop", type=str, default="</s>")
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,130 @@
+"""
+Compare the keyword filters of clean_battle_data with one `in` check per
+keyword against KeywordMatcher.
+
+The battles are read from a clean battle file with conversations (e.g. from
+`clean_battle_data.py --mode conv_release`) or generated: random text with
+arena-like lengths where a few percent of the battles contain a keyword. Both
+methods must flag the same battles. `--num-extra-words` adds random keywords to
+the identity list to show how each method scales with the list length.
+
+Usage:
+python3 -m playground.benchmark.benchmark_keyword_matcher --num-battles 20000
+python3 -m playground.benchmark.benchmark_keyword_matcher --clean-battle-file clean_battle_conv_20240101.json
+"""
+import argparse
+import random
+import string
+import time
+
+from fastchat.data import keyword_matcher
+from fastchat.data.keyword_matcher import KeywordMatcher
+from fastchat.serve.monitor.battle_store import load_battles
+from fastchat.serve.monitor.clean_battle_data import (
+    ERROR_WORDS,
+    IDENTITY_WORDS,
+    UNFINISHED_WORDS,
+)
+
+
+def make_messages(num_battles, seed=0):
+    rng = random.Random(seed)
+    vocab = [
+        "".join(rng.choices(string.ascii_lowercase, k=rng.randint(1, 10)))
+        for _ in range(5000)
+    ]
+    keywords = IDENTITY_WORDS + ERROR_WORDS + UNFINISHED_WORDS
+    messages = []
+    for _ in range(num_battles):
+        # Two turns of a prompt and two answers
+        words = rng.choices(vocab, k=int(rng.lognormvariate(5.5, 0.8)))
+        if rng.random() < 0.05:
+            words.insert(rng.randrange(len(words)), rng.choice(keywords))
+        messages.append(" ".join(words))
+    return messages
+
+
+def read_messages(clean_battle_file):
+    battles = load_battles(clean_battle_file, ["conversation_a", "conversation_b"])
+    messages = []
+    for conversation_a, conversation_b in zip(
+        battles["conversation_a"], battles["conversation_b"]
+    ):
+        text = "".join(
+            turn["content"] or "" for turn in conversation_a + conversation_b
+        )
+        messages.append(text.lower())
+    return messages
+
+
+def scan_lists(messages, categories):
+    """The loops of process_data before KeywordMatcher."""
+    flags = []
+    for text in messages:
+        found = []
+        for words in categories.values():
+            for word in words:
+                if word in text:
+                    found.append(word)
+                    break
+        flags.append(found)
+    return flags
+
+
+def scan_matcher(messages, matcher):
+    flags = []
+    for text in messages:
+        found = matcher.count(text)
+        flags.append([next(iter(x)) for x in found.values() if x])
+    return flags
+
+
+def main(args):
+    if args.clean_battle_file:
+        messages = read_messages(args.clean_battle_file)
+    else:
+        messages = make_messages(args.num_battles)
+    rng = random.Random(1)
+    extra_words = [
+        "".join(rng.choices(string.ascii_lowercase, k=8))
+        for _ in range(args.num_extra_words)
+    ]
+    categories = {
+        "identity": IDENTITY_WORDS + extra_words,
+        "error": ERROR_WORDS,
+        "unfinished": UNFINISHED_WORDS,
+    }
+    num_chars = sum(len(x) for x in messages)
+    num_words = sum(len(x) for x in categories.values())
+    print(
+        f"#battles: {len(messages)}, #chars: {num_chars / 1e6:.1f} M, "
+        f"#keywords: {num_words}"
+    )
+
+    methods = {
+        "in per keyword": lambda: scan_lists(messages, categories),
+        "KeywordMatcher": lambda: scan_matcher(messages, KeywordMatcher(categories)),
+    }
+    if keyword_matcher.ahocorasick is None:
+        print("pyahocorasick is not installed, KeywordMatcher uses its fallback")
+
+    reference = None
+    for name, method in methods.items():
+        tic = time.perf_counter()
+        flags = method()
+        elapsed = time.perf_counter() - tic
+        reference = reference or flags
+        num_flagged = sum(len(x) > 0 for x in flags)
+        print(
+            f"{name:>15}: {elapsed:.3f} s, {num_chars / elapsed / 1e6:.0f} M chars/s, "
+            f"#flagged: {num_flagged}, same flags: {flags == reference}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clean-battle-file", type=str)
+    parser.add_argument("--num-battles", type=int, default=20000)
+    parser.add_argument("--num-extra-words", type=int, default=0)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,83 @@
+"""
+Compare limit_user_votes with the previous implementation, which filtered the
+battles and concatenated the result once per day.
+
+The battles are synthetic: sorted timestamps over `--num-days` days and judges
+with heavy-tailed activity, so some judges exceed the daily limit. Both
+implementations must keep the same battles in the same order.
+
+Usage:
+python3 -m playground.benchmark.benchmark_limit_user_votes --num-battles 2000000 --num-days 1000
+"""
+import argparse
+from datetime import datetime
+import time
+
+import numpy as np
+import pandas as pd
+
+from fastchat.serve.monitor.elo_analysis import limit_user_votes
+
+
+def limit_user_votes_per_day(battles, daily_vote_per_user):
+    """The previous implementation."""
+    battles["date"] = battles["tstamp"].apply(
+        lambda x: datetime.fromtimestamp(x).strftime("%Y-%m-%d")
+    )
+
+    battles_new = pd.DataFrame()
+    for date in battles["date"].unique():
+        df_today = battles[battles["date"] == date]
+        df_sub = df_today.groupby("judge").head(daily_vote_per_user)
+        battles_new = pd.concat([battles_new, df_sub])
+    return battles_new
+
+
+def make_battles(num_battles, num_days, num_judges, seed=0):
+    rng = np.random.default_rng(seed)
+    start = 1682899200  # 2023-05-01
+    tstamp = np.sort(start + rng.random(num_battles) * num_days * 86400)
+    judge = rng.zipf(1.5, size=num_battles) % num_judges
+    return pd.DataFrame(
+        {
+            "model_a": rng.choice(["model-a", "model-b", "model-c"], num_battles),
+            "model_b": rng.choice(["model-d", "model-e", "model-f"], num_battles),
+            "winner": rng.choice(["model_a", "model_b", "tie"], num_battles),
+            "judge": [f"arena_user_{j}" for j in judge],
+            "tstamp": tstamp,
+        }
+    )
+
+
+def main(args):
+    battles = make_battles(args.num_battles, args.num_days, args.num_judges)
+    print(f"#battles: {len(battles)}, #days: {args.num_days}")
+
+    tic = time.perf_counter()
+    result = limit_user_votes(battles, args.daily_vote_per_user)
+    print(f"limit_user_votes: {time.perf_counter() - tic:.2f} s")
+
+    if not args.skip_reference:
+        tic = time.perf_counter()
+        expected = limit_user_votes_per_day(battles.copy(), args.daily_vote_per_user)
+        print(f"previous implementation: {time.perf_counter() - tic:.2f} s")
+        same = (
+            result.index.equals(expected.index)
+            and (result["date"].to_numpy() == expected["date"].to_numpy()).all()
+        )
+        print(f"same battles: {same}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-battles", type=int, default=2_000_000)
+    parser.add_argument("--num-days", type=int, default=1000)
+    parser.add_argument("--num-judges", type=int, default=100_000)
+    parser.add_argument("--daily-vote-per-user", type=int, default=5)
+    parser.add_argument(
+        "--skip-reference",
+        action="store_true",
+        help="Do not run the previous implementation, which takes minutes.",
+    )
+    args = parser.parse_args()
+    main(args)
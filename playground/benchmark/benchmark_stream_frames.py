@@ -0,0 +1,92 @@
+"""
+Measure the server CPU time per streamed token of the bot_response frame loop,
+with a full chatbot rebuild per chunk as before and with coalesce_frames and
+the cached Conversation.to_gradio_chatbot.
+
+A fake provider streams `--num-tokens` chunks at `--tokens-per-sec` into a
+conversation with `--num-turns` earlier turns. Each frame updates the last
+message, builds the chatbot and serializes it to JSON, which stands in for the
+Gradio payload. CPU time is measured for the whole process, so it includes the
+thread that coalesce_frames uses to advance the stream.
+
+Usage:
+python3 -m playground.benchmark.benchmark_stream_frames --num-tokens 2000 --tokens-per-sec 400
+"""
+import argparse
+import json
+import time
+
+from fastchat.conversation import get_conv_template
+from fastchat.serve.frame_coalescer import coalesce_frames
+
+
+def make_conversation(num_turns, message_len):
+    conv = get_conv_template("chatgpt")
+    for i in range(num_turns):
+        conv.append_message(conv.roles[0], f"question {i} " + "q" * message_len)
+        conv.append_message(conv.roles[1], f"answer {i} " + "a" * message_len)
+    conv.append_message(conv.roles[0], "Write a long answer.")
+    conv.append_message(conv.roles[1], None)
+    return conv
+
+
+def fake_stream(num_tokens, tokens_per_sec):
+    text = ""
+    for i in range(num_tokens):
+        text += f" tok{i}"
+        yield {"text": text, "error_code": 0}
+        time.sleep(1 / tokens_per_sec)
+
+
+def rebuild_chatbot(conv):
+    """The chatbot without the cache of earlier turns."""
+    return conv._to_gradio_chatbot_rows(conv.messages[conv.offset :])
+
+
+def run(conv, stream_iter, to_chatbot):
+    num_frames = 0
+    tic, cpu_tic = time.perf_counter(), time.process_time()
+    for data in stream_iter:
+        conv.update_last_message(data["text"].strip() + "▌")
+        json.dumps(to_chatbot(conv))
+        num_frames += 1
+    return time.perf_counter() - tic, time.process_time() - cpu_tic, num_frames
+
+
+def main(args):
+    print(
+        f"#tokens: {args.num_tokens} at {args.tokens_per_sec}/s, "
+        f"#earlier turns: {args.num_turns}"
+    )
+    modes = {
+        "rebuild per chunk": lambda stream: (stream, rebuild_chatbot),
+        "coalesced, cached": lambda stream: (
+            coalesce_frames(stream),
+            lambda conv: conv.to_gradio_chatbot(),
+        ),
+    }
+    for name, make in modes.items():
+        conv = make_conversation(args.num_turns, args.message_len)
+        stream_iter, to_chatbot = make(
+            fake_stream(args.num_tokens, args.tokens_per_sec)
+        )
+        elapsed, cpu, num_frames = run(conv, stream_iter, to_chatbot)
+        print(
+            f"{name:>18}: wall {elapsed:5.2f} s, #frames {num_frames:5d}, "
+            f"CPU {cpu * 1e3 / args.num_tokens:6.3f} ms/token"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-tokens", type=int, default=2000)
+    parser.add_argument("--tokens-per-sec", type=float, default=400)
+    parser.add_argument("--num-turns", type=int, default=10)
+    parser.add_argument(
+        "--message-len",
+        type=int,
+        default=2000,
+        help="Characters of each earlier message.",
+    )
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,229 @@
+"""
+Replay an arrival trace against simulated workers and compare the queueing delay
+of the controller dispatch methods.
+
+The simulation drives the real `Controller` dispatch code with a virtual clock.
+Each fake worker serves up to `--worker-concurrency` requests at a time, takes
+`ttft + output_tokens / tokens_per_second` seconds per request, releases its
+address when done and sends heart beats every `--heart-beat-interval` seconds.
+
+The trace is a JSON lines file with an arrival time in "tstamp" (or "start")
+and optionally the number of generated tokens in "output_tokens", so FastChat
+conversation logs can be replayed directly. Without a trace, a bursty Poisson
+trace is generated.
+
+Usage:
+python3 -m playground.benchmark.simulate_dispatch --num-requests 5000 --rate 2
+python3 -m playground.benchmark.simulate_dispatch --trace 2024-01-01-conv.json
+"""
+import argparse
+from collections import deque
+import heapq
+import json
+import logging
+import random
+import sys
+
+import numpy as np
+
+from fastchat.constants import LATENCY_EWMA_ALPHA, WORKER_HEART_BEAT_INTERVAL
+from fastchat.serve import controller as controller_module
+from fastchat.serve.controller import Controller, WorkerInfo
+
+DISPATCH_METHODS = [
+    "lottery",
+    "shortest_queue",
+    "power_of_two",
+    "least_outstanding",
+    "latency_ewma",
+]
+MODEL_NAME = "model"
+
+
+def load_trace(filename, mean_output_tokens, rng):
+    requests = []
+    with open(filename) as f:
+        for line in f:
+            row = json.loads(line)
+            tstamp = row.get("tstamp", row.get("start"))
+            if tstamp is None:
+                continue
+            output_tokens = row.get("output_tokens")
+            if output_tokens is None:
+                output_tokens = 1 + int(rng.exponential(mean_output_tokens))
+            requests.append((float(tstamp), int(output_tokens)))
+    requests.sort()
+    t0 = requests[0][0]
+    return [(t - t0, n) for t, n in requests]
+
+
+def synthetic_trace(num_requests, rate, burstiness, mean_output_tokens, rng):
+    """Poisson arrivals whose rate switches between calm and bursty periods."""
+    requests = []
+    t = 0.0
+    while len(requests) < num_requests:
+        burst = rng.random() < 0.2
+        period_rate = rate * burstiness if burst else rate
+        for _ in range(int(rng.integers(20, 100))):
+            t += rng.exponential(1 / period_rate)
+            requests.append((t, 1 + int(rng.exponential(mean_output_tokens))))
+    return requests[:num_requests]
+
+
+class FakeWorker:
+    def __init__(self, name, ttft, tokens_per_second, concurrency):
+        self.name = name
+        self.ttft = ttft
+        self.tokens_per_second = tokens_per_second
+        self.concurrency = concurrency
+        self.num_running = 0
+        self.waiting = deque()
+        # The moving averages this worker reports, as in BaseModelWorker
+        self.reported_ttft = None
+        self.reported_tokens_per_second = None
+
+    def queue_length(self):
+        return self.num_running + len(self.waiting)
+
+    def record_latency(self, ttft, tokens_per_second):
+        if self.reported_ttft is None:
+            self.reported_ttft = ttft
+            self.reported_tokens_per_second = tokens_per_second
+            return
+        self.reported_ttft += LATENCY_EWMA_ALPHA * (ttft - self.reported_ttft)
+        self.reported_tokens_per_second += LATENCY_EWMA_ALPHA * (
+            tokens_per_second - self.reported_tokens_per_second
+        )
+
+
+def simulate(dispatch_method, trace, args, seed):
+    random.seed(seed)
+    controller = Controller(dispatch_method)
+    workers = {}
+    for i, tokens_per_second in enumerate(args.worker_tokens_per_second):
+        worker = FakeWorker(
+            f"http://worker-{i}",
+            args.worker_ttft,
+            tokens_per_second,
+            args.worker_concurrency,
+        )
+        workers[worker.name] = worker
+        controller.add_worker(
+            worker.name, WorkerInfo([MODEL_NAME], 1, 0, False, 0.0, False)
+        )
+
+    events = []  # (time, seq, kind, payload)
+    seq = 0
+
+    def push(t, kind, payload):
+        nonlocal seq
+        heapq.heappush(events, (t, seq, kind, payload))
+        seq += 1
+
+    for arrival, output_tokens in trace:
+        push(arrival, "arrival", output_tokens)
+    for i, worker in enumerate(workers.values()):
+        # Spread the heart beats like independently started workers.
+        offset = args.heart_beat_interval * i / len(workers)
+        push(offset, "heart_beat", worker)
+
+    def start(worker, t, arrival, output_tokens):
+        worker.num_running += 1
+        queueing_delays.append(t - arrival)
+        push(
+            t + worker.ttft + output_tokens / worker.tokens_per_second, "finish", worker
+        )
+        worker.record_latency(worker.ttft, worker.tokens_per_second)
+
+    queueing_delays = []
+    num_done = 0
+    while num_done < len(trace):
+        t, _, kind, payload = heapq.heappop(events)
+        if kind == "arrival":
+            worker = workers[controller.get_worker_address(MODEL_NAME)]
+            if worker.num_running < worker.concurrency:
+                start(worker, t, t, payload)
+            else:
+                worker.waiting.append((t, payload))
+        elif kind == "finish":
+            worker = payload
+            worker.num_running -= 1
+            num_done += 1
+            controller.release_worker_address(worker.name)
+            if worker.waiting:
+                arrival, output_tokens = worker.waiting.popleft()
+                start(worker, t, arrival, output_tokens)
+        else:
+            worker = payload
+            controller.receive_heart_beat(
+                worker.name,
+                worker.queue_length(),
+                worker.reported_ttft,
+                worker.reported_tokens_per_second,
+            )
+            push(t + args.heart_beat_interval, "heart_beat", worker)
+
+    return np.array(queueing_delays)
+
+
+def main(args):
+    # Dispatch logs every request, which would dominate the simulation.
+    controller_module.logger.setLevel(logging.WARNING)
+    # Importing the controller redirects stdout to its logger.
+    sys.stdout = sys.__stdout__
+
+    rng = np.random.default_rng(args.seed)
+    if args.trace:
+        trace = load_trace(args.trace, args.mean_output_tokens, rng)
+    else:
+        trace = synthetic_trace(
+            args.num_requests, args.rate, args.burstiness, args.mean_output_tokens, rng
+        )
+    duration = trace[-1][0] - trace[0][0]
+    print(
+        f"#requests: {len(trace)}, duration: {duration:.1f} s, "
+        f"workers (tokens/s): {args.worker_tokens_per_second}"
+    )
+
+    print(f"{'dispatch method':>20} {'mean (s)':>10} {'p50 (s)':>10} {'p99 (s)':>10}")
+    for dispatch_method in args.dispatch_methods:
+        delays = simulate(dispatch_method, trace, args, args.seed)
+        print(
+            f"{dispatch_method:>20} {delays.mean():>10.3f} "
+            f"{np.percentile(delays, 50):>10.3f} {np.percentile(delays, 99):>10.3f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--trace", type=str, help="A JSON lines arrival trace")
+    parser.add_argument("--num-requests", type=int, default=5000)
+    parser.add_argument(
+        "--rate", type=float, default=2, help="Requests/sec of the synthetic trace"
+    )
+    parser.add_argument(
+        "--burstiness",
+        type=float,
+        default=3,
+        help="How much faster requests arrive during bursts of the synthetic trace",
+    )
+    parser.add_argument("--mean-output-tokens", type=float, default=200)
+    parser.add_argument(
+        "--worker-tokens-per-second",
+        type=lambda x: [float(v) for v in x.split(",")],
+        default=[20, 20, 40, 40, 80],
+        help="Comma separated decode speed of each simulated worker",
+    )
+    parser.add_argument("--worker-ttft", type=float, default=0.3)
+    parser.add_argument("--worker-concurrency", type=int, default=4)
+    parser.add_argument(
+        "--heart-beat-interval", type=float, default=WORKER_HEART_BEAT_INTERVAL
+    )
+    parser.add_argument(
+        "--dispatch-methods",
+        type=lambda x: x.split(","),
+        default=DISPATCH_METHODS,
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    main(args)
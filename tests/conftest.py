@@ -0,0 +1,76 @@
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+import pytest
+
+CORPUS = [
+    "FastChat is an open platform for training, serving, and evaluating chatbots.",
+    "The controller manages the distributed workers.",
+    "A model worker hosts one or more models and streams tokens back.",
+    "Hello, how are you doing today? I am fine, thank you.",
+]
+
+# The servers under test call build_logger when they are imported, which writes
+# to LOGDIR. Keep those logs out of the working tree.
+os.environ.setdefault("LOGDIR", tempfile.mkdtemp(prefix="fastchat_test_logs_"))
+
+
+@pytest.fixture(scope="session")
+def tiny_model():
+    """A tiny random Llama model and a byte-level BPE tokenizer built offline."""
+    torch = pytest.importorskip("torch")
+    transformers = pytest.importorskip("transformers")
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+
+    tok = Tokenizer(models.BPE())
+    tok.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tok.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=300,
+        special_tokens=["<s>", "</s>"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+    )
+    tok.train_from_iterator(CORPUS, trainer)
+    tokenizer = transformers.PreTrainedTokenizerFast(
+        tokenizer_object=tok, bos_token="<s>", eos_token="</s>"
+    )
+
+    torch.manual_seed(0)
+    config = transformers.LlamaConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=4,
+        max_position_embeddings=512,
+        bos_token_id=0,
+        eos_token_id=1,
+    )
+    model = transformers.LlamaForCausalLM(config).eval()
+    return model, tokenizer
+
+
+@pytest.fixture(scope="session")
+def battles():
+    """Synthetic anonymous arena battles between 8 models with known strengths."""
+    rng = np.random.default_rng(0)
+    num_battles, num_models = 5000, 8
+    strength = rng.normal(size=num_models)
+    a = rng.integers(num_models, size=num_battles)
+    b = (a + rng.integers(1, num_models, size=num_battles)) % num_models
+    p_a = 1 / (1 + np.exp(strength[b] - strength[a]))
+    u = rng.random(num_battles)
+    winner = np.where(u < p_a * 0.9, "model_a", "model_b")
+    winner[u > 0.9] = "tie"
+    return pd.DataFrame(
+        {
+            "model_a": [f"model-{i}" for i in a],
+            "model_b": [f"model-{i}" for i in b],
+            "winner": winner,
+            "tstamp": np.arange(num_battles, dtype=np.float64),
+            "anony": True,
+        }
+    )
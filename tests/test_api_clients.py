@@ -0,0 +1,45 @@
+"""
+Check that API clients are shared per settings and per event loop.
+
+Usage:
+python3 -m pytest tests/test_api_clients.py
+"""
+import asyncio
+
+import pytest
+
+pytest.importorskip("openai")
+
+from fastchat.serve.api_clients import get_api_client, get_http_session
+from fastchat.serve.api_provider import iterate_in_executor
+
+API_BASE = "http://localhost:8000/v1"
+
+
+def test_clients_are_shared():
+    client = get_api_client("openai", API_BASE, "key-1", timeout=180)
+    assert get_api_client("openai", API_BASE, "key-1", timeout=180) is client
+    assert get_api_client("openai", API_BASE, "key-2", timeout=180) is not client
+    assert get_api_client("openai", API_BASE, "key-1") is not client
+    assert get_http_session() is get_http_session()
+
+    async def get_async_clients():
+        return [get_api_client("openai_async", API_BASE, "key-1") for _ in range(2)]
+
+    first, second = asyncio.run(get_async_clients())
+    assert first is second
+    # A new event loop gets its own client and connections
+    assert asyncio.run(get_async_clients())[0] is not first
+    with pytest.raises(RuntimeError):
+        get_api_client("openai_async", API_BASE, "key-1")
+
+
+def test_iterate_in_executor():
+    def stream_iter():
+        for i in range(3):
+            yield {"text": "x" * i, "error_code": 0}
+
+    async def collect():
+        return [data["text"] async for data in iterate_in_executor(stream_iter())]
+
+    assert asyncio.run(collect()) == ["", "x", "xx"]
@@ -0,0 +1,148 @@
+"""
+Check that BattlePairSampler draws pairs with the frequencies of the former
+get_battle_pair.
+
+Usage:
+python3 -m pytest tests/test_battle_sampler.py
+"""
+from collections import Counter
+import re
+
+import numpy as np
+
+from fastchat.serve.battle_sampler import (
+    BattlePairSampler,
+    get_battle_pair_sampler,
+    get_sample_weight,
+)
+
+
+def reference_battle_pair(
+    models,
+    battle_targets,
+    outage_models,
+    sampling_weights,
+    sampling_boost_models,
+    strict_targets,
+    anon_models,
+):
+    """The former get_battle_pair of gradio_block_arena_anony."""
+
+    def is_model_match_pattern(model, patterns):
+        return any(re.match(p.replace("*", ".*"), model) for p in patterns)
+
+    model_weights = [
+        get_sample_weight(m, outage_models, sampling_weights, sampling_boost_models)
+        for m in models
+    ]
+    total_weight = np.sum(model_weights)
+    chosen_model = models[
+        np.random.choice(len(models), p=np.array(model_weights) / total_weight)
+    ]
+
+    rival_models = []
+    rival_weights = []
+    for model in models:
+        if model == chosen_model:
+            continue
+        if model in anon_models and chosen_model in anon_models:
+            continue
+        if chosen_model in strict_targets:
+            if not is_model_match_pattern(model, strict_targets[chosen_model]):
+                continue
+        if model in strict_targets:
+            if not is_model_match_pattern(chosen_model, strict_targets[model]):
+                continue
+        weight = get_sample_weight(model, outage_models, sampling_weights)
+        if (
+            weight != 0
+            and chosen_model in battle_targets
+            and model in battle_targets[chosen_model]
+        ):
+            weight = 0.5 * total_weight / len(battle_targets[chosen_model])
+        rival_models.append(model)
+        rival_weights.append(weight)
+    rival_weights = np.array(rival_weights) / np.sum(rival_weights)
+    rival_model = rival_models[np.random.choice(len(rival_models), p=rival_weights)]
+
+    if np.random.randint(2) == 0:
+        return chosen_model, rival_model
+    return rival_model, chosen_model
+
+
+CONFIG = (
+    ["gpt-4o", "gpt-4o-mini", "claude-3", "llama-3-8b", "llama-3-70b", "anon-a"],
+    {"gpt-4o": {"claude-3", "llama-3-70b"}},
+    ["llama-3-8b"],
+    {
+        "gpt-4o": 4,
+        "gpt-4o-mini": 2,
+        "claude-3": 1,
+        "llama-3-8b": 3,
+        "llama-3-70b": 1,
+        "anon-a": 0.5,
+    },
+    ["claude-3"],
+    {"llama-3-70b": ["gpt-*", "claude*"]},
+    ["anon-a", "gpt-4o-mini"],
+)
+
+
+def test_pair_frequencies_match_reference():
+    np.random.seed(0)
+    n = 40000
+    sampler = BattlePairSampler(*CONFIG)
+    observed = Counter(sampler.sample() for _ in range(n))
+    expected = Counter(reference_battle_pair(*CONFIG) for _ in range(n))
+
+    assert set(observed) == set(expected)
+    for pair in expected:
+        p = (observed[pair] + expected[pair]) / (2 * n)
+        sigma = np.sqrt(2 * p * (1 - p) / n)
+        assert abs(observed[pair] - expected[pair]) / n < 5 * sigma + 1e-3, pair
+
+    # Excluded pairs are never drawn
+    assert not any({"anon-a", "gpt-4o-mini"} == set(pair) for pair in observed)
+    assert not any("llama-3-8b" in pair for pair in observed)
+    assert all(
+        pair[1] in ("gpt-4o", "gpt-4o-mini", "claude-3")
+        for pair in observed
+        if pair[0] == "llama-3-70b"
+    )
+
+
+def test_sampler_is_rebuilt_on_config_change():
+    models = ["a", "b", "c"]
+    weights = {"a": 1, "b": 1, "c": 1}
+    targets, outage_models, boost_models = {}, [], []
+    sampler = get_battle_pair_sampler(
+        models, targets, outage_models, weights, boost_models
+    )
+    assert (
+        get_battle_pair_sampler(models, targets, outage_models, weights, boost_models)
+        is sampler
+    )
+
+    # Replacing a config object, as reloading it does, builds a new sampler
+    outage_models = ["c"]
+    new_sampler = get_battle_pair_sampler(
+        models, targets, outage_models, weights, boost_models
+    )
+    assert new_sampler is not sampler
+    assert all("c" not in new_sampler.sample() for _ in range(100))
+
+    assert BattlePairSampler(["a"], {}, [], {}, []).sample() == ("a", "a")
+
+
+def test_equal_configs_share_a_sampler():
+    # Reloading the model list on a page load builds equal but distinct objects
+    config = (["x", "y", "z"], {"x": {"y"}}, [], {"x": 1, "y": 2, "z": 1}, [])
+    sampler = get_battle_pair_sampler(*config)
+    reloaded = (
+        list(config[0]),
+        {"x": {"y"}},
+        [],
+        dict(reversed(config[3].items())),
+        [],
+    )
+    assert get_battle_pair_sampler(*reloaded) is sampler
@@ -0,0 +1,66 @@
+"""
+Check that the battle store round-trips battles and that both inputs of
+load_battles agree on columns and filters.
+
+Usage:
+python3 -m pytest tests/test_battle_store.py
+"""
+import json
+import os
+
+import pytest
+
+pytest.importorskip("pyarrow")
+
+from fastchat.serve.monitor.battle_store import load_battles, write_battles
+
+DAY = 24 * 3600
+
+
+def make_battles(num_battles, start=1699920000.0):
+    return [
+        {
+            "question_id": f"{i}e5",
+            "model_a": f"model-{i % 3}",
+            "model_b": f"model-{(i + 1) % 3}",
+            "winner": "model_a" if i % 2 else "tie",
+            "judge": f"arena_user_{i % 5}",
+            "anony": i % 4 != 0,
+            "language": "English",
+            "tstamp": start + i * DAY / 4,
+            "conversation_a": [{"role": "user", "content": f"question {i}"}],
+            "conversation_b": [{"role": "user", "content": f"question {i}"}],
+            "conv_metadata": {"sum_user_tokens": i, "header_count_a": {"h1": 0}},
+        }
+        for i in range(num_battles)
+    ]
+
+
+def test_round_trip_and_pushdown(tmp_path):
+    battles = make_battles(40)
+    root = str(tmp_path / "store")
+    write_battles(battles[:30], root)
+    write_battles(battles[30:], root)
+    assert len(os.listdir(root)) == 10
+
+    df = load_battles(root)
+    assert df.drop(columns=["date"]).to_dict("records") == battles
+
+    clean_battle_file = str(tmp_path / "clean_battle.json")
+    with open(clean_battle_file, "w") as fout:
+        json.dump(battles, fout)
+
+    columns = ["question_id", "model_a", "conv_metadata", "date"]
+    filters = [("anony", "==", True), ("date", ">=", "2023-11-18")]
+    from_store = load_battles(root, columns, filters)
+    from_file = load_battles(clean_battle_file, columns, filters)
+    assert list(from_store.columns) == columns
+    assert len(from_store) == 18
+    assert from_store.to_dict("records") == from_file.to_dict("records")
+
+
+def test_overwrite(tmp_path):
+    root = str(tmp_path / "store")
+    write_battles(make_battles(8), root)
+    write_battles(make_battles(4), root, mode="overwrite")
+    assert len(load_battles(root, columns=["tstamp"])) == 4
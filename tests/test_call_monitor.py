@@ -0,0 +1,83 @@
+"""
+Check the sliding-window call counters and log tailing of call_monitor.
+
+Usage:
+python3 -m pytest tests/test_call_monitor.py
+"""
+import json
+import random
+import time
+
+import pytest
+
+pytest.importorskip("fastapi")
+
+from fastchat.serve.call_monitor import Monitor, SlidingWindowCounter
+
+
+def test_counter_matches_bucketed_filter():
+    rng = random.Random(0)
+    counter = SlidingWindowCounter(3600, 60)
+    now = 1699920000.0
+    events = []
+    for _ in range(5000):
+        now += rng.expovariate(1 / 5)
+        key = rng.choice(["a", "b", "c"])
+        # Logs can arrive a little out of order
+        tstamp = now - rng.random() * 30
+        counter.add(key, tstamp, now=now)
+        events.append((key, tstamp))
+
+        if rng.random() < 0.05:
+            window_sec = rng.choice([None, 600, 3600])
+            num_buckets = 60 if window_sec is None else window_sec // 60
+            first_bucket = int(now // 60) - num_buckets + 1
+            for k in ["a", "b", "c", "d"]:
+                expected = sum(
+                    1
+                    for key, tstamp in events
+                    if key == k and first_bucket <= tstamp // 60 <= now // 60
+                )
+                assert counter.count(k, window_sec, now=now) == expected
+
+    # Keys expire after a quiet window
+    now += 3600
+    assert counter.counts(now=now) == {}
+    counter.prune(now=now)
+    assert counter.rings == {}
+
+
+def test_monitor_tails_logs(tmp_path):
+    now = time.time()
+    monitor = Monitor([str(tmp_path)])
+    monitor.model_call_limit_global = {"model-a": 3}
+    monitor.model_call_day_limit_per_user = {"model-a": 2}
+    log_file = tmp_path / "2024-01-01-conv.json"
+
+    def log_call(model, ip, tstamp, partial=False):
+        line = json.dumps({"type": "chat", "model": model, "ip": ip, "tstamp": tstamp})
+        with open(log_file, "a") as fout:
+            fout.write(line if partial else line + "\n")
+
+    log_call("model-a", "1.1.1.1", now - 2 * 3600)
+    log_call("model-a", "1.1.1.1", now - 10)
+    log_call("model-b", "2.2.2.2", now - 10)
+    monitor.read_new_calls(str(log_file))
+    assert monitor.get_model_call_stats() == {"model-a": 1, "model-b": 1}
+    assert monitor.is_user_limit_reached("model-a", "1.1.1.1")
+    assert not monitor.is_model_limit_reached("model-a")
+
+    # A line being written is read once it is complete
+    log_call("model-a", "2.2.2.2", now - 5, partial=True)
+    monitor.read_new_calls(str(log_file))
+    assert monitor.get_model_call_stats(target_model="model-a") == {"model-a": 1}
+    with open(log_file, "a") as fout:
+        fout.write("\n")
+    log_call("model-a", "3.3.3.3", now)
+    monitor.read_new_calls(str(log_file))
+    assert monitor.is_model_limit_reached("model-a")
+    assert monitor.get_user_call_stats(most_recent_min=24 * 60)["1.1.1.1"] == {
+        "call_dict": {"model-a": 2},
+        "total_calls": 2,
+    }
+    assert monitor.get_num_users() == 3
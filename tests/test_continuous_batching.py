@@ -0,0 +1,146 @@
+"""
+Check that continuous batching matches per-request generation on a tiny random model.
+
+Usage:
+python3 -m pytest tests/test_continuous_batching.py
+"""
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("torch")
+
+from fastchat.serve.continuous_batching import ContinuousBatchingEngine
+from fastchat.serve.inference import generate_stream
+
+PROMPTS = [
+    "Hello, how are",
+    "The controller manages the distributed workers and",
+    "FastChat",
+    "A model worker hosts one or more models",
+    "serving and evaluating",
+]
+
+
+def run_reference(model, tokenizer, params):
+    for output in generate_stream(model, tokenizer, dict(params), "cpu", 512):
+        pass
+    return output
+
+
+def test_batched_greedy_matches_sequential(tiny_model):
+    model, tokenizer = tiny_model
+    engine = ContinuousBatchingEngine(
+        model, tokenizer, "cpu", 512, stream_interval=1, max_batch_size=3
+    )
+    all_params = [
+        {
+            "prompt": prompt,
+            "temperature": 0.0,
+            "max_new_tokens": 8 + 5 * i,
+            "echo": False,
+            "stop": "zzz" if i % 2 else None,
+        }
+        for i, prompt in enumerate(PROMPTS)
+    ]
+
+    results = [None] * len(all_params)
+
+    def worker(i):
+        for output in engine.generate_stream(dict(all_params[i])):
+            pass
+        results[i] = output
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(len(PROMPTS))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(timeout=60)
+
+    for params, output in zip(all_params, results):
+        expected = run_reference(model, tokenizer, params)
+        assert output["text"] == expected["text"]
+        assert output["finish_reason"] == expected["finish_reason"]
+        assert output["usage"] == expected["usage"]
+    assert engine.get_num_running() == 0
+
+
+def test_parallel_samples_share_prefill(tiny_model):
+    model, tokenizer = tiny_model
+    engine = ContinuousBatchingEngine(
+        model, tokenizer, "cpu", 512, stream_interval=1, max_batch_size=4
+    )
+    params = {
+        "prompt": PROMPTS[1],
+        "temperature": 0.0,
+        "max_new_tokens": 12,
+        "echo": False,
+        "n": 3,
+    }
+
+    final = {}
+    for output in engine.generate_stream(dict(params)):
+        if output["finish_reason"] is not None:
+            final[output["index"]] = output
+
+    expected = run_reference(model, tokenizer, {**params, "n": 1})
+    assert sorted(final) == [0, 1, 2]
+    for output in final.values():
+        assert output["text"] == expected["text"]
+        assert output["usage"] == expected["usage"]
+    assert engine.get_num_running() == 0
+
+
+def test_closed_stream_leaves_batch(tiny_model):
+    model, tokenizer = tiny_model
+    engine = ContinuousBatchingEngine(
+        model, tokenizer, "cpu", 512, stream_interval=1, max_batch_size=4
+    )
+    params = {
+        "prompt": PROMPTS[0],
+        "temperature": 0.0,
+        "max_new_tokens": 400,
+        "echo": False,
+        "stop_token_ids": [],
+    }
+
+    stream = engine.generate_stream(dict(params))
+    output = next(stream)
+    assert output["finish_reason"] is None
+    stream.close()
+
+    deadline = time.time() + 10
+    while engine.get_num_running() > 0 and time.time() < deadline:
+        time.sleep(0.01)
+    assert engine.get_num_running() == 0
+
+
+def test_failed_prefill_does_not_hang(tiny_model):
+    model, tokenizer = tiny_model
+    engine = ContinuousBatchingEngine(
+        model, tokenizer, "cpu", 512, stream_interval=1, max_batch_size=2
+    )
+    params = {"prompt": PROMPTS[0], "temperature": 0.0, "max_new_tokens": 4}
+    errors = []
+
+    def worker():
+        try:
+            # A non-string stop fails with TypeError in the stop handling
+            list(engine.generate_stream(dict(params, stop=[1])))
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    thread.join(timeout=60)
+    assert not thread.is_alive()
+    assert [type(e) for e in errors] == [TypeError]
+
+    output = list(engine.generate_stream(dict(params, echo=False)))[-1]
+    assert output["finish_reason"] is not None
+    # The last output is sent before the sequence leaves the batch
+    deadline = time.monotonic() + 10
+    while engine.get_num_running() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert engine.get_num_running() == 0
@@ -0,0 +1,76 @@
+"""
+Check the load-aware dispatch methods of the controller.
+
+Usage:
+python3 -m pytest tests/test_controller_dispatch.py
+"""
+from fastchat.serve.controller import Controller, WorkerInfo
+
+
+def make_controller(dispatch_method, num_workers):
+    controller = Controller(dispatch_method)
+    for i in range(num_workers):
+        controller.add_worker(
+            f"http://worker-{i}", WorkerInfo(["m"], 1, 0, False, 0.0, False)
+        )
+    return controller
+
+
+def test_least_outstanding_spreads_bursts():
+    controller = make_controller("least_outstanding", 4)
+    addrs = [controller.get_worker_address("m") for _ in range(8)]
+    assert sorted(addrs) == sorted([f"http://worker-{i}" for i in range(4)] * 2)
+
+    controller.release_worker_address("http://worker-2")
+    assert controller.get_worker_address("m") == "http://worker-2"
+
+    # A heart beat does not drop requests that have not reached the worker yet
+    controller.receive_heart_beat("http://worker-0", 0)
+    assert controller.worker_info["http://worker-0"].num_outstanding == 2
+    controller.release_worker_address("http://worker-3")
+    assert controller.get_worker_address("m") == "http://worker-3"
+
+    # The worker's own queue counts when it is longer
+    controller.receive_heart_beat("http://worker-1", 9)
+    for addr in ["http://worker-0", "http://worker-3"]:
+        controller.release_worker_address(addr)
+        controller.release_worker_address(addr)
+    assert {controller.get_worker_address("m") for _ in range(4)} == {
+        "http://worker-0",
+        "http://worker-3",
+    }
+
+
+def test_lost_release_expires_after_a_heart_beat():
+    controller = make_controller("least_outstanding", 2)
+    assert controller.get_worker_address("m") == "http://worker-0"
+    # The request finishes, but its release never arrives.
+    controller.receive_heart_beat("http://worker-0", 1)
+    assert controller.worker_info["http://worker-0"].num_outstanding == 1
+    controller.receive_heart_beat("http://worker-0", 0)
+    assert controller.worker_info["http://worker-0"].num_outstanding == 0
+    addrs = {controller.get_worker_address("m") for _ in range(2)}
+    assert addrs == {"http://worker-0", "http://worker-1"}
+
+
+def test_power_of_two_picks_less_loaded():
+    controller = make_controller("power_of_two", 2)
+    controller.receive_heart_beat("http://worker-0", 5)
+    for _ in range(3):
+        assert controller.get_worker_address("m") == "http://worker-1"
+
+
+def test_latency_ewma_prefers_fast_workers():
+    controller = make_controller("latency_ewma", 2)
+    controller.receive_heart_beat("http://worker-0", 0, 0.2, 10.0)
+    controller.receive_heart_beat("http://worker-1", 0, 0.2, 40.0)
+    addrs = [controller.get_worker_address("m") for _ in range(5)]
+    # A request takes about 4x longer on worker-0, so it gets one in five.
+    assert addrs.count("http://worker-1") == 4
+
+
+def test_only_load_aware_methods_need_releases():
+    for method in ["lottery", "shortest_queue"]:
+        assert not make_controller(method, 1).counts_outstanding()
+    for method in ["power_of_two", "least_outstanding", "latency_ewma"]:
+        assert make_controller(method, 1).counts_outstanding()
@@ -0,0 +1,68 @@
+"""
+Check when the API server stops using the batched token counting of a worker.
+
+Usage:
+python3 -m pytest tests/test_count_tokens_batch.py
+"""
+import asyncio
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from fastchat.serve import openai_api_server
+from fastchat.serve.openai_api_server import (
+    count_token_batch_unsupported,
+    count_tokens_batch,
+)
+
+
+def run_with_worker(batch_statuses, num_calls):
+    """Count tokens num_calls times against a worker whose /count_token_batch
+    answers with the given statuses in turn, and return the batched calls."""
+    batch_calls = []
+
+    async def count_token_batch(request):
+        batch_calls.append(request.path)
+        status = batch_statuses[min(len(batch_calls), len(batch_statuses)) - 1]
+        if status != 200:
+            return web.Response(status=status)
+        params = await request.json()
+        return web.json_response({"counts": [len(p) for p in params["prompts"]]})
+
+    async def count_token(request):
+        params = await request.json()
+        return web.json_response({"count": len(params["prompt"]), "error_code": 0})
+
+    async def main():
+        app = web.Application()
+        app.router.add_post("/count_token_batch", count_token_batch)
+        app.router.add_post("/count_token", count_token)
+        server = TestServer(app)
+        await server.start_server()
+        worker_addr = str(server.make_url("")).rstrip("/")
+        openai_api_server.session = None
+        try:
+            for _ in range(num_calls):
+                counts = await count_tokens_batch("m", worker_addr, ["ab", "cde"])
+                assert list(counts) == [2, 3]
+        finally:
+            await openai_api_server.get_session().close()
+            openai_api_server.session = None
+            await server.close()
+        return worker_addr
+
+    worker_addr = asyncio.run(main())
+    return worker_addr, batch_calls
+
+
+def test_transient_errors_fall_back_for_one_call():
+    worker_addr, batch_calls = run_with_worker([503, 500, 200], 3)
+    assert len(batch_calls) == 3
+    assert worker_addr not in count_token_batch_unsupported
+
+
+def test_missing_endpoint_is_remembered():
+    worker_addr, batch_calls = run_with_worker([404], 3)
+    assert len(batch_calls) == 1
+    assert worker_addr in count_token_batch_unsupported
+    count_token_batch_unsupported.discard(worker_addr)
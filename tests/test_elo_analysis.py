@@ -0,0 +1,130 @@
+"""
+Check the vectorized battle filters of elo_analysis against per-row references.
+
+Usage:
+python3 -m pytest tests/test_elo_analysis.py
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("plotly")
+pytest.importorskip("pytz")
+
+from fastchat.serve.monitor.elo_analysis import (
+    compute_pairwise_win_fraction,
+    get_model_pair_stats,
+    limit_user_votes,
+    outlier_detect,
+)
+from fastchat.serve.monitor.incremental_rating import IncrementalBTRating
+
+
+def get_vote(model_a, model_b, winner):
+    """The vote for the first model by name: 1 win, 0.5 tie, 0 loss."""
+    first = min(model_a, model_b)
+    if winner in ["tie", "tie (bothbad)"]:
+        return 0.5
+    if (winner == "model_a" and model_a == first) or (
+        winner == "model_b" and model_b == first
+    ):
+        return 1
+    return 0
+
+
+def reference_bad_users(model_pair_stats, battles, max_vote=100, alpha=0.05):
+    """One martingale test per user over materialized pair ratings."""
+    user_vote_cnt = battles["judge"].value_counts()
+    bad_users = []
+    for user in user_vote_cnt[user_vote_cnt >= 5].index:
+        p_upper, p_lower = [], []
+        for row in battles[battles["judge"] == user].head(max_vote).itertuples():
+            pair = tuple(sorted([row.model_a, row.model_b]))
+            vote = get_vote(row.model_a, row.model_b, row.winner)
+            stats = model_pair_stats[pair]
+            ratings = np.array([1] * stats["win"] + [0] * stats["loss"])
+            with np.errstate(divide="ignore", invalid="ignore"):
+                p_upper.append(np.mean(ratings <= vote) if len(ratings) else np.nan)
+                p_lower.append(np.mean(ratings >= vote) if len(ratings) else np.nan)
+                M_upper = np.prod(1 / (2 * np.array(p_upper)))
+                M_lower = np.prod(1 / (2 * np.array(p_lower)))
+            if M_upper > 1 / alpha or M_lower > 1 / alpha:
+                bad_users.append(user)
+                break
+    return bad_users
+
+
+def test_outlier_detect_matches_reference(battles):
+    battles = battles.assign(judge=[f"user-{i % 97}" for i in range(len(battles))])
+    # Users that always vote for the weaker model
+    win_rate = battles.groupby("model_a")["winner"].apply(
+        lambda x: (x == "model_a").mean()
+    )
+    biased = battles["judge"].isin(["user-1", "user-2", "user-3", "user-4"])
+    battles.loc[biased, "winner"] = [
+        "model_a" if win_rate[a] < win_rate[b] else "model_b"
+        for a, b in zip(battles["model_a"][biased], battles["model_b"][biased])
+    ]
+    # A pair with only ties makes the p-values nan, which never flags a user
+    ties = pd.DataFrame(
+        {"model_a": "x", "model_b": "z", "winner": "tie", "judge": ["user-4"] * 5}
+    )
+    battles = pd.concat([ties, battles], ignore_index=True)
+
+    model_pair_stats = get_model_pair_stats(battles)
+    expected_stats = {}
+    for a, b, winner in zip(battles.model_a, battles.model_b, battles.winner):
+        stats = expected_stats.setdefault(
+            tuple(sorted([a, b])), {"win": 0, "loss": 0, "tie": 0}
+        )
+        stats[{1: "win", 0: "loss", 0.5: "tie"}[get_vote(a, b, winner)]] += 1
+    assert model_pair_stats == expected_stats
+
+    expected = reference_bad_users(model_pair_stats, battles)
+    assert sorted(expected) == ["user-1", "user-2", "user-3"]
+    filtered = outlier_detect(model_pair_stats, battles)
+    assert filtered.equals(battles[~battles["judge"].isin(expected)])
+
+
+def test_limit_user_votes_matches_per_day_filter(battles):
+    from datetime import datetime
+
+    rng = np.random.default_rng(1)
+    battles = battles.assign(
+        judge=[f"user-{i}" for i in rng.integers(20, size=len(battles))],
+        tstamp=1699920000.0 + rng.random(len(battles)) * 30 * 86400,
+    )
+    limited = limit_user_votes(battles, 3)
+
+    dates = [datetime.fromtimestamp(x).strftime("%Y-%m-%d") for x in battles.tstamp]
+    battles = battles.assign(date=dates)
+    expected = pd.concat(
+        [
+            battles[battles["date"] == date].groupby("judge").head(3)
+            for date in battles["date"].unique()
+        ]
+    )
+    assert limited.equals(expected)
+
+
+def test_pairwise_tables_match_elo_analysis(battles):
+    rating = IncrementalBTRating()
+    rating.add_battles(battles)
+    win_fraction, battle_counts = rating.get_pairwise_tables()
+
+    battles_no_ties = battles[battles["winner"] != "tie"]
+    expected = compute_pairwise_win_fraction(battles_no_ties, None)
+    np.testing.assert_allclose(
+        win_fraction.loc[expected.index, expected.columns], expected
+    )
+    ptbl = pd.pivot_table(
+        battles_no_ties,
+        index="model_a",
+        columns="model_b",
+        aggfunc="size",
+        fill_value=0,
+    )
+    expected = ptbl + ptbl.T
+    np.testing.assert_array_equal(
+        battle_counts.loc[expected.index, expected.columns], expected
+    )
@@ -0,0 +1,70 @@
+"""
+Check that IncrementalDetokenizer streams the same text as decoding all tokens
+at once, including characters split over several byte-level tokens.
+
+Usage:
+python3 -m pytest tests/test_incremental_detokenizer.py
+"""
+import pytest
+
+from fastchat.serve.inference import IncrementalDetokenizer
+
+TEXTS = [
+    "Hello, how are you doing today?",
+    "héllo wörld, naïve café",
+    "你好，世界！FastChat 很好。",
+    "Emoji 🤖🎉 and a family 👨‍👩‍👧 in the middle of text.",
+]
+
+
+def decode(tokenizer, token_ids):
+    return tokenizer.decode(
+        token_ids, skip_special_tokens=True, clean_up_tokenization_spaces=True
+    )
+
+
+@pytest.mark.parametrize("tokens_per_step", [1, 2, 3])
+@pytest.mark.parametrize("text", TEXTS)
+def test_streamed_text_matches_decode(tiny_model, text, tokens_per_step):
+    _, tokenizer = tiny_model
+    prompt_ids = tokenizer("The controller manages").input_ids
+    output_ids = tokenizer(text).input_ids
+
+    for context in [[], prompt_ids]:
+        detokenizer = IncrementalDetokenizer(tokenizer, context)
+        deltas = []
+        for i in range(0, len(output_ids), tokens_per_step):
+            step = output_ids[i : i + tokens_per_step]
+            final = i + tokens_per_step >= len(output_ids)
+            deltas.append(detokenizer.add_tokens(step, final=final))
+            # Incomplete characters are held back until their last byte
+            assert "�" not in deltas[-1]
+
+        assert "".join(deltas) == decode(tokenizer, output_ids)
+        assert detokenizer.text == decode(tokenizer, context + output_ids)
+
+
+@pytest.mark.parametrize("echo", [False, True])
+def test_stream_logprobs_cover_the_output(tiny_model, echo):
+    from fastchat.serve.inference import generate_stream
+
+    model, tokenizer = tiny_model
+    prompt = "The controller manages the workers"
+    params = {
+        "prompt": prompt,
+        "temperature": 0.0,
+        "max_new_tokens": 12,
+        "echo": echo,
+        "logprobs": 1,
+        "stop_token_ids": [],
+    }
+    for output in generate_stream(model, tokenizer, params, "cpu", 512):
+        pass
+    logprobs = output["logprobs"]
+    num_tokens = output["usage"]["completion_tokens"] + 1
+    if echo:
+        num_tokens += output["usage"]["prompt_tokens"]
+    for key in ["text_offset", "tokens", "token_logprobs", "top_logprobs"]:
+        assert len(logprobs[key]) == num_tokens, key
+    # Only the first prompt token has no logprob
+    assert all(x is not None for x in logprobs["token_logprobs"][int(echo) :])
@@ -0,0 +1,82 @@
+"""
+Check that incrementally updated BT ratings match a full refit.
+
+Usage:
+python3 -m pytest tests/test_incremental_rating.py
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from fastchat.serve.monitor.battle_store import load_battles
+from fastchat.serve.monitor.incremental_rating import (
+    IncrementalBTRating,
+    filter_battles,
+    get_filter_settings,
+)
+from fastchat.serve.monitor.rating_systems import compute_bt
+
+
+def test_incremental_matches_full_fit(battles):
+    rating = IncrementalBTRating()
+    # The last chunk brings a model that was not seen before.
+    chunks = [battles[:2000], battles[2000:4000], battles[4000:]]
+    chunks[0] = chunks[0][
+        (chunks[0]["model_a"] != "model-7") & (chunks[0]["model_b"] != "model-7")
+    ]
+    for chunk in chunks:
+        rating.add_battles(chunk)
+        incremental = rating.fit()
+
+    full = compute_bt(pd.concat(chunks))
+    assert list(incremental.index) == list(full.index)
+    np.testing.assert_allclose(incremental[full.index], full, atol=0.01)
+    assert rating.last_tstamp == battles["tstamp"].max()
+
+
+def test_reingesting_adds_only_new_battles(battles, tmp_path):
+    pytest.importorskip("pyarrow")
+    battles = battles.assign(question_id=[f"q{i}" for i in range(len(battles))])
+    rating = IncrementalBTRating(late_window=100)
+    rating.add_battles(battles[:3000])
+
+    # A late vote older than the last one and a vote with the same tstamp
+    late = battles.iloc[[2950, 2999]].assign(question_id=["late", "same-tstamp"])
+    battle_file = str(tmp_path / "clean_battle.json")
+    pd.concat([battles, late]).sort_values("tstamp", kind="stable").to_json(
+        battle_file, orient="records"
+    )
+
+    # The votes before the late window are not read again
+    new_battles = load_battles(battle_file, filters=rating.get_filters())
+    assert new_battles["tstamp"].min() == 2999 - 100
+    assert len(new_battles) == len(battles) - 2899 + 2
+    rating.add_battles(new_battles)
+    assert rating.num_battles == len(battles) + 2
+
+    new_battles = load_battles(battle_file, filters=rating.get_filters())
+    assert len(new_battles) == 100 + 1
+    rating.add_battles(new_battles)
+    assert rating.num_battles == len(battles) + 2
+    assert rating.counts.sum() == len(battles) + 2
+
+    # Saving forgets the ids before the window, which are skipped by tstamp
+    state_file = str(tmp_path / "bt_state.pkl")
+    rating.save(state_file)
+    rating = IncrementalBTRating.load(state_file)
+    assert len(rating.battle_ids) == 100 + 1
+    rating.add_battles(battles)
+    assert rating.num_battles == len(battles) + 2
+
+
+def test_state_rejects_other_filters(battles, tmp_path):
+    settings = get_filter_settings(exclude_models=["model-7"], exclude_tie=True)
+    rating = IncrementalBTRating(filter_settings=settings)
+    rating.add_battles(filter_battles(battles, **settings))
+    state_file = str(tmp_path / "bt_state.pkl")
+    rating.save(state_file)
+
+    same = get_filter_settings(exclude_tie=True, exclude_models=["model-7"])
+    assert IncrementalBTRating.load(state_file, same).num_battles == rating.num_battles
+    with pytest.raises(ValueError):
+        IncrementalBTRating.load(state_file, get_filter_settings(exclude_tie=True))
@@ -0,0 +1,82 @@
+"""
+Check that log ingestion only reads complete lines appended since the last pass.
+
+Usage:
+python3 -m pytest tests/test_ingest_battle_logs.py
+"""
+import json
+
+import pytest
+
+pytest.importorskip("pyarrow")
+pytest.importorskip("tiktoken")
+pytest.importorskip("plotly")
+
+from fastchat.serve.monitor import ingest_battle_logs as ingest
+from fastchat.serve.monitor.battle_store import load_battles
+from fastchat.serve.monitor.clean_battle_data import read_new_votes
+
+
+def make_line(i, type="leftvote"):
+    row = {"tstamp": 1699920000.0 + i, "type": type, "models": ["", ""], "ip": "x"}
+    return (json.dumps(row) + "\n").encode()
+
+
+def fake_process_data_parallel(data, *args):
+    battles = [
+        {"model_a": "a", "model_b": "b", "winner": "model_a", "tstamp": row["tstamp"]}
+        for row in data
+    ]
+    return battles, {}, {}, {}
+
+
+def test_read_new_votes_stops_at_partial_line(tmp_path):
+    log_file = tmp_path / "2023-11-14-conv.json"
+    log_file.write_bytes(make_line(0) + make_line(1, "chat") + make_line(2)[:10])
+
+    votes, offset = read_new_votes(str(log_file))
+    assert [row["tstamp"] for row in votes] == [1699920000.0]
+    assert offset == len(make_line(0) + make_line(1, "chat"))
+
+    with open(log_file, "ab") as fout:
+        fout.write(make_line(2)[10:])
+    votes, offset = read_new_votes(str(log_file), offset)
+    assert [row["tstamp"] for row in votes] == [1699920002.0]
+    assert offset == log_file.stat().st_size
+
+
+def test_read_new_votes_skips_malformed_line(tmp_path):
+    log_file = tmp_path / "2023-11-14-conv.json"
+    # A truncated line that was appended to, and a line cut off by a restart
+    bad_lines = make_line(1)[:20] + make_line(2) + b'{"type": "leftvote"\n'
+    log_file.write_bytes(make_line(0) + bad_lines + make_line(3))
+
+    votes, offset = read_new_votes(str(log_file))
+    assert [row["tstamp"] for row in votes] == [1699920000.0, 1699920003.0]
+    assert offset == log_file.stat().st_size
+
+
+def test_ingest_appends_new_votes(tmp_path, monkeypatch):
+    monkeypatch.setattr(ingest, "process_data_parallel", fake_process_data_parallel)
+    log_file = tmp_path / "2023-11-14-conv.json"
+    store_dir = str(tmp_path / "store")
+    checkpoint_file = str(tmp_path / "checkpoint.json")
+    args = ([str(log_file)], store_dir, checkpoint_file)
+
+    log_file.write_bytes(make_line(0) + make_line(1))
+    assert ingest.ingest_battle_logs(*args, num_processes=1) == 2
+    assert ingest.ingest_battle_logs(*args, num_processes=1) == 0
+
+    # An interrupted pass is rolled back before the votes are read again
+    checkpoint = ingest.load_checkpoint(checkpoint_file)
+    with open(log_file, "ab") as fout:
+        fout.write(make_line(2))
+    ingest.write_battles(
+        fake_process_data_parallel([{"tstamp": 0.0}])[0], store_dir, write_id="w"
+    )
+    checkpoint["pending_write"] = "w"
+    ingest.save_checkpoint(checkpoint, checkpoint_file)
+    assert ingest.ingest_battle_logs(*args, num_processes=1) == 1
+
+    tstamps = load_battles(store_dir, columns=["tstamp"])["tstamp"]
+    assert list(tstamps - 1699920000.0) == [0, 1, 2]
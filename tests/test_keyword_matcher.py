@@ -0,0 +1,42 @@
+"""
+Check that KeywordMatcher finds the same keywords with and without pyahocorasick.
+
+Usage:
+python3 -m pytest tests/test_keyword_matcher.py
+"""
+import pytest
+
+from fastchat.data import keyword_matcher
+from fastchat.data.keyword_matcher import KeywordMatcher
+
+CATEGORIES = {
+    "identity": ["ChatGPT", "gpt-4", "openai", "Tülu"],
+    "error": ["**api request error**", "gpt"],
+    "unfinished": ["▌"],
+}
+TEXT = "I am ChatGPT-4, made by OpenAI. gpt-4 or TÜLU? ▌"
+EXPECTED = {
+    "identity": {"chatgpt": 1, "gpt-4": 2, "openai": 1, "tülu": 1},
+    "error": {"gpt": 2},
+    "unfinished": {"▌": 1},
+}
+
+
+@pytest.mark.parametrize("use_automaton", [True, False])
+def test_count(monkeypatch, use_automaton):
+    if use_automaton:
+        pytest.importorskip("ahocorasick")
+    else:
+        monkeypatch.setattr(keyword_matcher, "ahocorasick", None)
+    matcher = KeywordMatcher(CATEGORIES)
+
+    found = matcher.count(TEXT)
+    assert found == EXPECTED
+    # The first keyword of a category is the first listed one
+    assert next(iter(found["identity"])) == "chatgpt"
+    assert matcher.count("nothing here") == {name: {} for name in CATEGORIES}
+    case_sensitive = KeywordMatcher({"x": ["OpenAI", "openai"]}, ignore_case=False)
+    assert case_sensitive.count(TEXT) == {"x": {"OpenAI": 1}}
+    assert not KeywordMatcher({"blocked": []}).contains(TEXT, "blocked")
+    # Overlapping occurrences are counted, and empty keywords never match
+    assert KeywordMatcher({"x": ["aa", ""]}).count("aaa") == {"x": {"aa": 2}}
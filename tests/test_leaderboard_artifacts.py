@@ -0,0 +1,125 @@
+"""
+Check that leaderboard artifacts load back like the elo_results pickle.
+
+Usage:
+python3 -m pytest tests/test_leaderboard_artifacts.py
+"""
+import os
+
+import pandas as pd
+import pytest
+
+pytest.importorskip("pyarrow")
+go = pytest.importorskip("plotly.graph_objects")
+
+from fastchat.serve.monitor.leaderboard_artifacts import (
+    export_leaderboard_artifacts,
+    load_leaderboard_artifacts,
+)
+
+
+def make_results(rating):
+    table = pd.DataFrame(
+        {
+            "rating": [rating, 1000.0],
+            "rating_q975": [rating + 5, 1005.0],
+            "rating_q025": [rating - 5, 995.0],
+            "num_battles": [500, 400],
+        },
+        index=["model-a", "model-b"],
+    )
+    return {
+        "leaderboard_table_df": table,
+        "win_fraction_heatmap": go.Figure(go.Bar(x=["model-a"], y=[rating])),
+        "bootstrap_elo_rating": None,
+        "last_updated_datetime": "2024-01-01 00:00:00 PST",
+    }
+
+
+def test_round_trip_and_reload(tmp_path):
+    elo_results = {
+        "text": {"full": make_results(1100.0), "coding": make_results(1200.0)},
+        "vision": {"full": make_results(1050.0)},
+    }
+    export_leaderboard_artifacts(elo_results, tmp_path)
+    results = load_leaderboard_artifacts(tmp_path)
+
+    assert list(results) == ["text", "vision"]
+    assert list(results["text"]) == ["full", "coding"]
+    coding = results["text"]["coding"]
+    assert set(coding) == {
+        "last_updated_datetime",
+        "leaderboard_table_df",
+        "win_fraction_heatmap",
+    }
+    assert coding["last_updated_datetime"] == "2024-01-01 00:00:00 PST"
+    pd.testing.assert_frame_equal(
+        coding["leaderboard_table_df"],
+        elo_results["text"]["coding"]["leaderboard_table_df"],
+    )
+    assert (
+        coding["win_fraction_heatmap"]
+        == elo_results["text"]["coding"]["win_fraction_heatmap"]
+    )
+    # Unchanged files are served from the cache
+    assert coding["leaderboard_table_df"] is coding["leaderboard_table_df"]
+
+    # A new export is picked up without loading the artifacts again
+    export_leaderboard_artifacts(
+        {"text": {"full": make_results(1300.0)}, "vision": {}}, tmp_path
+    )
+    filename = tmp_path / "text" / "full" / "leaderboard_table_df.parquet"
+    os.utime(filename, (0, 0))
+    os.utime(tmp_path / "manifest.json", (0, 0))
+    assert list(results["text"]) == ["full"]
+    assert results["text"]["full"]["leaderboard_table_df"]["rating"].iloc[0] == 1300
+
+
+def test_cache_is_bounded(tmp_path):
+    categories = {f"c{i}": make_results(1000.0 + i) for i in range(5)}
+    export_leaderboard_artifacts({"text": categories}, tmp_path)
+    results = load_leaderboard_artifacts(tmp_path, max_cached_files=3)
+
+    for i in range(5):
+        table = results["text"][f"c{i}"]["leaderboard_table_df"]
+        assert table["rating"].iloc[0] == 1000 + i
+    file_cache = results["text"].file_cache
+    # The manifest and the two latest tables
+    assert len(file_cache.cache) == 3
+    assert str(tmp_path / "manifest.json") in file_cache.cache
+
+
+def test_build_leaderboard_tab(tmp_path):
+    gr = pytest.importorskip("gradio")
+    from fastchat.serve.monitor.monitor import build_leaderboard_tab
+
+    def make_full_results(rating):
+        results = make_results(rating)
+        results["leaderboard_table_df"]["final_ranking"] = [1, 2]
+        for key in ["battle_count_heatmap", "average_win_rate_bar"]:
+            results[key] = results["win_fraction_heatmap"]
+        results["bootstrap_elo_rating"] = results["win_fraction_heatmap"]
+        return results
+
+    elo_results = {
+        "text": {
+            "full": make_full_results(1100.0),
+            "full_style_control": make_full_results(1090.0),
+            "coding": make_full_results(1200.0),
+        },
+        "vision": {"full": make_full_results(1050.0)},
+    }
+    export_leaderboard_artifacts(elo_results, tmp_path / "artifacts")
+
+    table_file = tmp_path / "leaderboard_table.csv"
+    table_file.write_text(
+        "key,Model,MT-bench (score),MMLU,Knowledge cutoff date,License,Organization,Link\n"
+        "model-a,Model A,8.5,0.8,2023/12,Proprietary,Org A,https://a.example\n"
+        "model-b,Model B,7.0,0.6,2023/10,Apache 2.0,Org B,https://b.example\n"
+    )
+
+    with gr.Blocks():
+        components = build_leaderboard_tab(
+            str(tmp_path / "artifacts"), str(table_file), None, show_plot=True
+        )
+    assert len(components) == 5
@@ -0,0 +1,40 @@
+"""
+Check that closing a worker stream stops the generation right away.
+
+Usage:
+python3 -m pytest tests/test_model_worker_stream.py
+"""
+import asyncio
+import json
+
+from fastchat.serve.base_model_worker import BaseModelWorker, stream_until_disconnect
+
+
+def test_closing_the_stream_closes_the_generator():
+    worker = BaseModelWorker(
+        "http://controller", "http://worker", "test", "model", ["m"], 1, "vicuna_v1.1"
+    )
+    events = []
+
+    def generate_stream_gate():
+        try:
+            for i in range(100):
+                yield json.dumps({"text": str(i), "error_code": 0}).encode() + b"\0"
+        finally:
+            events.append("generator closed")
+
+    # Hold a reference, so the generator is not just finalized when dropped
+    generator = generate_stream_gate()
+
+    async def consume_one_chunk():
+        stream = stream_until_disconnect(
+            worker.track_latency(generator), lambda: events.append("released")
+        )
+        async for chunk in stream:
+            break
+        # What Starlette does when the client disconnects
+        await stream.aclose()
+
+    asyncio.run(consume_one_chunk())
+    assert events == ["generator closed", "released"]
+    assert worker.ttft is None
@@ -0,0 +1,98 @@
+"""
+Check that the API server collects the samples of a parallel sampling worker.
+
+Usage:
+python3 -m pytest tests/test_parallel_sampling.py
+"""
+import asyncio
+import json
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from fastchat.constants import ErrorCode
+from fastchat.serve import openai_api_server
+from fastchat.serve.openai_api_server import generate_completions
+
+
+def run_with_worker(chunks, n):
+    """Generate n samples from a worker that streams the given chunks."""
+
+    async def model_details(request):
+        return web.json_response({"context_length": 2048, "parallel_sampling": True})
+
+    async def generate_stream(request):
+        response = web.StreamResponse()
+        await response.prepare(request)
+        for chunk in chunks:
+            await response.write(json.dumps(chunk).encode() + b"\0")
+        await response.write_eof()
+        return response
+
+    async def main():
+        app = web.Application()
+        app.router.add_post("/model_details", model_details)
+        app.router.add_post("/worker_generate_stream", generate_stream)
+        server = TestServer(app)
+        await server.start_server()
+        worker_addr = str(server.make_url("")).rstrip("/")
+        openai_api_server.session = None
+        try:
+            return await generate_completions({"model": "m"}, n, worker_addr)
+        finally:
+            await openai_api_server.get_session().close()
+            openai_api_server.session = None
+            await server.close()
+
+    return asyncio.run(main())
+
+
+def make_chunk(index, text, finish_reason=None):
+    return {
+        "index": index,
+        "text": text,
+        "error_code": 0,
+        "finish_reason": finish_reason,
+    }
+
+
+def test_samples_are_collected():
+    chunks = [
+        make_chunk(1, "b"),
+        make_chunk(0, "a"),
+        make_chunk(1, "bb", "stop"),
+        make_chunk(0, "aa", "length"),
+    ]
+    outputs = run_with_worker(chunks, 2)
+    assert [(c["text"], c["finish_reason"]) for c in outputs] == [
+        ("aa", "length"),
+        ("bb", "stop"),
+    ]
+
+
+def test_unfinished_sample_is_an_error():
+    # Sample 1 stops after a partial chunk and sample 2 never starts
+    chunks = [make_chunk(0, "a", "stop"), make_chunk(1, "b")]
+    outputs = run_with_worker(chunks, 3)
+    assert outputs[0]["text"] == "a"
+    assert [c["error_code"] for c in outputs] == [
+        0,
+        ErrorCode.INTERNAL_ERROR,
+        ErrorCode.INTERNAL_ERROR,
+    ]
+
+
+def test_finish_reason_only_on_last_chunk():
+    # SGLang-shaped stream: no finish_reason key until the final chunk
+    chunks = [
+        {"index": 0, "text": "a", "error_code": 0},
+        {"index": 1, "text": "b", "error_code": 0},
+        {"index": 1, "text": "bb", "error_code": 0},
+        {"index": 0, "text": "aa", "error_code": 0, "finish_reason": "stop"},
+        {"index": 1, "text": "bb", "error_code": 0, "finish_reason": "length"},
+    ]
+    outputs = run_with_worker(chunks, 2)
+    assert [(c["text"], c["finish_reason"]) for c in outputs] == [
+        ("aa", "stop"),
+        ("bb", "length"),
+    ]
@@ -0,0 +1,91 @@
+"""
+Check that reusing cached prompt prefixes does not change the generated text.
+
+Usage:
+python3 -m pytest tests/test_prefix_cache.py
+"""
+import pytest
+
+pytest.importorskip("torch")
+
+from fastchat.serve.inference import generate_stream
+from fastchat.serve.prefix_cache import PrefixCache
+
+
+def generate(model, tokenizer, prompt, prefix_cache=None):
+    params = {
+        "prompt": prompt,
+        "temperature": 0.0,
+        "max_new_tokens": 24,
+        "echo": False,
+        "stop_token_ids": [],
+    }
+    for output in generate_stream(
+        model, tokenizer, params, "cpu", 512, prefix_cache=prefix_cache
+    ):
+        pass
+    return output["text"]
+
+
+def test_multi_turn_reuses_prefix(tiny_model):
+    model, tokenizer = tiny_model
+    prefix_cache = PrefixCache(max_bytes=2**30, block_size=4)
+
+    prompt = "USER: Hello, how are you doing today? ASSISTANT:"
+    for turn in range(3):
+        cached = generate(model, tokenizer, prompt, prefix_cache)
+        assert cached == generate(model, tokenizer, prompt)
+        prompt = f"{prompt}{cached} USER: The controller manages workers. ASSISTANT:"
+
+    stats = prefix_cache.get_stats()
+    assert stats["misses"] == 1
+    assert stats["hits"] == 2
+    assert stats["hit_tokens"] > 0
+
+
+def test_lru_eviction_respects_budget(tiny_model):
+    model, tokenizer = tiny_model
+    prefix_cache = PrefixCache(max_bytes=2**30, block_size=4)
+    generate(model, tokenizer, "FastChat is an open platform", prefix_cache)
+    entry_bytes = prefix_cache.get_stats()["num_bytes"]
+
+    prefix_cache.max_bytes = int(entry_bytes * 1.5)
+    generate(model, tokenizer, "The controller manages the workers", prefix_cache)
+    stats = prefix_cache.get_stats()
+    assert stats["evictions"] == 1
+    assert stats["num_entries"] == 1
+    assert stats["num_bytes"] <= prefix_cache.max_bytes
+
+
+def make_kv(num_tokens):
+    import torch
+
+    return [(torch.zeros(1, 1, num_tokens, 2), torch.zeros(1, 1, num_tokens, 2))]
+
+
+class CollidingPrefixCache(PrefixCache):
+    """Every sequence has the same block hashes."""
+
+    def _block_hashes(self, token_ids, max_len):
+        return list(range(max_len // self.block_size))
+
+
+def test_hash_collision_is_a_miss():
+    prefix_cache = CollidingPrefixCache(max_bytes=2**20, block_size=4)
+    prefix_cache.insert([1, 2, 3, 4, 5, 6, 7, 8], make_kv(8), None)
+    assert prefix_cache.lookup([9, 9, 9, 9, 9, 9, 9, 9, 9]) == (0, None)
+    assert prefix_cache.lookup([1, 2, 3, 4, 5, 6, 7, 8, 9])[0] == 8
+
+
+def test_evicting_an_entry_keeps_shared_blocks():
+    entry_bytes = 2 * 8 * 2 * 4
+    prefix_cache = PrefixCache(max_bytes=int(entry_bytes * 2.5), block_size=4)
+    prefix_cache.insert([1, 2, 3, 4, 5, 6, 7, 8], make_kv(8), None)
+    # Shares its first block with the entry above
+    prefix_cache.insert([1, 2, 3, 4, 9, 9, 9, 9], make_kv(8), None)
+    assert prefix_cache.lookup([1, 2, 3, 4, 5, 6, 7, 8, 0])[0] == 8
+
+    # Evicts the second entry, which is now the least recently used
+    prefix_cache.insert([7, 7, 7, 7, 7, 7, 7, 7], make_kv(8), None)
+    assert prefix_cache.get_stats()["evictions"] == 1
+    assert prefix_cache.lookup([1, 2, 3, 4, 9, 9, 9, 9, 0])[0] == 4
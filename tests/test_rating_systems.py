@@ -0,0 +1,196 @@
+"""
+Check the batched BT solvers against the per-round L-BFGS fits and the cached
+style features.
+
+Usage:
+python3 -m pytest tests/test_rating_systems.py
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+from fastchat.serve.monitor.rating_systems import (
+    add_style_features,
+    compute_bootstrap_bt,
+    fit_bt,
+    fit_bt_batched,
+    fit_contextual_bt,
+    fit_contextual_bt_batched,
+    fit_sandwich_bt,
+    fit_bootstrap_bt,
+    preprocess_for_bt,
+    preprocess_for_style,
+)
+
+
+def test_batched_newton_matches_lbfgs(battles):
+    matchups, outcomes, models, weights = preprocess_for_bt(battles)
+    rng = np.random.default_rng(0)
+    boot_weights = rng.multinomial(len(battles), weights / weights.sum(), size=8)
+    boot_weights = boot_weights / len(battles)
+
+    batched = fit_bt_batched(
+        matchups, outcomes, boot_weights, len(models), np.log(10.0)
+    )
+    for ratings, w in zip(batched, boot_weights):
+        expected = fit_bt(matchups, outcomes, w, len(models), np.log(10.0))
+        np.testing.assert_allclose(ratings * 400, expected * 400, atol=0.05)
+
+
+def add_sparse_models(battles):
+    """Add a model with two battles and a pair of models that only meet each other,
+    so that most bootstrap rounds leave a model without battles."""
+    extra = pd.DataFrame(
+        {
+            "model_a": ["model-rare", "model-rare", "model-iso-a"],
+            "model_b": ["model-0", "model-0", "model-iso-b"],
+            "winner": ["model_a", "model_a", "model_b"],
+        }
+    )
+    return pd.concat([battles, extra], ignore_index=True)
+
+
+def test_bootstrap_newton_with_sparse_models(battles):
+    battles = add_sparse_models(battles)[["model_a", "model_b", "winner"]]
+    np.random.seed(0)
+    newton = compute_bootstrap_bt(battles, num_round=50)
+    np.random.seed(0)
+    lbfgs = compute_bootstrap_bt(battles, num_round=50, solver="lbfgs")
+    assert np.isfinite(newton.values).all()
+
+    # model-rare has no finite rating, so compare the others relative to model-0
+    common = [f"model-{i}" for i in range(8)]
+    relative = lambda df: df[common].sub(df["model-0"], axis=0)
+    np.testing.assert_allclose(relative(newton), relative(lbfgs), atol=0.5)
+
+
+def test_sandwich_ci_matches_bootstrap(battles):
+    table = preprocess_for_bt(battles)
+    bootstrap_df = fit_bootstrap_bt(*table, num_round=200)
+    sandwich_df = fit_sandwich_bt(*table, num_round=2000)
+    ratio = sandwich_df.std() / bootstrap_df.std()
+    assert ratio.between(0.8, 1.25).all()
+
+
+def make_conv_metadata(rng, num_battles):
+    return [
+        {
+            "sum_assistant_a_tokens": int(rng.integers(1, 1000)),
+            "sum_assistant_b_tokens": int(rng.integers(1, 1000)),
+            "header_count_a": {"h1": int(rng.integers(3)), "h2": int(rng.integers(3))},
+            "header_count_b": {"h1": int(rng.integers(3)), "h2": int(rng.integers(3))},
+            "list_count_a": {"ordered": int(rng.integers(5))},
+            "list_count_b": {"ordered": int(rng.integers(5))},
+            "bold_count_a": {"**": int(rng.integers(5))},
+            "bold_count_b": {"**": int(rng.integers(5))},
+        }
+        for _ in range(num_battles)
+    ]
+
+
+def test_style_features_are_cached(battles, tmp_path):
+    battle_file = str(tmp_path / "clean_battle.json")
+    battles = battles.copy()
+    battles["conv_metadata"] = make_conv_metadata(
+        np.random.default_rng(0), len(battles)
+    )
+    battles.to_json(battle_file)
+
+    expected = preprocess_for_style(battles)
+    add_style_features(battles, battle_file)
+    battles["conv_metadata"] = None  # the cached columns are used from now on
+    add_style_features(battles, battle_file)
+    for x, y in zip(preprocess_for_style(battles), expected):
+        np.testing.assert_array_equal(np.asarray(x), np.asarray(y))
+
+
+def test_style_cache_is_keyed_by_battles(battles, tmp_path):
+    battle_file = str(tmp_path / "clean_battle.json")
+    battles = battles.copy()
+    battles["conv_metadata"] = make_conv_metadata(
+        np.random.default_rng(0), len(battles)
+    )
+    battles.to_json(battle_file)
+    add_style_features(battles[:2000].copy(), battle_file)
+
+    # Other battles of the same file with the same count are not served the cache
+    other = battles[2000:4000].copy()
+    expected = preprocess_for_style(other)
+    add_style_features(other, battle_file)
+    for x, y in zip(preprocess_for_style(other), expected):
+        np.testing.assert_array_equal(np.asarray(x), np.asarray(y))
+
+
+def test_style_cache_of_a_battle_store(battles, tmp_path):
+    store = tmp_path / "battles"
+    partition = store / "date=2024-01-01" / "part-0.parquet"
+    partition.parent.mkdir(parents=True)
+    partition.write_bytes(b"v1")
+    battles = battles.copy()
+    rng = np.random.default_rng(0)
+    battles["conv_metadata"] = make_conv_metadata(rng, len(battles))
+    add_style_features(battles, str(store))
+
+    # Rewriting a partition does not change the mtime of the store directory
+    battles["conv_metadata"] = make_conv_metadata(rng, len(battles))
+    partition.write_bytes(b"v2")
+    mtime = os.path.getmtime(str(store) + ".style.npz") + 10
+    os.utime(partition, (mtime, mtime))
+    # Without all the cached columns, the new conv_metadata is parsed
+    expected = preprocess_for_style(battles.drop(columns=["sum_assistant_a_tokens"]))
+    add_style_features(battles, str(store))
+    for x, y in zip(preprocess_for_style(battles), expected):
+        np.testing.assert_array_equal(np.asarray(x), np.asarray(y))
+
+
+def test_batched_contextual_bt_matches_lbfgs(battles):
+    battles = battles.copy()
+    battles["conv_metadata"] = make_conv_metadata(
+        np.random.default_rng(0), len(battles)
+    )
+    matchups, features, outcomes, models = preprocess_for_style(battles)
+    boot_idxs = np.random.default_rng(0).integers(len(battles), size=(4, len(battles)))
+    boot_weights = np.stack(
+        [np.bincount(idxs, minlength=len(battles)) for idxs in boot_idxs]
+    ).astype(np.float64)
+
+    batched = fit_contextual_bt_batched(
+        matchups, features, outcomes, len(models), boot_weights
+    )
+    for params, idxs in zip(batched, boot_idxs):
+        expected = fit_contextual_bt(matchups, features, outcomes, models, idxs=idxs)
+        np.testing.assert_allclose(
+            params[: len(models)] * 400, expected[: len(models)] * 400, atol=0.05
+        )
+        np.testing.assert_allclose(
+            params[len(models) :], expected[len(models) :], atol=1e-4
+        )
+
+
+def test_batched_contextual_bt_with_sparse_models(battles):
+    battles = add_sparse_models(battles)
+    battles["conv_metadata"] = make_conv_metadata(
+        np.random.default_rng(0), len(battles)
+    )
+    matchups, features, outcomes, models = preprocess_for_style(battles)
+    boot_idxs = np.random.default_rng(1).integers(len(battles), size=(4, len(battles)))
+    boot_weights = np.stack(
+        [np.bincount(idxs, minlength=len(battles)) for idxs in boot_idxs]
+    ).astype(np.float64)
+
+    batched = fit_contextual_bt_batched(
+        matchups, features, outcomes, len(models), boot_weights
+    )
+    for params, idxs in zip(batched, boot_idxs):
+        expected = fit_contextual_bt(matchups, features, outcomes, models, idxs=idxs)
+        # L-BFGS stops early on the flat rating of model-rare
+        np.testing.assert_allclose(
+            params[: len(models)] * 400, expected[: len(models)] * 400, atol=0.2
+        )
+
+    # without regularization the hessian is singular in every row
+    unregularized = fit_contextual_bt_batched(
+        matchups, features, outcomes, len(models), boot_weights, reg=0.0
+    )
+    assert np.isfinite(unregularized).all()
@@ -0,0 +1,34 @@
+"""
+Check that replayed answers take a bounded number of frames and time.
+
+Usage:
+python3 -m pytest tests/test_replay_streamer.py
+"""
+import asyncio
+import time
+
+from fastchat.serve.replay_streamer import replay_text, replay_text_async
+
+
+def test_replay_is_bounded_by_time():
+    text = "0123456789" * 2000
+    tic = time.monotonic()
+    frames = [
+        data["text"]
+        for data in replay_text(text, frame_interval=0.01, max_duration=0.2)
+    ]
+    elapsed = time.monotonic() - tic
+
+    assert frames[-1] == text
+    assert all(text.startswith(x) for x in frames)
+    assert [len(x) for x in frames] == sorted({len(x) for x in frames})
+    assert 2 <= len(frames) <= 0.2 / 0.01 + 1
+    assert elapsed < 0.5
+
+
+def test_short_replay_async():
+    async def collect(text):
+        return [data["text"] async for data in replay_text_async(text)]
+
+    assert asyncio.run(collect("Hello!")) == ["Hello!"]
+    assert asyncio.run(collect("")) == []
@@ -0,0 +1,90 @@
+"""
+Check the frame coalescing, the merging of battle sides and the cached chatbot
+rows of bot_response.
+
+Usage:
+python3 -m pytest tests/test_stream_frames.py
+"""
+import time
+
+import pytest
+
+from fastchat.conversation import get_conv_template
+from fastchat.serve.frame_coalescer import coalesce_frames, merge_streams
+
+
+def stream(num_items, stall=0, error=None):
+    for i in range(num_items):
+        yield {"text": str(i), "error_code": 0, "tstamp": time.monotonic()}
+    time.sleep(stall)
+    if error is not None:
+        raise error
+
+
+def test_coalesce_frames():
+    frames = list(coalesce_frames(stream(10000), frame_interval=0.05))
+    assert len(frames) < 100
+    assert frames[0]["text"] == "0"
+    assert frames[-1]["text"] == "9999"
+    assert [int(x["text"]) for x in frames] == sorted(int(x["text"]) for x in frames)
+
+    # The last item before a stall is not held back until the stall ends
+    tic = time.monotonic()
+    for data in coalesce_frames(stream(3, stall=1), frame_interval=0.05):
+        if data["text"] == "2":
+            assert time.monotonic() - tic < 0.5
+
+    frames = []
+    with pytest.raises(ValueError):
+        for data in coalesce_frames(stream(3, error=ValueError())):
+            frames.append(data["text"])
+    assert frames[-1] == "2"
+
+
+def slow_stream(delay, num_items=3):
+    for i in range(num_items):
+        time.sleep(delay)
+        yield i
+
+
+def test_merge_streams():
+    received = []
+    tic = time.monotonic()
+    for updates in merge_streams([slow_stream(0.3), stream(3, error=ValueError())]):
+        for i, data, error in updates:
+            received.append((i, time.monotonic() - tic, data, error))
+
+    # The failing side ends first and does not stop the slow side
+    errors = [x for x in received if x[3] is not None]
+    assert [(i, type(error)) for i, _, _, error in errors] == [(1, ValueError)]
+    assert errors[0][1] < 0.3
+    assert [data for i, _, data, _ in received if i == 0] == [0, 1, 2]
+
+    received = []
+    for updates in merge_streams([slow_stream(0.05), slow_stream(5)], timeout=0.5):
+        received += updates
+    assert [data for i, data, _ in received if i == 0] == [0, 1, 2]
+    assert [(i, type(error)) for i, _, error in received if error] == [
+        (1, TimeoutError)
+    ]
+
+
+def test_cached_chatbot_rows():
+    conv = get_conv_template("chatgpt")
+
+    def expected():
+        return conv._to_gradio_chatbot_rows(conv.messages[conv.offset :])
+
+    for i in range(3):
+        conv.append_message(conv.roles[0], f"question {i}")
+        conv.append_message(conv.roles[1], None)
+        assert conv.to_gradio_chatbot() == expected()
+        for j in range(3):
+            conv.update_last_message(f"answer {i}" * j)
+            assert conv.to_gradio_chatbot() == expected()
+
+    conv.messages[0][1] = "edited question"
+    assert conv.to_gradio_chatbot() == expected()
+    assert conv.to_gradio_chatbot()[0] == ["edited question", "answer 0answer 0"]
+    conv.messages = conv.messages[:2]
+    assert conv.to_gradio_chatbot() == expected()